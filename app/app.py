@@ -12,57 +12,649 @@ import os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'vendor'))
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'config'))
 
-import math
-import bson
+import time
+import itertools
+import struct
+import bisect
+import array
 import pymongo
 import config
+import resultcache
+import downsample
+import hyperloglog
+import topk
+import server
 
-from bottle import TEMPLATE_PATH, HTTPError, get, run, debug, request, validate, static_file, error
-from bottle import jinja2_view as view, jinja2_template as template
+from bottle import TEMPLATE_PATH, HTTPError, get, run, debug, request, response, static_file, json_dumps
+from bottle import jinja2_view as view
 
 # the collection prefix to use for flows
 DB_FLOW_PREFIX = "flows_"
 # the collection prefix to use for completely aggregated flows
 DB_FLOW_AGGR_PREFIX = "flows_aggr_"
+# the collection prefix to use for flows aggregated by a subset of the values
+DB_FLOW_CUBE_PREFIX = "flows_cube_"
+# the collection prefix to use for flows aggregated by the networks of a prefix length
+DB_FLOW_NET_PREFIX = "flows_net"
+# the collection prefix to use for the top-k summaries
+DB_TOPK_PREFIX = "topk_"
 # the collection to use for the node index
 DB_INDEX_NODES = "index_nodes"
 # the collection to use for the port index
 DB_INDEX_PORTS = "index_ports"
+# the collection to use for the bucket catalogue
+DB_BUCKET_CATALOGUE = "bucket_catalogue"
+# the collection the preprocessors publish their horizon in
+DB_HORIZON = "horizon"
 # column names of IP addresses
 COL_SRC_IP = "srcIP"
 COL_DST_IP = "dstIP"
 # column names of ports
 COL_SRC_PORT = "srcPort"
 COL_DST_PORT = "dstPort"
+# the array types of the binary bucket format
+BINARY_TYPES = { "uint32": "I", "int32": "i", "float64": "d" }
 
 # set template path
 TEMPLATE_PATH.insert(0, os.path.join(os.path.dirname(__file__), "views"))
 
+# queries aborted by MongoDB after the request timeout (pymongo >= 2.7)
+EXECUTION_TIMEOUT = getattr(pymongo.errors, "ExecutionTimeout", ())
+
 # MongoDB
-db = pymongo.Connection(config.db_host, config.db_port)[config.db_name]
+def connect():
+	"""Connect to MongoDB with a connection pool for the threads of the server.
+	"""
+	return pymongo.Connection(config.db_host, config.db_port, max_pool_size=config.server_threads)[config.db_name]
+	
+db = connect()
 
-def get_bucket_size(start_time, end_time, resolution):
-	for i,s in enumerate(config.flow_bucket_sizes):
-		if i == len(config.flow_bucket_sizes)-1:
-			return s
+class BucketCatalogue:
+	def __init__(self, collection, ttl=10):
+		"""Keeps the bucket catalogue written by the preprocessor in memory.
+		The catalogue is reloaded if it is older than `ttl` seconds.
+		
+		:Parameters:
+		 - `collection`: The bucket catalogue collection.
+		 - `ttl`: The number of seconds the catalogue is kept.
+		"""
+		self.collection = collection
+		self.ttl = ttl
+		self.loaded = None
+		# bucket size -> (sorted days, sorted bucket arrays per day)
+		self.sizes = dict()
+		
+	def load(self):
+		sizes = dict()
+		for doc in self.collection.find(fields={ "size": 1, "day": 1, "buckets": 1 }).sort("day", pymongo.ASCENDING):
+			if len(doc.get("buckets", [])) == 0:
+				continue
+			days, buckets = sizes.setdefault(doc["size"], ([], []))
+			days.append(doc["day"])
+			buckets.append(array.array("l", sorted(doc["buckets"])))
+		# replaced at once, other threads may be reading it
+		self.sizes = sizes
+		self.loaded = time.time()
+		
+	def getRange(self, size, start_time, end_time):
+		"""Returns the smallest and the largest bucket between start_time and end_time.
+		Returns (None, None) if there are no buckets in the interval and None if
+		the catalogue does not know the bucket size at all.
+		"""
+		if self.loaded == None or time.time() - self.loaded > self.ttl:
+			self.load()
 			
-		coll = db[DB_FLOW_AGGR_PREFIX + str(s)]
+		if size not in self.sizes:
+			return None
+		days, buckets = self.sizes[size]
+		
+		# the days which may contain buckets in the interval
+		first = max(bisect.bisect_right(days, start_time) - 1, 0)
+		last = bisect.bisect_right(days, end_time)
+		
+		min_bucket = None
+		for i in xrange(first, last):
+			j = bisect.bisect_left(buckets[i], start_time)
+			if j < len(buckets[i]) and buckets[i][j] <= end_time:
+				min_bucket = buckets[i][j]
+				break
+		if min_bucket == None:
+			return None, None
+			
+		max_bucket = None
+		for i in xrange(last - 1, first - 1, -1):
+			j = bisect.bisect_right(buckets[i], end_time) - 1
+			if j >= 0 and buckets[i][j] >= start_time:
+				max_bucket = buckets[i][j]
+				break
+		return min_bucket, max_bucket
+
+catalogue = BucketCatalogue(db[DB_BUCKET_CATALOGUE], config.db_catalogue_ttl)
+
+class Partitions:
+	def __init__(self, ttl=10):
+		"""Keeps the names of the collections in memory to find the partitions
+		of the bucket collections. The names are reloaded if they are older
+		than `ttl` seconds.
+		"""
+		self.ttl = ttl
+		self.loaded = None
+		self.names = []
+		
+	def load(self):
+		# replaced at once, other threads may be reading it
+		self.names = db.collection_names()
+		self.loaded = time.time()
+		
+	def getCollections(self, name, size, start_time, end_time):
+		"""Returns the partitions of a bucket collection which overlap the
+		interval between start_time and end_time sorted by time.
+		"""
+		width = config.flow_partition_sizes.get(size, 0)
+		if width == 0:
+			return [db[name]]
+			
+		if self.loaded == None or time.time() - self.loaded > self.ttl:
+			self.load()
+			
+		prefix = name + "_"
+		starts = sorted([int(n[len(prefix):]) for n in self.names if n.startswith(prefix) and n[len(prefix):].isdigit()])
+		return [db[prefix + str(start)] for start in starts if start + width > start_time and start <= end_time]
+		
+partitions = Partitions(config.db_catalogue_ttl)
+
+# instance name -> (start time, number of the last late write) of the
+# preprocessors seen by the last call of read_horizon (None before the first call)
+horizon_seen = None
+
+def read_horizon_docs():
+	"""Returns the horizon documents of the running preprocessors.
+	"""
+	docs = list(db[DB_HORIZON].find())
+	if len(docs) == 0:
+		return docs
+		
+	# instances which have not published their horizon for a while are stopped
+	newest = max([doc["updated"] for doc in docs])
+	return [doc for doc in docs if doc["updated"] >= newest - config.app_cache_horizon_timeout]
+	
+def get_horizons(docs):
+	"""Returns the time up to which all preprocessors of the horizon documents
+	have written the buckets of each bucket size.
+	"""
+	horizons = dict()
+	for doc in docs:
+		if "horizons" in doc:
+			doc_horizons = dict([(int(s), horizon) for s, horizon in doc["horizons"].iteritems()])
+		else:
+			# published by a preprocessor without horizons per bucket size
+			doc_horizons = dict([(s, doc["horizon"]) for s in config.flow_bucket_sizes])
+		for s, horizon in doc_horizons.iteritems():
+			horizons[s] = min(horizon, horizons.get(s, horizon))
+	return horizons
+	
+def read_horizon():
+	"""Returns the time up to which all running preprocessors have written the buckets
+	of each bucket size and the earliest bucket of each size written after the horizon
+	had passed it since the last call (None if the late writes are not known),
+	or None if no preprocessor has published its horizon.
+	"""
+	global horizon_seen
+	
+	docs = read_horizon_docs()
+	if len(docs) == 0:
+		return None
+		
+	horizons = get_horizons(docs)
+	late = dict()
+	seen = dict()
+	for doc in docs:
+		started = doc.get("started", 0)
+		entries = doc.get("late", [])
+		last = 0
+		if len(entries) > 0:
+			last = entries[-1][0]
+		seen[doc["_id"]] = (started, last)
+		
+		previous = None
+		if horizon_seen != None:
+			previous = horizon_seen.get(doc["_id"], None)
+		if previous == None or previous[0] != started:
+			# a new or restarted instance may have written any bucket
+			if horizon_seen != None:
+				late = None
+		elif len(entries) > 0 and entries[0][0] > previous[1] + 1:
+			# the log does not contain all late writes since the last call
+			late = None
+		elif late != None:
+			for num, s, bucket in entries:
+				if num > previous[1]:
+					late[s] = min(bucket, late.get(s, bucket))
+					
+	horizon_seen = seen
+	return horizons, late
+	
+def init_worker():
+	"""Worker processes of the prefork server open their own connection after the fork.
+	"""
+	global db
+	db = connect()
+	catalogue.collection = db[DB_BUCKET_CATALOGUE]
+	
+def limit_time(cursor):
+	"""Let MongoDB abort the query of a cursor after the request timeout.
+	"""
+	if config.server_timeout > 0 and hasattr(cursor, "max_time_ms"):
+		cursor.max_time_ms(config.server_timeout * 1000)
+	return cursor
+	
+def abort_on_timeout(query):
+	"""Run a query and iterate over its results.
+	A query aborted by MongoDB leads to an error response.
+	
+	:Parameters:
+	 - `query`: A function returning an iterator over the results.
+	"""
+	try:
+		for doc in query():
+			yield doc
+	except EXECUTION_TIMEOUT:
+		raise HTTPError(503, "The query took longer than %i seconds." % (config.server_timeout))
+		
+result_cache = resultcache.ResultCache(config.app_cache_size, read_horizon, config.app_cache_horizon_interval)
+
+def find_bucket_range(size, start_time, end_time):
+	"""Find the smallest and the largest bucket of an aggregated collection
+	between start_time and end_time. Uses the bucket catalogue and falls back
+	to querying the collection if the catalogue has no entries for this size.
+	"""
+	bucket_range = catalogue.getRange(size, start_time, end_time)
+	if bucket_range != None:
+		return bucket_range
+		
+	# the first and the last partition with buckets in the interval
+	colls = partitions.getCollections(DB_FLOW_AGGR_PREFIX + str(size), size, start_time, end_time)
+	min_bucket = None
+	for coll in colls:
 		min_bucket = coll.find_one(
 			{ "bucket": { "$gte": start_time, "$lte": end_time} }, 
 			fields={ "bucket": 1, "_id": 0 }, 
 			sort=[("bucket", pymongo.ASCENDING)])
+		if min_bucket:
+			break
+	max_bucket = None
+	for coll in reversed(colls):
 		max_bucket = coll.find_one(
 			{ "bucket": { "$gte": start_time, "$lte": end_time} }, 
 			fields={ "bucket": 1, "_id": 0 }, 
 			sort=[("bucket", pymongo.DESCENDING)])
+		if max_bucket:
+			break
+		
+	if not min_bucket or not max_bucket:
+		return None, None
+	return min_bucket["bucket"], max_bucket["bucket"]
+
+def find_cube(fields):
+	"""Find the cube with the fewest aggregation values which contains all `fields`.
+	Returns its aggregation values sorted like config.flow_aggr_values or None.
+	"""
+	cube = None
+	for cube_fields in config.flow_cubes:
+		cube_fields = [v for v in config.flow_aggr_values if v in cube_fields]
+		if set(fields) <= set(cube_fields) and (cube == None or len(cube_fields) < len(cube)):
+			cube = cube_fields
+	return cube
+	
+def get_prefix():
+	"""Returns the prefix length of the request param prefix or None.
+	"""
+	if not "prefix" in request.GET:
+		return None
+	try:
+		prefix = int(request.GET["prefix"])
+	except ValueError:
+		raise HTTPError(output="Param prefix has to be an integer.")
+	if prefix not in config.flow_prefix_lengths:
+		raise HTTPError(output="Param prefix has to be one of the prefix lengths: %s." % (",".join(map(str, sorted(config.flow_prefix_lengths)))))
+	return prefix
+	
+def find_topk_sketches(fields, value, start_time, end_time, horizons=None, sizes=None):
+	"""Yields the top-k summaries of the buckets starting between start_time and
+	(excluding) end_time with as few summaries as possible.
+	The largest bucket size covers its buckets which lie completely in the
+	interval and behind its horizon. The rest of the interval and its buckets
+	without a summary (not written yet or expired) are covered by the next
+	smaller bucket size. The summaries of buckets which are still open (e.g.
+	written on a shutdown of the preprocessor) cover only a part of their
+	bucket, so only the smallest bucket size is used for them.
+	
+	:Parameters:
+	 - `fields`: The aggregation values of the summaries joined by "_".
+	 - `value`: The summed up value the summaries are ranked by.
+	 - `start_time`: The start of the interval.
+	 - `end_time`: The end of the interval.
+	 - `horizons`: The horizon of each bucket size (None if unknown, which
+	   uses all summaries).
+	 - `sizes`: The bucket sizes to use, largest first (defaults to all).
+	"""
+	if sizes == None:
+		sizes = sorted(config.flow_bucket_sizes, reverse=True)
+	if len(sizes) == 0 or start_time >= end_time:
+		return
+		
+	s = sizes[0]
+	first = start_time + (-start_time % s)
+	last = end_time - end_time % s
+	if len(sizes) == 1:
+		last = end_time + (-end_time % s)
+	elif horizons != None:
+		horizon = horizons.get(s, 0)
+		last = min(last, horizon - horizon % s)
+	if first >= last:
+		for sketch in find_topk_sketches(fields, value, start_time, end_time, horizons, sizes[1:]):
+			yield sketch
+		return
+		
+	gaps = [(start_time, first)]
+	covered = first
+	for collection in partitions.getCollections(DB_TOPK_PREFIX + str(s), s, first, last - 1):
+		cursor = collection.find(
+			{ "bucket": { "$gte": first, "$lt": last }, "fields": fields, "value": value },
+			fields={ "bucket": 1, "floor": 1, "items": 1, "total": 1, "_id": 0 }
+		).sort("bucket", pymongo.ASCENDING).batch_size(100)
+		limit_time(cursor)
+		for sketch in cursor:
+			if sketch["bucket"] > covered:
+				gaps.append((covered, sketch["bucket"]))
+			covered = sketch["bucket"] + s
+			yield sketch
+	gaps.append((covered, end_time))
+	
+	for gap_start, gap_end in gaps:
+		for sketch in find_topk_sketches(fields, value, gap_start, gap_end, horizons, sizes[1:]):
+			yield sketch
+			
+def get_bucket_size(start_time, end_time, resolution):
+	for i,s in enumerate(config.flow_bucket_sizes):
+		if i == len(config.flow_bucket_sizes)-1:
+			return s
 			
-		if not min_bucket or not max_bucket:
+		min_bucket, max_bucket = find_bucket_range(s, start_time, end_time)
+		if min_bucket == None or max_bucket == None:
 			return s
 			
-		num_slots = (max_bucket["bucket"]-min_bucket["bucket"]) / s + 1
+		num_slots = (max_bucket-min_bucket) / s + 1
 		if num_slots <= resolution:
 			return s
+
+def get_slot_width(start_time, end_time, resolution, bucket_size=None):
+	"""Find the bucket size and the slots to downsample a bucket query to at most `resolution` slots.
+	Chooses the smallest bucket size which has at most app_downsample_factor buckets
+	per slot unless `bucket_size` is set. Each slot spans a whole number of buckets
+	and the first one starts at the first bucket, so there may be fewer slots
+	(e.g. 11 buckets at a resolution of 10 lead to 6 slots of 2 buckets).
+	Returns the bucket size, the first bucket and the slot width.
+	"""
+	sizes = config.flow_bucket_sizes
+	if bucket_size != None:
+		sizes = [bucket_size]
+		
+	for i,s in enumerate(sizes):
+		min_bucket, max_bucket = find_bucket_range(s, start_time, end_time)
+		if min_bucket == None or max_bucket == None:
+			return s, start_time, s
+			
+		num_buckets = (max_bucket - min_bucket) / s + 1
+		if num_buckets <= resolution * config.app_downsample_factor or i == len(sizes)-1:
+			buckets_per_slot = (num_buckets + resolution - 1) / resolution
+			return s, min_bucket, buckets_per_slot * s
+			
+def aggregate_python(collection, spec, fields, biflow):
+	"""Group the documents of a bucket query in Python.
+	Yields the buckets sorted by the bucket timestamp, each one as
+	soon as all of its documents have been read.
+	
+	:Parameters:
+	 - `collection`: The flow collection to query.
+	 - `spec`: The query to select the documents.
+	 - `fields`: The aggregation values to group by.
+	 - `biflow`: Whether srcIP and dstIP are swapped so the smaller one is the srcIP.
+	"""
+	query_fields = fields + ["bucket", "flows"] + config.flow_aggr_sums
+	cursor = collection.find(spec, fields=query_fields).sort("bucket", pymongo.ASCENDING).batch_size(1000)
+	limit_time(cursor)
+	
+	current_bucket = -1
+	aggr_buckets = {}
+	for doc in cursor:
+		if doc["bucket"] > current_bucket:
+			for key in aggr_buckets:
+				yield aggr_buckets[key]
+			aggr_buckets = {}
+			current_bucket = doc["bucket"]
+			
+		# biflow?
+		if biflow and COL_SRC_IP in fields and COL_DST_IP in fields:
+			srcIP = doc.get(COL_SRC_IP, None)
+			dstIP = doc.get(COL_DST_IP, None)
+			if srcIP > dstIP:
+				doc[COL_SRC_IP] = dstIP
+				doc[COL_DST_IP] = srcIP
+		
+		# construct aggregation key
+		key = tuple([doc.get(a, None) for a in fields])
+			
+		if key not in aggr_buckets:
+			bucket = { "bucket": current_bucket }
+			for a in fields:
+				bucket[a] = doc.get(a, None)
+			for s in ["flows"] + config.flow_aggr_sums:
+				bucket[s] = 0
+			aggr_buckets[key] = bucket
+		else:
+			bucket = aggr_buckets[key]
+		
+		for s in ["flows"] + config.flow_aggr_sums:
+			bucket[s] += doc.get(s, 0)
+		
+	for key in aggr_buckets:
+		yield aggr_buckets[key]
+	
+def aggregate_pipeline(collection, spec, fields, biflow):
+	"""Group the documents of a bucket query with the aggregation pipeline of MongoDB.
+	Returns an iterator over the buckets sorted by the bucket timestamp.
+	Raises pymongo.errors.OperationFailure if the server does not support it.
+	
+	:Parameters:
+	 - `collection`: The flow collection to query.
+	 - `spec`: The query to select the documents.
+	 - `fields`: The aggregation values to group by.
+	 - `biflow`: Whether srcIP and dstIP are swapped so the smaller one is the srcIP.
+	"""
+	pipeline = [{ "$match": spec }]
+	
+	# biflow?
+	if biflow and COL_SRC_IP in fields and COL_DST_IP in fields:
+		project = dict([(f, 1) for f in fields + ["bucket", "flows"] + config.flow_aggr_sums])
+		swap = { "$gt": [ "$" + COL_SRC_IP, "$" + COL_DST_IP ] }
+		project[COL_SRC_IP] = { "$cond": [ swap, "$" + COL_DST_IP, "$" + COL_SRC_IP ] }
+		project[COL_DST_IP] = { "$cond": [ swap, "$" + COL_SRC_IP, "$" + COL_DST_IP ] }
+		pipeline.append({ "$project": project })
+		
+	group = { "_id": { "bucket": "$bucket" } }
+	for a in fields:
+		group["_id"][a] = "$" + a
+	for s in ["flows"] + config.flow_aggr_sums:
+		group[s] = { "$sum": "$" + s }
+	pipeline.append({ "$group": group })
+	pipeline.append({ "$sort": { "_id.bucket": pymongo.ASCENDING } })
+	
+	# results are streamed with a cursor since MongoDB 2.6, before they
+	# are returned in one document (limited to 16 MB)
+	options = dict(allowDiskUse=True, cursor={})
+	if config.server_timeout > 0:
+		options["maxTimeMS"] = config.server_timeout * 1000
+	try:
+		result = collection.aggregate(pipeline, **options)
+	except EXECUTION_TIMEOUT:
+		raise
+	except (TypeError, pymongo.errors.OperationFailure):
+		result = collection.aggregate(pipeline)
+	if isinstance(result, dict):
+		result = result["result"]
+		
+	def convert(doc):
+		bucket = { "bucket": doc["_id"]["bucket"] }
+		for a in fields:
+			bucket[a] = doc["_id"].get(a, None)
+		for s in ["flows"] + config.flow_aggr_sums:
+			bucket[s] = doc[s]
+		return bucket
+	return itertools.imap(convert, result)
+	
+def stream_json(envelope, results):
+	"""Serialize a response with a list of results in chunks.
+	The results are read from an iterator, so only one chunk has to be kept
+	in memory. The first chunk is built before anything is sent, so a failing
+	query still leads to an error response.
+	
+	:Parameters:
+	 - `envelope`: A dictionary with the other values of the response.
+	 - `results`: An iterator over the result documents.
+	"""
+	head = json_dumps(envelope)[:-1]
+	if len(envelope) > 0:
+		head += ", "
+	head += '"results": ['
+	
+	chunk = []
+	separator = ""
+	for doc in results:
+		chunk.append(json_dumps(doc))
+		if len(chunk) >= config.app_stream_chunk_size:
+			yield head + separator + ", ".join(chunk)
+			head = ""
+			separator = ", "
+			chunk = []
+	if len(chunk) > 0:
+		yield head + separator + ", ".join(chunk)
+		head = ""
+	yield head + "]}"
+	
+def estimate_distinct(results, distinct):
+	"""Replace the HyperLogLog registers of the results by the distinct counts
+	(named distinct_ and the counted values). The results are copied, they
+	may be kept in the result cache.
+	"""
+	for doc in results:
+		doc = dict(doc)
+		registers = doc.pop("distinct", {})
+		for d in distinct:
+			doc["distinct_" + d] = hyperloglog.estimate(registers.get(d, {}), config.flow_distinct_precision)
+		yield doc
+		
+def collect_columns(results, fields, dictionary, distinct=[]):
+	"""Collect the results of a bucket query into one array per column.
+	Returns the columns as (name, binary type, data) tuples and the
+	dictionary values or None if no dictionary is used.
+	
+	:Parameters:
+	 - `results`: An iterator over the result documents.
+	 - `fields`: The aggregation values of the query.
+	 - `dictionary`: Whether IP addresses are replaced by indexes into the dictionary.
+	 - `distinct`: The distinct counts of the query.
+	"""
+	fields = [f for i, f in enumerate(fields) if f not in fields[:i]]
+	sums = ["flows"] + config.flow_aggr_sums + ["distinct_" + d for d in distinct]
+	encoded = []
+	if dictionary:
+		encoded = [f for f in fields if f in [COL_SRC_IP, COL_DST_IP]]
+	values = []
+	indexes = {}
+	
+	bucket_column = []
+	field_columns = [[] for f in fields]
+	sum_columns = [[] for s in sums]
+	for doc in results:
+		bucket_column.append(doc["bucket"])
+		for f, column in zip(fields, field_columns):
+			value = doc.get(f, None)
+			if f in encoded and value != None:
+				index = indexes.get(value, None)
+				if index == None:
+					index = len(values)
+					indexes[value] = index
+					values.append(value)
+				value = index
+			column.append(value)
+		for s, column in zip(sums, sum_columns):
+			column.append(doc.get(s, 0))
+			
+	columns = [("bucket", "uint32", bucket_column)]
+	for f, column in zip(fields, field_columns):
+		columns.append((f, f in encoded and "int32" or "float64", column))
+	for s, column in zip(sums, sum_columns):
+		columns.append((s, "float64", column))
 		
+	if not dictionary:
+		values = None
+	return columns, values
+	
+def encode_binary(header, columns, values):
+	"""Encode columns as little-endian typed arrays.
+	The buffer starts with the length of a JSON header (uint32) and the header,
+	which states the name, type, offset and length of every column. The offsets
+	count from the end of the header, which is padded to a multiple of 8 bytes
+	like every column, so each one can be read with a typed array view.
+	Missing values are -1 in int32 columns and NaN in float64 columns.
+	
+	:Parameters:
+	 - `header`: A dictionary with the other values of the response.
+	 - `columns`: The columns returned by collect_columns.
+	 - `values`: The dictionary values or None.
+	"""
+	payloads = []
+	for name, type, data in columns:
+		if type == "int32":
+			data = [v == None and -1 or v for v in data]
+		elif type == "float64":
+			data = [v == None and float("nan") or v for v in data]
+		try:
+			data = array.array(BINARY_TYPES[type], data)
+		except TypeError:
+			raise HTTPError(output="Column %s is not numeric, use the dictionary." % (name))
+		if sys.byteorder != "little":
+			data.byteswap()
+		payloads.append((name, type, len(data), data.tostring()))
+		
+	header = dict(header)
+	header["count"] = payloads[0][2]
+	if values != None:
+		header["dictionary"] = values
+	header["columns"] = []
+	offset = 0
+	for name, type, length, payload in payloads:
+		header["columns"].append({ "name": name, "type": type, "offset": offset, "length": length })
+		offset += len(payload) + (-len(payload) % 8)
+		
+	encoded = json_dumps(header)
+	parts = [struct.pack("<I", len(encoded)), encoded, "\0" * (-(4 + len(encoded)) % 8)]
+	for name, type, length, payload in payloads:
+		parts.append(payload)
+		parts.append("\0" * (-len(payload) % 8))
+	return "".join(parts)
+	
+def json_results(envelope, results):
+	"""Return a response with a list of results which is streamed if enabled.
+	"""
+	if config.app_stream_chunk_size > 0:
+		response.content_type = "application/json"
+		return stream_json(envelope, results)
+		
+	envelope["results"] = list(results)
+	return envelope
+	
 @get("/")
 @get("/graph")
 @get("/graph/:##")
@@ -138,7 +730,22 @@ def api_bucket_query():
 			
 		if bucket_size not in config.flow_bucket_sizes:
 			raise HTTPError(output="This bucket size is not available.")
-			
+	
+	# reduce the buckets to the resolution instead of only choosing the bucket size,
+	# either by summing up equally wide slots or by selecting the buckets with lttb
+	downsample_method = None
+	if "downsample" in request.GET:
+		downsample_method = request.GET["downsample"].strip()
+		if downsample_method not in ["sum", "lttb"]:
+			raise HTTPError(output="Param downsample has to be sum or lttb.")
+	
+	# the value whose shape is preserved by lttb
+	value = "flows"
+	if "value" in request.GET:
+		value = request.GET["value"].strip()
+		if value not in ["flows"] + config.flow_aggr_sums:
+			raise HTTPError(output="Param value has to be flows or one of the summed up values.")
+	
 	# biflow aggregation
 	# This simply removes the difference between srcIP and dstIP
 	# (The smaller ip will always be the srcIP)
@@ -146,6 +753,18 @@ def api_bucket_query():
 	if "biflow" in request.GET:
 		biflow = True
 		
+	# return one array per column instead of one object per bucket
+	format = "objects"
+	if "format" in request.GET:
+		format = request.GET["format"].strip()
+		if format not in ["objects", "columnar", "binary"]:
+			raise HTTPError(output="Param format has to be objects, columnar or binary.")
+			
+	# replace the IP addresses of the columnar formats by indexes into a dictionary
+	dictionary = False
+	if "dictionary" in request.GET:
+		dictionary = True
+		
 	# only stated fields will be available, all others will be aggregated toghether	
 	fields = []
 	if "fields" in request.GET:
@@ -170,24 +789,61 @@ def api_bucket_query():
 			exclude_ports = map(lambda v: int(v.strip()), exclude_ports.split(","))
 		except ValueError:
 			raise HTTPError(output="Ports have to be integers.")
+			
+	# distinct counts of the aggregated collections, e.g. srcIP or srcIP_dstPort
+	distinct = []
+	if "distinct" in request.GET:
+		distinct = request.GET["distinct"].strip()
+		distinct = map(lambda v: v.strip(), distinct.split(","))
+		available = ["_".join(d) for d in config.flow_aggr_distinct]
+		if len([d for d in distinct if d not in available]) > 0:
+			raise HTTPError(output="Param distinct has to be a list of the counted values: %s." % (",".join(available)))
+		if len(fields) > 0 or len(include_ports) > 0 or len(exclude_ports) > 0:
+			raise HTTPError(output="Param distinct is only available without fields and port filters.")
+			
+	# replace the IP addresses by their networks of a prefix length, e.g. 24
+	prefix = get_prefix()
+	if prefix != None:
+		if len(fields) == 0 or len([v for v in fields if v not in [COL_SRC_IP, COL_DST_IP]]) > 0 \
+			or len(include_ports) > 0 or len(exclude_ports) > 0:
+			raise HTTPError(output="Param prefix is only available with the fields srcIP and dstIP and without port filters.")
 		
 	# get buckets and aggregate
-	if bucket_size == None:
-		bucket_size = get_bucket_size(start_bucket, end_bucket, resolution)
+	if downsample_method != None:
+		bucket_size, first_slot, slot_width = get_slot_width(start_bucket, end_bucket, resolution, bucket_size)
+	else:
+		if bucket_size == None:
+			bucket_size = get_bucket_size(start_bucket, end_bucket, resolution)
+		slot_width = bucket_size
 	
-	if len(fields) > 0 or len(include_ports) > 0 or len(exclude_ports) > 0:
-		collection = db[DB_FLOW_PREFIX + str(bucket_size)]
+	aggregate = len(fields) > 0 or len(include_ports) > 0 or len(exclude_ports) > 0
+	if prefix != None:
+		collection_name = DB_FLOW_NET_PREFIX + str(prefix) + "_" + str(bucket_size)
+		# the collection is aggregated by both IP addresses
+		swap = biflow and COL_SRC_IP in fields and COL_DST_IP in fields
+		net_fields = [v for v in config.flow_aggr_values if v in [COL_SRC_IP, COL_DST_IP]]
+		if set(net_fields) == set(fields) and not swap:
+			aggregate = False
+	elif aggregate:
+		# the port filters need both ports
+		cube_fields = set(fields)
+		if len(include_ports) > 0 or len(exclude_ports) > 0:
+			cube_fields.update([COL_SRC_PORT, COL_DST_PORT])
+		cube = find_cube(cube_fields)
+		if cube == None:
+			collection_name = DB_FLOW_PREFIX + str(bucket_size)
+		else:
+			# use the smallest preaggregated collection with the fields
+			collection_name = DB_FLOW_CUBE_PREFIX + "_".join(cube) + "_" + str(bucket_size)
+			# nothing has to be aggregated if the cube has exactly the fields
+			swap = biflow and COL_SRC_IP in fields and COL_DST_IP in fields
+			if set(cube) == set(fields) and not swap:
+				aggregate = False
 	else:
 		# use preaggregated collection
-		collection = db[DB_FLOW_AGGR_PREFIX + str(bucket_size)]
+		collection_name = DB_FLOW_AGGR_PREFIX + str(bucket_size)
 		
 	spec = {}
-	if start_bucket > 0 or end_bucket < sys.maxint:
-		spec["bucket"] = {}
-		if start_bucket > 0:
-			spec["bucket"]["$gte"] = start_bucket
-		if end_bucket < sys.maxint:
-			spec["bucket"]["$lte"] = end_bucket
 	if len(include_ports) > 0:
 		spec["$or"] = [
 			{ COL_SRC_PORT: { "$in": include_ports } },
@@ -196,59 +852,152 @@ def api_bucket_query():
 	if len(exclude_ports) > 0:
 		spec[COL_SRC_PORT] = { "$nin": exclude_ports }
 		spec[COL_DST_PORT] = { "$nin": exclude_ports }
-	
-	query_fields = fields + ["bucket", "flows"] + config.flow_aggr_sums
-	cursor = collection.find(spec, fields=query_fields).sort("bucket", pymongo.ASCENDING).batch_size(1000)
-
-	buckets = []
-	if len(fields) > 0 or len(include_ports) > 0 or len(exclude_ports) > 0:
-		current_bucket = -1
-		aggr_buckets = {}
-		for doc in cursor:
-			if doc["bucket"] > current_bucket:
-				for key in aggr_buckets:
-					buckets.append(aggr_buckets[key])
-				aggr_buckets = {}
-				current_bucket = doc["bucket"]
+		
+	def fetch(start_bucket, end_bucket):
+		# buckets never span two partitions, so their results are simply chained
+		for collection in partitions.getCollections(collection_name, bucket_size, start_bucket, end_bucket):
+			for doc in fetch_collection(collection, start_bucket, end_bucket):
+				yield doc
 				
-			# biflow?
-			if biflow and COL_SRC_IP in fields and COL_DST_IP in fields:
-				srcIP = doc.get(COL_SRC_IP, None)
-				dstIP = doc.get(COL_DST_IP, None)
-				if srcIP > dstIP:
-					doc[COL_SRC_IP] = dstIP
-					doc[COL_DST_IP] = srcIP
-			
-			# construct aggregation key
-			key = str(current_bucket)
-			for a in fields:
-				key += str(doc.get(a, "x"))
+	def fetch_collection(collection, start_bucket, end_bucket):
+		bucket_spec = dict(spec)
+		if start_bucket > 0 or end_bucket < sys.maxint:
+			bucket_spec["bucket"] = {}
+			if start_bucket > 0:
+				bucket_spec["bucket"]["$gte"] = start_bucket
+			if end_bucket < sys.maxint:
+				bucket_spec["bucket"]["$lte"] = end_bucket
 				
-			if key not in aggr_buckets:
-				bucket = { "bucket": current_bucket }
-				for a in fields:
-					bucket[a] = doc.get(a, None)
-				for s in ["flows"] + config.flow_aggr_sums:
-					bucket[s] = 0
-				aggr_buckets[key] = bucket
-			else:
-				bucket = aggr_buckets[key]
+		if aggregate:
+			if config.db_aggregation_pipeline and hasattr(collection.__class__, "aggregate"):
+				try:
+					return aggregate_pipeline(collection, bucket_spec, fields, biflow)
+				except EXECUTION_TIMEOUT:
+					raise
+				except pymongo.errors.OperationFailure:
+					pass
+			return aggregate_python(collection, bucket_spec, fields, biflow)
 			
-			for s in ["flows"] + config.flow_aggr_sums:
-				bucket[s] += doc.get(s, 0)
-			
-		for key in aggr_buckets:
-			buckets.append(aggr_buckets[key])
-	else:
 		# cheap operation if nothing has to be aggregated
-		for doc in cursor:
+		query_fields = fields + ["bucket", "flows"] + config.flow_aggr_sums + ["distinct." + d for d in distinct]
+		cursor = collection.find(bucket_spec, fields=query_fields).sort("bucket", pymongo.ASCENDING).batch_size(1000)
+		limit_time(cursor)
+		def strip_id(doc):
 			del doc["_id"]
-			buckets.append(doc)
+			return doc
+		return itertools.imap(strip_id, cursor)
+		
+	def query():
+		if config.app_cache_size > 0:
+			# the results only depend on the collection and the aggregation
+			key = (collection_name, tuple(sorted(set(fields))), tuple(sorted(set(include_ports))),
+				tuple(sorted(set(exclude_ports))), biflow, tuple(sorted(set(distinct))))
+			return result_cache.query(key, bucket_size, start_bucket, end_bucket, fetch)
+		return fetch(start_bucket, end_bucket)
+	buckets = abort_on_timeout(query)
 	
-	return { 
+	if downsample_method == "sum":
+		buckets = downsample.rebucket(buckets, list(set(fields)), ["flows"] + config.flow_aggr_sums, first_slot, slot_width, distinct)
+	elif downsample_method == "lttb":
+		buckets = downsample.lttb(buckets, resolution, value)
+		
+	# the registers are merged up to here
+	if len(distinct) > 0:
+		buckets = estimate_distinct(buckets, distinct)
+	
+	# slot_width is the time span each result stands for
+	if format == "objects":
+		return json_results({ "bucket_size": bucket_size, "slot_width": slot_width }, buckets)
+	
+	columns, values = collect_columns(buckets, fields, dictionary, distinct)
+	if format == "binary":
+		response.content_type = "application/octet-stream"
+		return encode_binary({ "bucket_size": bucket_size, "slot_width": slot_width }, columns, values)
+	
+	result = {
 		"bucket_size": bucket_size,
-		"results": buckets
+		"slot_width": slot_width,
+		"results": dict([(name, list(data)) for name, type, data in columns])
 	}
+	if values != None:
+		result["dictionary"] = values
+	return result
+	
+@get("/api/topk")
+@get("/api/topk/")
+def api_topk():
+	# get query params
+	start_bucket = 0
+	if "start_bucket" in request.GET:
+		try:
+			start_bucket = int(request.GET["start_bucket"])
+		except ValueError:
+			raise HTTPError(output="Param start_bucket has to be an integer.")
+		
+		if start_bucket < 0:
+			start_bucket = 0
+	
+	end_bucket = sys.maxint
+	if "end_bucket" in request.GET:
+		try:
+			end_bucket = int(request.GET["end_bucket"])
+		except ValueError:
+			raise HTTPError(output="Param end_bucket has to be an integer.")
+		
+		if end_bucket < 0:
+			end_bucket = 0
+			
+	# the aggregation values to find the heavy hitters of, e.g. srcIP or srcIP,dstIP
+	fields = []
+	if "fields" in request.GET:
+		fields = request.GET["fields"].strip()
+		fields = map(lambda v: v.strip(), fields.split(","))
+	fields = [v for v in config.flow_aggr_values if v in fields]
+	available = [[v for v in config.flow_aggr_values if v in f] for f in config.topk_fields]
+	if len(fields) == 0 or fields not in available:
+		raise HTTPError(output="There is no top-k summary of these fields.")
+		
+	# the summed up value the heavy hitters are ranked by
+	value = config.topk_values[0]
+	if "value" in request.GET:
+		value = request.GET["value"].strip()
+		if value not in config.topk_values:
+			raise HTTPError(output="Param value has to be one of the ranked values.")
+			
+	limit = 10
+	if "limit" in request.GET:
+		try:
+			limit = int(request.GET["limit"])
+		except ValueError:
+			raise HTTPError(output="Param limit has to be an integer.")
+			
+		if limit < 1 or limit > config.topk_size:
+			raise HTTPError(output="Param limit has to be between 1 and %i." % (config.topk_size))
+			
+	# the buckets starting in the interval are covered
+	end_time = end_bucket
+	if end_bucket < sys.maxint:
+		end_time = end_bucket + 1
+	# coarse summaries are only used for buckets behind the horizon
+	horizons = None
+	docs = read_horizon_docs()
+	if len(docs) > 0:
+		horizons = get_horizons(docs)
+	sketches = abort_on_timeout(lambda: find_topk_sketches("_".join(fields), value, start_bucket, end_time, horizons))
+	results, bound, total = topk.merge(sketches, limit)
+	
+	def to_doc(result):
+		item, upper, lower = result
+		if len(fields) == 1:
+			item = (item,)
+		doc = dict(zip(fields, item))
+		# the weight is at most the estimate and at least estimate - error
+		doc[value] = upper
+		doc["error"] = upper - lower
+		return doc
+		
+	# values which are not in the results weigh at most max_other
+	return json_results({ "value": value, "total": total, "max_other": bound }, itertools.imap(to_doc, results))
 	
 @get("/api/index/:name")
 @get("/api/index/:name/")
@@ -289,31 +1038,42 @@ def api_index(name):
 	if "count" in request.GET:
 		count = True
 	
+	# the networks of a prefix length instead of the single nodes
+	prefix = get_prefix()
+	
 	collection = None
 	if name == "nodes":
 		collection = db[DB_INDEX_NODES]
+		if prefix != None:
+			collection = db[DB_INDEX_NODES + "_" + str(prefix)]
 	elif name == "ports":
+		if prefix != None:
+			raise HTTPError(output="Param prefix is only available for the node index.")
 		collection = db[DB_INDEX_PORTS]
 		
 	if collection == None:
 		raise HTTPError(404, "Index name not known.")
 		
 	cursor = collection.find(fields=fields).batch_size(1000)
+	limit_time(cursor)
 	if sort:
 		cursor.sort(sort)
 	if limit:
 		cursor.limit(limit)
 		
 	if count:
-		result = cursor.count() 
-	else:
-		result = []
-		for row in cursor:
-			row["id"] = row["_id"]
-			del row["_id"]
-			result.append(row)
-	
-	return { "results": result }
+		return { "results": cursor.count() }
+		
+	def rename_id(row):
+		row["id"] = row["_id"]
+		del row["_id"]
+		return row
+	return json_results({}, abort_on_timeout(lambda: itertools.imap(rename_id, cursor)))
+
+@get("/api/cache")
+@get("/api/cache/")
+def api_cache():
+	return result_cache.getStats()
 
 @get("/static/:path#.+#")
 def server_static(path):
@@ -321,4 +1081,11 @@ def server_static(path):
 
 if __name__ == "__main__":
 	debug(config.debug)
-	run(host=config.host, port=config.port, reloader=config.debug)
\ No newline at end of file
+	if config.server == "threaded":
+		run(server=server.ThreadedServer, host=config.host, port=config.port,
+			threads=config.server_threads)
+	elif config.server == "prefork":
+		run(server=server.PreforkServer, host=config.host, port=config.port,
+			workers=config.server_workers, timeout=config.server_timeout, init=init_worker)
+	else:
+		run(host=config.host, port=config.port, reloader=config.debug)
\ No newline at end of file
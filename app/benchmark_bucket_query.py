@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compare the Python grouping of bucket queries with the aggregation
+pipeline of MongoDB on a large synthetic flow collection.
+The dataset is written into its own database, which is dropped first.
+"""
+
+import sys
+import time
+import random
+import argparse
+
+import pymongo
+
+import app
+
+parser = argparse.ArgumentParser(description="Benchmark the grouping of bucket queries.")
+parser.add_argument("--dst-host", nargs="?", default=app.config.db_host, help="MongoDB host")
+parser.add_argument("--dst-port", nargs="?", default=app.config.db_port, type=int, help="MongoDB port")
+parser.add_argument("--dst-database", nargs="?", default="flows_benchmark", help="MongoDB database for the synthetic dataset (will be dropped!)")
+parser.add_argument("--docs", nargs="?", default=1000000, type=int, help="Number of generated flow documents")
+parser.add_argument("--bucket-size", nargs="?", default=60, type=int, help="Bucket size of the generated collection")
+parser.add_argument("--keep", nargs="?", type=bool, default=False, const=True, help="Reuse the dataset of a previous run")
+args = parser.parse_args()
+
+# the queries to compare: fields, include_ports, exclude_ports, biflow
+QUERIES = [
+	(["srcIP", "dstIP"], [], [], False),
+	(["srcIP", "dstIP"], [], [], True),
+	(["dstPort"], [], [], False),
+	([], [80, 443], [], False),
+	(["srcIP"], [], [53], False)
+]
+
+def generate(collection):
+	random.seed(0)
+	start = 1330000000 // args.bucket_size * args.bucket_size
+	num_buckets = max(1, args.docs // 1000)
+	batch = []
+	for i in xrange(args.docs):
+		doc = {
+			"bucket": start + random.randint(0, num_buckets - 1) * args.bucket_size,
+			"srcIP": 0x0a000000 + random.randint(0, 255),
+			"dstIP": 0x0a000000 + random.randint(0, 255),
+			"srcPort": random.choice([80, 443, 22, 53, None]),
+			"dstPort": random.choice([80, 443, 22, 53, None]),
+			"flows": random.random() * 10,
+			"pkts": random.randint(1, 1000),
+			"bytes": random.randint(40, 1000000)
+		}
+		batch.append(doc)
+		if len(batch) >= 10000:
+			collection.insert(batch)
+			batch = []
+	if len(batch) > 0:
+		collection.insert(batch)
+	collection.create_index("bucket")
+
+def canonical(buckets, fields):
+	result = {}
+	for b in buckets:
+		key = tuple([b["bucket"]] + [b.get(f, None) for f in fields])
+		result[key] = [b["flows"]] + [b[s] for s in app.config.flow_aggr_sums]
+	return result
+
+def same(a, b):
+	if set(a) != set(b):
+		return False
+	for key in a:
+		if a[key][1:] != b[key][1:] or abs(a[key][0] - b[key][0]) > 1e-6 * max(1, abs(a[key][0])):
+			return False
+	return True
+
+conn = pymongo.Connection(args.dst_host, args.dst_port)
+if not args.keep:
+	conn.drop_database(args.dst_database)
+collection = conn[args.dst_database][app.DB_FLOW_PREFIX + str(args.bucket_size)]
+if not args.keep:
+	start = time.time()
+	generate(collection)
+	print "Generated %i documents in %.2f seconds." % (args.docs, time.time() - start)
+print ""
+
+for fields, include_ports, exclude_ports, biflow in QUERIES:
+	spec = {}
+	if len(include_ports) > 0:
+		spec["$or"] = [
+			{ app.COL_SRC_PORT: { "$in": include_ports } },
+			{ app.COL_DST_PORT: { "$in": include_ports } }
+		]
+	if len(exclude_ports) > 0:
+		spec[app.COL_SRC_PORT] = { "$nin": exclude_ports }
+		spec[app.COL_DST_PORT] = { "$nin": exclude_ports }
+
+	start = time.time()
+	python_buckets = list(app.aggregate_python(collection, spec, fields, biflow))
+	python_time = time.time() - start
+
+	start = time.time()
+	pipeline_buckets = list(app.aggregate_pipeline(collection, spec, fields, biflow))
+	pipeline_time = time.time() - start
+
+	print "fields=%s include_ports=%s exclude_ports=%s biflow=%s" % (",".join(fields), include_ports, exclude_ports, biflow)
+	print "Python:   %.3f seconds (%i buckets)" % (python_time, len(python_buckets))
+	print "Pipeline: %.3f seconds (%i buckets, %.1fx)" % (pipeline_time, len(pipeline_buckets), python_time / max(pipeline_time, 0.001))
+	if not same(canonical(python_buckets, fields), canonical(pipeline_buckets, fields)):
+		print >> sys.stderr, "Results differ!"
+		sys.exit(1)
+	print ""
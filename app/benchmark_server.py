@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Load test for a running app. Several clients request a mix of slow and
+fast queries concurrently, the throughput and the latency percentiles
+are printed per path. Run it once against each server mode to compare.
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'config'))
+
+import time
+import urllib2
+import argparse
+import threading
+
+import config
+
+# a slow query which has to aggregate the raw flows and some cheap ones
+DEFAULT_PATHS = [
+	"/api/bucket/query?resolution=1000&fields=srcIP,dstIP",
+	"/api/bucket/query?resolution=1000",
+	"/api/index/ports?limit=10&sort=flows",
+	"/api/index/nodes?count"
+]
+
+parser = argparse.ArgumentParser(description="Measure the throughput and latency of concurrent requests to the app.")
+parser.add_argument("--url", nargs="?", default="http://127.0.0.1:%i" % (config.port), help="Base URL of the app")
+parser.add_argument("--path", nargs="*", default=DEFAULT_PATHS, help="Paths which are requested in turn by every client")
+parser.add_argument("--clients", nargs="?", default=16, type=int, help="Number of concurrent clients")
+parser.add_argument("--duration", nargs="?", default=30, type=int, help="Duration of the test in seconds")
+parser.add_argument("--timeout", nargs="?", default=120, type=int, help="Timeout of a single request in seconds")
+args = parser.parse_args()
+
+def percentile(values, p):
+	if len(values) == 0:
+		return 0
+	return values[min(len(values) - 1, int(len(values) * p))]
+
+def client(num, results, errors, stop_time):
+	i = num
+	while time.time() < stop_time:
+		path = args.path[i % len(args.path)]
+		i += 1
+		start = time.time()
+		try:
+			f = urllib2.urlopen(args.url + path, timeout=args.timeout)
+			f.read()
+			f.close()
+		except Exception, e:
+			errors.append((path, str(e)))
+			continue
+		results.append((path, time.time() - start))
+
+results = []
+errors = []
+start = time.time()
+threads = []
+for i in range(args.clients):
+	thread = threading.Thread(target=client, args=(i, results, errors, start + args.duration))
+	thread.daemon = True
+	thread.start()
+	threads.append(thread)
+for thread in threads:
+	thread.join()
+elapsed = time.time() - start
+
+print "%i clients, %.1f seconds: %i requests (%.2f requests/s), %i errors" % (
+	args.clients, elapsed, len(results), len(results) / elapsed, len(errors))
+print ""
+print "%-60s %8s %8s %8s %8s %8s" % ("path", "requests", "p50", "p95", "p99", "max")
+for path in args.path + [None]:
+	latencies = sorted([t for p, t in results if path == None or p == path])
+	print "%-60s %8i %7.3fs %7.3fs %7.3fs %7.3fs" % (
+		path or "all", len(latencies), percentile(latencies, 0.5), percentile(latencies, 0.95),
+		percentile(latencies, 0.99), latencies and latencies[-1] or 0)
+
+if len(errors) > 0:
+	print ""
+	for path, error in errors[:10]:
+		print >> sys.stderr, "%s: %s" % (path, error)
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+"""
+Downsampling of bucket query results to the resolution of a chart.
+
+rebucket sums up the buckets of equally wide slots, so the values stay
+exact. lttb selects the buckets which preserve the shape of a time series
+best (Largest-Triangle-Three-Buckets by Sveinn Steinarsson).
+"""
+
+import hyperloglog
+
+def rebucket(results, fields, sums, origin, width, distinct=[]):
+	"""Sum up the results of the buckets in each slot.
+	Yields the slots sorted by time, each one as soon as all of its buckets
+	have been read. The bucket of a slot is the time the slot starts.
+
+	:Parameters:
+	 - `results`: An iterator over the results sorted by bucket.
+	 - `fields`: The aggregation values the results are grouped by.
+	 - `sums`: The values which are summed up.
+	 - `origin`: The time the first slot starts.
+	 - `width`: The width of a slot in seconds.
+	 - `distinct`: The HyperLogLog registers which are merged.
+	"""
+	current_slot = None
+	aggr_slots = {}
+	for doc in results:
+		slot = doc["bucket"] - (doc["bucket"] - origin) % width
+		if slot != current_slot:
+			for key in aggr_slots:
+				yield aggr_slots[key]
+			aggr_slots = {}
+			current_slot = slot
+
+		key = tuple([doc.get(a, None) for a in fields])
+		if key not in aggr_slots:
+			aggr = { "bucket": slot }
+			for a in fields:
+				aggr[a] = doc.get(a, None)
+			for s in sums:
+				aggr[s] = 0
+			if len(distinct) > 0:
+				aggr["distinct"] = dict([(d, {}) for d in distinct])
+			aggr_slots[key] = aggr
+		else:
+			aggr = aggr_slots[key]
+
+		for s in sums:
+			aggr[s] += doc.get(s, 0)
+		for d in distinct:
+			hyperloglog.merge(aggr["distinct"][d], doc.get("distinct", {}).get(d, {}))
+
+	for key in aggr_slots:
+		yield aggr_slots[key]
+
+def lttb(results, threshold, value):
+	"""Select `threshold` buckets with Largest-Triangle-Three-Buckets.
+	The first and the last bucket are always selected. The buckets in between
+	are split into equally sized bins and the one which spans the largest
+	triangle with the previously selected bucket and the average of the next
+	bin is selected from each bin. All results of the selected buckets are
+	yielded unchanged.
+
+	:Parameters:
+	 - `results`: An iterator over the results sorted by bucket.
+	 - `threshold`: The number of buckets to select.
+	 - `value`: The value which is compared, summed up over all results of a bucket.
+	"""
+	# [bucket, total value, results]
+	buckets = []
+	for doc in results:
+		if len(buckets) == 0 or buckets[-1][0] != doc["bucket"]:
+			buckets.append([doc["bucket"], 0, []])
+		buckets[-1][1] += doc.get(value, 0)
+		buckets[-1][2].append(doc)
+
+	num_buckets = len(buckets)
+	if threshold >= num_buckets:
+		selected = buckets
+	elif threshold < 3:
+		selected = [buckets[0], buckets[-1]][:threshold]
+	else:
+		selected = [buckets[0]]
+		every = float(num_buckets - 2) / (threshold - 2)
+		a = 0
+		for i in range(threshold - 2):
+			# the average of the next bin (the last bucket for the last bin)
+			avg_start = int((i + 1) * every) + 1
+			avg_end = min(int((i + 2) * every) + 1, num_buckets)
+			avg_x = 0.0
+			avg_y = 0.0
+			for j in range(avg_start, avg_end):
+				avg_x += buckets[j][0]
+				avg_y += buckets[j][1]
+			avg_x /= avg_end - avg_start
+			avg_y /= avg_end - avg_start
+
+			# the bucket of this bin which spans the largest triangle
+			a_x = buckets[a][0]
+			a_y = buckets[a][1]
+			max_area = -1
+			next_a = None
+			for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+				area = abs((a_x - avg_x) * (buckets[j][1] - a_y) - (a_x - buckets[j][0]) * (avg_y - a_y))
+				if area > max_area:
+					max_area = area
+					next_a = j
+			selected.append(buckets[next_a])
+			a = next_a
+		selected.append(buckets[-1])
+
+	for bucket, total, docs in selected:
+		for doc in docs:
+			yield doc
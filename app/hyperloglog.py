@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+"""
+Estimation of distinct counts from the HyperLogLog registers of the
+aggregated flow documents (Flajolet et al., with the linear counting
+correction for small cardinalities).
+
+The registers are stored as a subdocument { register: rank } which only
+contains the registers that are set. Registers of several buckets are
+merged with the maximum, so the count of any number of buckets costs the
+same memory as the count of a single one.
+"""
+
+import math
+
+def merge(target, registers):
+	"""Merge registers into `target`, keeping the larger rank of each register.
+	"""
+	for register, rank in registers.iteritems():
+		if target.get(register, 0) < rank:
+			target[register] = rank
+
+def estimate(registers, precision):
+	"""Estimate the number of distinct values counted by the registers.
+
+	:Parameters:
+	 - `registers`: A dictionary of the registers which are set and their ranks.
+	 - `precision`: The number of registers as a power of 2.
+	"""
+	m = 1 << precision
+	alpha = { 16: 0.673, 32: 0.697, 64: 0.709 }.get(m, 0.7213 / (1 + 1.079 / m))
+	zeros = m - len(registers)
+	e = alpha * m * m / (zeros + sum([2.0 ** -rank for rank in registers.itervalues()]))
+	if e <= 2.5 * m and zeros > 0:
+		e = m * math.log(float(m) / zeros)
+	return e
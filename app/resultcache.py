@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+"""
+LRU cache for the results of bucket queries.
+
+Buckets which end before the horizon of the preprocessors for their bucket
+size do not change anymore (unless the preprocessors report that they have
+written them late), so their results can be kept in memory. Every cache entry covers
+a continuous range of buckets of one query. A query only fetches the
+buckets outside of this range from MongoDB, which usually is the still
+open tail, and the final part of them is added to the entry.
+"""
+
+import sys
+import time
+import bisect
+import threading
+from collections import OrderedDict
+
+def estimate_size(doc):
+	"""Estimate the memory used by a result document in bytes.
+	"""
+	size = sys.getsizeof(doc)
+	for value in doc.itervalues():
+		if isinstance(value, dict):
+			size += estimate_size(value)
+		else:
+			size += sys.getsizeof(value)
+	return size
+
+class Collector:
+	def __init__(self, max_bytes):
+		"""Collects the results which are added to the cache.
+		Gives up if they do not fit into the cache at all.
+		"""
+		self.max_bytes = max_bytes
+		self.results = []
+		self.bytes = 0
+
+	def add(self, doc):
+		if self.results == None:
+			return
+		self.bytes += estimate_size(doc)
+		if self.bytes > self.max_bytes:
+			self.results = None
+			return
+		self.results.append(doc)
+
+class ResultCache:
+	def __init__(self, max_bytes, read_horizon, horizon_interval=10):
+		"""
+		:Parameters:
+		 - `max_bytes`: The maximum memory used by the cached results.
+		 - `read_horizon`: A function returning the horizon of each bucket size and the earliest late
+		   bucket of each size since its last call (None if they are not known), or None if no horizon is known.
+		 - `horizon_interval`: The number of seconds after which the horizon is read again.
+		"""
+		self.max_bytes = max_bytes
+		self.read_horizon = read_horizon
+		self.horizon_interval = horizon_interval
+		# bucket size -> horizon
+		self.horizons = None
+		self.horizon_read = None
+		# the threads of the server share the cache, the lock is
+		# never held while results are passed to the caller
+		self.lock = threading.Lock()
+
+		# key -> entry, ordered from least to most recently used
+		self.entries = OrderedDict()
+		self.bytes = 0
+
+		# stats
+		self.hits = 0
+		self.partial_hits = 0
+		self.misses = 0
+		self.cached_buckets = 0
+		self.fetched_buckets = 0
+		self.evictions = 0
+		self.invalidations = 0
+
+	def updateHorizon(self):
+		"""Read the horizons again if the horizon interval has passed.
+		All buckets which are not final anymore are removed, i.e. the buckets
+		after the horizon if it moves back (e.g. the database has been rebuilt)
+		and the buckets from the earliest bucket written late.
+		"""
+		if self.horizon_read != None and time.time() - self.horizon_read < self.horizon_interval:
+			return
+		self.horizon_read = time.time()
+
+		result = self.read_horizon()
+		if result == None:
+			if len(self.entries) > 0:
+				self.invalidations += 1
+			self.clear()
+			self.horizons = None
+			return
+
+		horizons, late = result
+		if late == None:
+			if len(self.entries) > 0:
+				self.invalidations += 1
+			self.clear()
+		elif self.horizons != None:
+			limits = dict()
+			for s, horizon in self.horizons.iteritems():
+				if horizons.get(s, None) < horizon:
+					limits[s] = horizons.get(s, None)
+			for s, bucket in late.iteritems():
+				if not s in limits or limits[s] > bucket:
+					limits[s] = bucket
+			if len(limits) > 0 and len(self.entries) > 0:
+				self.invalidations += 1
+			for key in self.entries.keys():
+				entry = self.entries[key]
+				if entry["size"] in limits:
+					# None if the bucket size has no horizon anymore
+					limit = limits[entry["size"]]
+					if limit == None:
+						limit = entry["first"]
+					self.trimEntry(key, entry, limit - entry["size"])
+		self.horizons = horizons
+
+	def clear(self):
+		self.entries = OrderedDict()
+		self.bytes = 0
+
+	def trimEntry(self, key, entry, last):
+		"""Remove the buckets after `last` from an entry.
+		"""
+		if entry["last"] <= last:
+			return
+		if last < entry["first"]:
+			self.bytes -= entry["bytes"]
+			del self.entries[key]
+			return
+
+		i = bisect.bisect_right(entry["times"], last)
+		removed = sum([estimate_size(doc) for doc in entry["results"][i:]])
+		del entry["results"][i:]
+		del entry["times"][i:]
+		entry["last"] = last
+		entry["bytes"] -= removed
+		self.bytes -= removed
+
+	def query(self, key, bucket_size, start, end, fetch):
+		"""Iterate over the results of the buckets between `start` and `end` sorted by bucket.
+		The results are passed through while they are fetched. The cache is
+		only updated once all results have been consumed.
+
+		:Parameters:
+		 - `key`: The normalized query parameters without the time range.
+		 - `bucket_size`: The bucket size of the queried collection.
+		 - `start`: The first bucket of the query.
+		 - `end`: The last bucket of the query.
+		 - `fetch`: A function returning an iterator over the results between two buckets from MongoDB.
+		"""
+		self.lock.acquire()
+		try:
+			self.updateHorizon()
+
+			# the last bucket which will not change anymore
+			final = None
+			if self.horizons != None and bucket_size in self.horizons:
+				final = min(end, self.horizons[bucket_size] - bucket_size)
+
+			entry = self.entries.get(key, None)
+			if entry == None or entry["first"] > end or entry["last"] < start:
+				self.misses += 1
+				entry = None
+			else:
+				# mark as most recently used
+				del self.entries[key]
+				self.entries[key] = entry
+				first = entry["first"]
+				last = entry["last"]
+				times = entry["times"]
+				cached = entry["results"][bisect.bisect_left(times, start):bisect.bisect_right(times, end)]
+				if start >= first and end <= last:
+					self.hits += 1
+				else:
+					self.partial_hits += 1
+		finally:
+			self.lock.release()
+
+		if entry == None:
+			if final == None or final < start:
+				for doc in fetch(start, end):
+					self.fetched_buckets += 1
+					yield doc
+				return
+
+			collected = Collector(self.max_bytes)
+			for doc in fetch(start, end):
+				self.fetched_buckets += 1
+				if doc["bucket"] <= final:
+					collected.add(doc)
+				yield doc
+
+			if collected.results != None:
+				self.lock.acquire()
+				try:
+					# replaces an entry of another time range
+					if self.entries.get(key, None) != None:
+						self.bytes -= self.entries.pop(key)["bytes"]
+					self.store(key, bucket_size, start, final, collected)
+				finally:
+					self.lock.release()
+			return
+
+		# the fetched buckets before the entry are final, after it only up to the horizon
+		head = None
+		if start < first:
+			head = Collector(self.max_bytes)
+			for doc in fetch(start, first - 1):
+				self.fetched_buckets += 1
+				head.add(doc)
+				yield doc
+
+		for doc in cached:
+			self.cached_buckets += 1
+			yield doc
+
+		tail = None
+		if end > last:
+			tail = Collector(self.max_bytes)
+			for doc in fetch(last + 1, end):
+				self.fetched_buckets += 1
+				if final != None and doc["bucket"] <= final:
+					tail.add(doc)
+				yield doc
+
+		self.lock.acquire()
+		try:
+			# the entry may have changed while the results were consumed
+			if self.entries.get(key, None) is not entry or entry["first"] != first or entry["last"] != last:
+				return
+			if head != None and head.results != None:
+				self.extend(entry, start, first - 1, head, True)
+			if tail != None and tail.results != None and final > last:
+				self.extend(entry, last + 1, final, tail, False)
+			self.evict()
+		finally:
+			self.lock.release()
+
+	def store(self, key, bucket_size, first, last, collected):
+		entry = {
+			"size": bucket_size,
+			"first": first,
+			"last": last,
+			"results": [],
+			"times": [],
+			"bytes": 0
+		}
+		self.entries[key] = entry
+		self.extend(entry, first, last, collected, False)
+		self.evict()
+
+	def extend(self, entry, first, last, collected, prepend):
+		"""Add the collected results of the buckets between `first` and `last` to an entry.
+		"""
+		results = collected.results
+		size = collected.bytes
+		times = [doc["bucket"] for doc in results]
+		if prepend:
+			entry["results"][0:0] = results
+			entry["times"][0:0] = times
+			entry["first"] = first
+		else:
+			entry["results"].extend(results)
+			entry["times"].extend(times)
+			entry["last"] = last
+		entry["bytes"] += size
+		self.bytes += size
+
+	def evict(self):
+		"""Remove the least recently used entries until the cache fits into its memory limit.
+		"""
+		while self.bytes > self.max_bytes and len(self.entries) > 0:
+			key, entry = self.entries.popitem(False)
+			self.bytes -= entry["bytes"]
+			self.evictions += 1
+
+	def getStats(self):
+		"""Returns the size of the cache and its hit and miss counters.
+		The counters are not synchronized, so they can be slightly off with the threaded server.
+		"""
+		queries = self.hits + self.partial_hits + self.misses
+		return {
+			"entries": len(self.entries),
+			"bytes": self.bytes,
+			"max_bytes": self.max_bytes,
+			"horizons": self.horizons,
+			"hits": self.hits,
+			"partial_hits": self.partial_hits,
+			"misses": self.misses,
+			"hit_ratio": float(self.hits + self.partial_hits) / max(queries, 1),
+			"cached_buckets": self.cached_buckets,
+			"fetched_buckets": self.fetched_buckets,
+			"evictions": self.evictions,
+			"invalidations": self.invalidations
+		}
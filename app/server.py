@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+"""
+Production servers for the app which only need the standard library.
+
+ThreadedServer handles each request in its own thread. PreforkServer
+forks worker processes which share the listening socket and handle one
+request at a time. The master process replaces workers which die or are
+busy with a request for too long. Send SIGHUP to the master for a
+graceful restart: the workers finish their current request while the
+master executes itself again and forks new workers on the same socket,
+so no connection gets lost.
+"""
+
+import os
+import sys
+import time
+import errno
+import signal
+import socket
+import select
+import threading
+import traceback
+from multiprocessing.sharedctypes import RawArray
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+from bottle import ServerAdapter
+
+# the environment variables which hand over the listening socket
+# and the old workers to the master after a graceful restart
+ENV_SOCKET_FD = "FLOW_INSPECTOR_SOCKET_FD"
+ENV_OLD_WORKERS = "FLOW_INSPECTOR_OLD_WORKERS"
+
+# Workers are killed ... seconds after the request timeout,
+# so MongoDB has the chance to abort the query first
+KILL_GRACE = 5
+
+def compile_routes(handler):
+	"""Bottle compiles its routes on the first request, which is not thread-safe.
+	"""
+	if hasattr(handler, "router"):
+		handler.router._compile()
+
+class QuietHandler(WSGIRequestHandler):
+	def log_request(*args, **kw):
+		pass
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+	daemon_threads = True
+
+	def process_request(self, request, client_address):
+		# do not accept more requests than there are threads
+		self.slots.acquire()
+		ThreadingMixIn.process_request(self, request, client_address)
+
+	def process_request_thread(self, request, client_address):
+		try:
+			ThreadingMixIn.process_request_thread(self, request, client_address)
+		finally:
+			self.slots.release()
+
+class PreforkWSGIServer(WSGIServer):
+	def get_request(self):
+		# the listening socket is non-blocking, so a worker does not hang in
+		# accept() when another one took the connection
+		conn, addr = self.socket.accept()
+		conn.setblocking(True)
+		return conn, addr
+
+class ThreadedServer(ServerAdapter):
+	"""Handles each request in its own thread.
+
+	Options:
+	 - `threads`: The maximum number of requests handled at once.
+	"""
+	def run(self, handler):
+		compile_routes(handler)
+		handler_class = WSGIRequestHandler
+		if self.quiet:
+			handler_class = QuietHandler
+		server = make_server(self.host, self.port, handler, ThreadingWSGIServer, handler_class)
+		server.slots = threading.BoundedSemaphore(self.options.get("threads", 16))
+		server.serve_forever()
+
+class PreforkServer(ServerAdapter):
+	"""Forks worker processes which handle one request at a time.
+
+	Options:
+	 - `workers`: The number of worker processes.
+	 - `timeout`: The number of seconds a request may take before its worker is killed (0 disables it).
+	 - `init`: A function called in each worker after the fork, e.g. to connect to the database.
+	"""
+	def run(self, handler):
+		# compile the routes once for all workers
+		compile_routes(handler)
+		self.handler = handler
+		self.num_workers = self.options.get("workers", 4)
+		self.timeout = self.options.get("timeout", 0)
+		self.init = self.options.get("init", None)
+
+		self.server = self.createServer()
+		# the start time of the current request of each worker (0 if idle)
+		self.busy = RawArray("d", self.num_workers)
+		self.workers = [None] * self.num_workers
+		self.running = True
+		self.restart = False
+
+		# the workers of the master before a graceful restart, which are
+		# killed if they do not finish their current request in time
+		# (without a request timeout they have no deadline either)
+		self.old_workers = dict()
+		deadline = None
+		if self.timeout > 0:
+			deadline = time.time() + self.timeout + KILL_GRACE
+		for pid in os.environ.pop(ENV_OLD_WORKERS, "").split(","):
+			if pid != "":
+				self.old_workers[int(pid)] = deadline
+
+		signal.signal(signal.SIGTERM, self.handleStop)
+		signal.signal(signal.SIGINT, self.handleStop)
+		signal.signal(signal.SIGHUP, self.handleRestart)
+
+		print "Started master process %i with %i workers." % (os.getpid(), self.num_workers)
+		while self.running:
+			for i in range(self.num_workers):
+				if self.workers[i] == None:
+					self.workers[i] = self.spawn(i)
+			time.sleep(1)
+			self.reap()
+			self.killTimeouts()
+
+		pids = [pid for pid in self.workers if pid != None]
+		for pid in pids:
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except OSError:
+				pass
+
+		if self.restart:
+			print "Restarting master process %i..." % (os.getpid())
+			os.environ[ENV_SOCKET_FD] = str(self.server.socket.fileno())
+			os.environ[ENV_OLD_WORKERS] = ",".join([str(pid) for pid in pids + self.old_workers.keys()])
+			os.execv(sys.executable, [sys.executable] + sys.argv)
+
+		for pid in pids:
+			try:
+				os.waitpid(pid, 0)
+			except OSError:
+				pass
+
+	def createServer(self):
+		handler_class = WSGIRequestHandler
+		if self.quiet:
+			handler_class = QuietHandler
+
+		fd = os.environ.pop(ENV_SOCKET_FD, None)
+		if fd == None:
+			server = PreforkWSGIServer((self.host, self.port), handler_class)
+		else:
+			# take over the socket of the master before the restart
+			server = PreforkWSGIServer((self.host, self.port), handler_class, False)
+			server.socket = socket.fromfd(int(fd), socket.AF_INET, socket.SOCK_STREAM)
+			os.close(int(fd))
+			host, port = server.socket.getsockname()[:2]
+			server.server_name = socket.getfqdn(host)
+			server.server_port = port
+			server.setup_environ()
+		server.set_app(self.handler)
+		server.socket.setblocking(False)
+		# wake up regularly to check if the worker has to stop
+		server.timeout = 1
+		return server
+
+	def spawn(self, slot):
+		pid = os.fork()
+		if pid != 0:
+			return pid
+
+		# worker process
+		try:
+			self.runWorker(slot)
+		except:
+			traceback.print_exc()
+			os._exit(1)
+		os._exit(0)
+
+	def runWorker(self, slot):
+		busy = self.busy
+		running = [True]
+		def stop(signum, frame):
+			running[0] = False
+		signal.signal(signal.SIGTERM, stop)
+		# the current request must not be interrupted, e.g. while reading from MongoDB
+		signal.siginterrupt(signal.SIGTERM, False)
+		signal.signal(signal.SIGHUP, signal.SIG_DFL)
+		# Ctrl-C is handled by the master
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+		base_class = self.server.RequestHandlerClass
+		class TimedHandler(base_class):
+			def handle(self):
+				busy[slot] = time.time()
+				try:
+					base_class.handle(self)
+				finally:
+					busy[slot] = 0
+		self.server.RequestHandlerClass = TimedHandler
+
+		if self.init != None:
+			self.init()
+
+		while running[0]:
+			try:
+				self.server.handle_request()
+			except (select.error, socket.error), e:
+				if e.args[0] != errno.EINTR:
+					raise
+
+	def reap(self):
+		"""Collect the exit status of terminated workers.
+		"""
+		while True:
+			try:
+				pid, status = os.waitpid(-1, os.WNOHANG)
+			except OSError:
+				return
+			if pid == 0:
+				return
+
+			self.old_workers.pop(pid, None)
+			if pid in self.workers:
+				slot = self.workers.index(pid)
+				self.workers[slot] = None
+				self.busy[slot] = 0
+				if self.running:
+					print >> sys.stderr, "Worker %i died (status %i), starting a new one." % (pid, status)
+
+	def killTimeouts(self):
+		"""Kill the workers which are busy with a request for too long.
+		"""
+		if self.timeout <= 0:
+			return
+
+		now = time.time()
+		for slot, pid in enumerate(self.workers):
+			started = self.busy[slot]
+			if pid != None and started > 0 and now - started > self.timeout + KILL_GRACE:
+				print >> sys.stderr, "Worker %i has been busy for %i seconds, killing it." % (pid, now - started)
+				self.kill(pid)
+		for pid, deadline in self.old_workers.items():
+			if deadline != None and now > deadline:
+				print >> sys.stderr, "Old worker %i did not finish in time, killing it." % (pid)
+				self.kill(pid)
+				del self.old_workers[pid]
+
+	def kill(self, pid):
+		try:
+			os.kill(pid, signal.SIGKILL)
+		except OSError:
+			pass
+
+	def handleStop(self, signum, frame):
+		self.running = False
+
+	def handleRestart(self, signum, frame):
+		self.running = False
+		self.restart = True
@@ -181,13 +181,38 @@ var Flows = CachedCollection.extend({
     cache_timeout: 60*10,
     model: Flow,
     url: "/api/bucket/query",
+    sync: function(method, model, options) {
+    	// request one array per column which repeats no field names
+    	// and shares the IP addresses in a dictionary
+    	options.data = _.extend({ format: "columnar", dictionary: 1 }, options.data);
+    	return CachedCollection.prototype.sync.call(this, method, model, options);
+    },
     parse: function(response) {
     	this.bucket_size = response.bucket_size;
-    	response.results.forEach(function(d) {
+    	
+    	var columns = response.results;
+    	var dictionary = response.dictionary || [];
+    	var names = _.keys(columns);
+    	var encoded = _.filter(names, function(name) {
+    		return name === "srcIP" || name === "dstIP";
+    	});
+    	
+    	var results = new Array(columns.bucket.length);
+    	for(var i = 0; i < results.length; i++) {
+    		var d = {};
+    		for(var j = 0; j < names.length; j++) {
+    			d[names[j]] = columns[names[j]][i];
+    		}
+    		for(var j = 0; j < encoded.length; j++) {
+    			if(d[encoded[j]] !== null) {
+    				d[encoded[j]] = dictionary[d[encoded[j]]];
+    			}
+    		}
     		// convert unix timestamp to JS Date
     		d.bucket = new Date(d.bucket * 1000);
-    	});
-    	return response.results;
+    		results[i] = d;
+    	}
+    	return results;
     }
 });
 
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+"""
+Merging of the top-k summaries written by the preprocessor.
+
+Every summary counts the heaviest values of one bucket and overestimates
+each of them by at most its error. A value which is not counted by a
+summary weighs at most the floor of that summary. Summing up both over all
+summaries of a time range gives an upper and a lower bound of the weight
+of every value (Agarwal et al., Mergeable Summaries).
+"""
+
+import heapq
+
+def merge(sketches, limit):
+	"""Merge summaries into the `limit` values with the largest upper bounds.
+	Returns the results as (value, upper bound, lower bound) tuples heaviest
+	first, the largest weight a value which is not in the results may have
+	and the total weight of all values.
+
+	:Parameters:
+	 - `sketches`: An iterator over the summary documents.
+	 - `limit`: The number of results.
+	"""
+	floors = 0
+	total = 0
+	# the upper bounds without the floors of all summaries,
+	# the floors of the summaries which count a value are replaced by its count
+	upper = dict()
+	lower = dict()
+	for sketch in sketches:
+		floor = sketch["floor"]
+		floors += floor
+		total += sketch["total"]
+		for value, count, error in sketch["items"]:
+			# pairs of values are stored as arrays
+			if isinstance(value, list):
+				value = tuple(value)
+			upper[value] = upper.get(value, 0) + count - floor
+			lower[value] = lower.get(value, 0) + count - error
+
+	top = heapq.nlargest(limit + 1, upper.iteritems(), key=lambda item: item[1])
+	results = [(value, bound + floors, lower[value]) for value, bound in top[:limit]]
+
+	bound = floors
+	if len(top) > limit:
+		bound = top[limit][1] + floors
+	return results, bound, total
@@ -6,12 +6,53 @@
 host = "0.0.0.0"
 port = 8080
 debug = True
+# "wsgiref" is the single-threaded development server (the only one with
+# the reloader), "threaded" handles every request in its own thread and
+# "prefork" forks worker processes (send SIGHUP for a graceful restart)
+server = "wsgiref"
+# number of worker processes of the prefork server
+server_workers = 4
+# maximum number of requests handled at once by the threaded server
+# (also the size of the MongoDB connection pool of each process)
+server_threads = 16
+# queries are aborted by MongoDB after ... seconds (requires MongoDB >= 2.6
+# and pymongo >= 2.7), prefork workers still busy shortly after that are
+# killed and replaced (0 disables the timeout)
+server_timeout = 60
 
 # MongoDB
 #----------------------------------------------------------------
 db_host = "127.0.0.1"
 db_port = 27017
 db_name = "flows"
+# group bucket queries with the aggregation pipeline of MongoDB
+# (requires MongoDB >= 2.2 and pymongo >= 2.3, falls back to Python otherwise)
+db_aggregation_pipeline = True
+# number of seconds the app keeps the bucket catalogue and the list of
+# partitions in memory
+db_catalogue_ttl = 10
+
+# Result cache
+#----------------------------------------------------------------
+# the app keeps the results of buckets which do not change anymore
+# maximum memory in bytes used by cached results per process (0 disables the cache)
+app_cache_size = 64*1024*1024
+# number of seconds after which the horizon of the preprocessors is read again
+app_cache_horizon_interval = 10
+# preprocessors which have not published their horizon for ... seconds
+# while others did are considered stopped and ignored
+app_cache_horizon_timeout = 5*60
+
+# Responses
+#----------------------------------------------------------------
+# bucket and index results are serialized and sent in chunks of this
+# many documents while they are read (0 sends the whole response at once)
+app_stream_chunk_size = 1000
+# downsampled bucket queries (downsample=sum or lttb) read the smallest
+# bucket size with at most ... buckets per slot. downsample=sum returns at
+# most the requested resolution of slots, each one a whole number of buckets
+# (more buckets per slot bring the number of slots closer to the resolution)
+app_downsample_factor = 10
 
 # Flow settings
 #----------------------------------------------------------------
@@ -27,11 +68,93 @@ flow_aggr_sums = ["pkts", "bytes"]
 # Only consider known port numbers, set the others to null
 # before aggregation.
 flow_filter_unknown_ports = True
+# The flows are additionally aggregated by these subsets of the values above
+# (the data cube), each one leads to a collection per bucket size.
+# Bucket queries read the smallest one which contains the requested fields.
+# Run preprocess/rebuild_cubes.py after changing this list.
+flow_cubes = [["srcIP"], ["dstIP"], ["dstPort"], ["srcIP", "dstIP"]]
+# IPv4 addresses are stored as integers and IPv6 addresses as strings.
+# The flows between networks and the node index of networks are kept for
+# these prefix lengths (IPv4 length: IPv6 length of the same collection),
+# bucket and node index queries read them with prefix=<IPv4 length>.
+# Run preprocess/rebuild_cubes.py after changing the prefix lengths.
+flow_prefix_lengths = { 16: 48, 24: 64 }
+# The aggregated collections count the distinct values (or combinations)
+# of these columns per bucket with HyperLogLog, e.g. distinct sources or
+# distinct (source, destination port) pairs for finding scans.
+# The registers are updated with $max, which requires MongoDB >= 2.6
+# (set to [] to disable, e.g. for older servers).
+flow_aggr_distinct = [["srcIP"], ["dstIP"], ["srcIP", "dstPort"]]
+# number of HyperLogLog registers as a power of 2 (10 means 1024 registers
+# and a standard error of about 3%, each register adds a few bytes per
+# document). Changing it requires rebuilding the database.
+flow_distinct_precision = 10
+# The collections of a bucket size are split into one collection per
+# ... seconds (0 keeps a single collection), so queries only touch the
+# partitions of their time range and old data is dropped at once.
+# Each partition size has to be a multiple of its bucket size.
+# Run preprocess/partition_collections.py after changing these sizes.
+flow_partition_sizes = { 60: 24*60*60, 10*60: 30*24*60*60, 60*60: 30*24*60*60, 24*60*60: 0 }
+# Partitions which ended more than ... seconds before the newest flow are
+# dropped by the preprocessor (0 keeps everything, requires partitions)
+flow_retention = { 60: 30*24*60*60, 10*60: 365*24*60*60, 60*60: 0, 24*60*60: 0 }
+
+# Top-K
+#----------------------------------------------------------------
+# The preprocessor summarizes the heaviest values of these aggregation
+# values per bucket (sources, destinations, ports and pairs), the app
+# merges the summaries of a time range for /api/topk (set to [] to disable)
+topk_fields = [["srcIP"], ["dstIP"], ["srcPort"], ["dstPort"], ["srcIP", "dstIP"]]
+# the summed up values the heavy hitters are ranked by
+topk_values = ["flows", "bytes"]
+# number of values counted per summary, the more the smaller the error
+# (also the maximum number of results of /api/topk)
+topk_size = 100
 
 # Preprocessor settings
 #----------------------------------------------------------------
 # caching can reduce the amount of writes to Mongo
-# cache size per bucket size
-pre_cache_size = 10000
-# cache size for aggregated collections per bucket size
-pre_cache_size_aggr = 5
\ No newline at end of file
+# buckets are kept in the cache until the latest seen lastSwitched
+# minus the allowed lateness passes their end
+# maximum cache size per bucket size (older buckets are written early if reached)
+pre_cache_size = 100000
+# maximum cache size for aggregated collections per bucket size
+pre_cache_size_aggr = 1000
+# allowed lateness of flows in seconds
+pre_cache_lateness = 5*60
+# the node and port index counters are kept in memory and written
+# if the cache size is reached or after the cache interval in seconds
+# (set the size to 0 to update the index for every flow)
+pre_index_cache_size = 100000
+pre_index_cache_interval = 10
+# bulk writes can reduce the amount of round-trips to Mongo
+# (requires pymongo >= 2.7 and MongoDB >= 2.6, set to 0 to disable)
+# maximum number of documents in one unordered bulk write
+pre_bulk_size = 1000
+# maximum time in seconds a document waits before its bulk batch is sent
+pre_bulk_linger = 5
+
+# number of queue entries to dequeue at once (requires Redis >= 2.6,
+# set to 0 to dequeue single entries)
+pre_queue_batch_size = 1000
+# every ... seconds the closed buckets are written and the dequeued entries
+# whose buckets have all been written are acknowledged. With pre_rollup the
+# open buckets of the coarser bucket sizes are stored in the rollup_state
+# collection at the same time, so entries stay in the processing list until
+# the smallest bucket size plus the lateness has passed (the largest one
+# without pre_rollup). Unacknowledged entries are processed again on restart
+# without the buckets written before, only the writes since the last
+# acknowledgement (early flushes and closed buckets) may be counted twice
+# after a crash.
+pre_queue_ack_interval = 60
+
+# only slice flows into the smallest bucket size and roll up the coarser
+# bucket sizes from it (each bucket size has to be a multiple of the previous)
+pre_rollup = True
+
+# backfill mode (preprocess.py --from-file / --from-sql)
+# maximum number of documents per collection kept in memory before
+# they are spilled to a sorted file on disk
+pre_backfill_max_docs = 2000000
+# directory of the spill files (None uses the system temp directory)
+pre_backfill_spill_dir = None
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+"""
+Offline aggregation of complete collections for rebuilding a database.
+
+The flow and index handlers write their upserts into BackfillCollections
+instead of MongoDB. A BackfillCollection sums up all updates of a key in
+memory. If it holds too many documents, they are written to a spill file
+sorted by key. When all flows are read, the spill files are merged and the
+finished documents are inserted with plain bulk inserts, which is a lot
+cheaper than $inc upserts against an ever growing index.
+"""
+
+import os
+import heapq
+import tempfile
+import cPickle as pickle
+
+def merge_update(target, doc):
+	"""Add the $inc values of an update document to another one
+	and keep the larger of the $max values.
+	"""
+	for s, v in doc["$inc"].iteritems():
+		target["$inc"][s] = target["$inc"].get(s, 0) + v
+	for s, v in doc.get("$max", {}).iteritems():
+		maxes = target.setdefault("$max", {})
+		if maxes.get(s, 0) < v:
+			maxes[s] = v
+	if "$set" in doc and "$set" not in target:
+		target["$set"] = dict(doc["$set"])
+
+def to_document(key, doc):
+	"""Convert an update document into the document it would create.
+	Dotted field names of the $inc and $max values become subdocuments.
+	"""
+	result = { "_id": key }
+	result.update(doc.get("$set", {}))
+	for s, v in doc["$inc"].items() + doc.get("$max", {}).items():
+		parts = s.split(".")
+		target = result
+		for part in parts[:-1]:
+			target = target.setdefault(part, {})
+		target[parts[-1]] = v
+	return result
+
+def read_spill_file(filename):
+	f = open(filename, "rb")
+	try:
+		while True:
+			yield pickle.load(f)
+	except EOFError:
+		pass
+	f.close()
+
+class BackfillCollection:
+	def __init__(self, collection, max_docs, spill_dir=None, insert_size=1000):
+		"""
+		:Parameters:
+		 - `collection`: The pymongo collection the documents are inserted into.
+		 - `max_docs`: The maximum number of documents kept in memory.
+		 - `spill_dir`: The directory of the spill files (None uses the system default).
+		 - `insert_size`: The number of documents inserted at once.
+		"""
+		self.collection = collection
+		self.name = collection.name
+		self.max_docs = max_docs
+		self.spill_dir = spill_dir
+		self.insert_size = insert_size
+
+		self.docs = dict()
+		self.spill_files = []
+		self.indexes = []
+
+		# stats
+		self.num_updates = 0
+		self.num_inserts = 0
+
+	def update(self, spec, doc, upsert=True):
+		"""Sum up an upsert of the flow or index handlers.
+		"""
+		self.num_updates += 1
+		key = spec["_id"]
+		pending = self.docs.get(key, None)
+		if pending == None:
+			self.docs[key] = doc
+		else:
+			merge_update(pending, doc)
+
+		if len(self.docs) >= self.max_docs:
+			self.spill()
+
+	def create_index(self, *args, **kwargs):
+		"""Indexes are created after all documents are inserted.
+		"""
+		self.indexes.append((args, kwargs))
+
+	def spill(self):
+		"""Write the documents sorted by key to a spill file.
+		"""
+		fd, filename = tempfile.mkstemp(prefix="backfill_" + self.name + "_", suffix=".spill", dir=self.spill_dir)
+		f = os.fdopen(fd, "wb")
+		for key in sorted(self.docs.iterkeys()):
+			pickle.dump((key, self.docs[key]), f, pickle.HIGHEST_PROTOCOL)
+		f.close()
+		self.spill_files.append(filename)
+		self.docs = dict()
+
+	def iterDocuments(self):
+		"""Iterate over the finished documents.
+		Spill files are merged, so every key is returned once.
+		"""
+		if len(self.spill_files) == 0:
+			for key, doc in self.docs.iteritems():
+				yield key, doc
+			return
+
+		if len(self.docs) > 0:
+			self.spill()
+
+		current_key = None
+		current = None
+		for key, doc in heapq.merge(*[read_spill_file(f) for f in self.spill_files]):
+			if current != None and key == current_key:
+				merge_update(current, doc)
+				continue
+			if current != None:
+				yield current_key, current
+			current_key = key
+			current = doc
+		if current != None:
+			yield current_key, current
+
+	def finish(self):
+		"""Insert all documents, build the indexes and remove the spill files.
+		"""
+		batch = []
+		for key, doc in self.iterDocuments():
+			batch.append(to_document(key, doc))
+			if len(batch) >= self.insert_size:
+				self.collection.insert(batch)
+				self.num_inserts += len(batch)
+				batch = []
+		if len(batch) > 0:
+			self.collection.insert(batch)
+			self.num_inserts += len(batch)
+
+		for args, kwargs in self.indexes:
+			self.collection.create_index(*args, **kwargs)
+
+		for filename in self.spill_files:
+			os.remove(filename)
+		self.docs = dict()
+
+	def printReport(self):
+		print "%s: %i updates aggregated into %i documents (%i spill files)" % (
+			self.name, self.num_updates, self.num_inserts, len(self.spill_files))
+
+class BackfillDatabase:
+	def __init__(self, db, max_docs, spill_dir=None, insert_size=1000):
+		"""Hands out a BackfillCollection for every collection of a database.
+
+		:Parameters:
+		 - `db`: A pymongo database.
+		 - `max_docs`: The maximum number of documents kept in memory per collection.
+		 - `spill_dir`: The directory of the spill files (None uses the system default).
+		 - `insert_size`: The number of documents inserted at once.
+		"""
+		self.db = db
+		self.max_docs = max_docs
+		self.spill_dir = spill_dir
+		self.insert_size = insert_size
+		self.collections = []
+		self.by_name = dict()
+
+	def __getitem__(self, name):
+		collection = self.by_name.get(name, None)
+		if collection == None:
+			collection = BackfillCollection(self.db[name], self.max_docs, self.spill_dir, self.insert_size)
+			self.collections.append(collection)
+			self.by_name[name] = collection
+		return collection
+
+	def finish(self):
+		for collection in self.collections:
+			collection.finish()
+
+	def printReport(self):
+		for collection in self.collections:
+			collection.printReport()
+		print ""
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compare the startup time and the lookup cost of the compiled known
+ports table with the former DOM based dictionary of port lists.
+"""
+
+import sys
+import os.path
+import shutil
+import tempfile
+import time
+import timeit
+import random
+import argparse
+import xml.dom.minidom
+
+import ports
+
+PORTS_FILE = os.path.join(os.path.dirname(__file__), '..', 'config', 'service-names-port-numbers.xml')
+
+parser = argparse.ArgumentParser(description="Benchmark the known ports table.")
+parser.add_argument("--lookups", nargs="?", default=1000000, type=int, help="Number of lookups to measure")
+args = parser.parse_args()
+
+def load_dict(filename):
+	"""The former DOM based parser.
+	"""
+	f = open(filename, "r")
+	dom = xml.dom.minidom.parse(f)
+	f.close()
+
+	def getDomText(node):
+		rc = []
+		for n in node.childNodes:
+			if n.nodeType == node.TEXT_NODE:
+				rc.append(n.data)
+		return ''.join(rc)
+
+	known_ports = dict()
+	records = dom.getElementsByTagName("record")
+	for record in records:
+		description = getDomText(record.getElementsByTagName("description")[0])
+		number = record.getElementsByTagName("number")
+		if description != "Unassigned" and len(number) > 0:
+			numbers = getDomText(number[0]).split('-')
+			number = int(numbers[0])
+			number_to = int(numbers[len(numbers)-1])
+
+			protocol = record.getElementsByTagName("protocol")
+			if len(protocol) > 0:
+				protocol = getDomText(protocol[0])
+				if protocol == "tcp":
+					protocol = 6
+				elif protocol == "udp":
+					protocol = 17
+				else:
+					protocol = 0
+			else:
+				protocol = 0
+
+			while number <= number_to:
+				if number in known_ports:
+					known_ports[number].append(protocol)
+				else:
+					known_ports[number] = [protocol]
+				number += 1
+	return known_ports
+
+def is_known_dict(known_ports, port, proto):
+	return port in known_ports and (proto == -1 or proto in known_ports[port])
+
+# compile a copy in a temporary directory to keep the cache of the config directory
+temp_dir = tempfile.mkdtemp()
+temp_file = os.path.join(temp_dir, os.path.basename(PORTS_FILE))
+shutil.copy2(PORTS_FILE, temp_file)
+
+start = time.time()
+known_dict = load_dict(PORTS_FILE)
+print "DOM parse:          %.3f s" % (time.time() - start)
+
+start = time.time()
+known_ports = ports.load_known_ports(temp_file)
+print "Compile (no cache): %.3f s" % (time.time() - start)
+
+start = time.time()
+known_ports = ports.load_known_ports(temp_file)
+print "Load cached bitmap: %.3f s" % (time.time() - start)
+
+shutil.rmtree(temp_dir)
+
+def is_known_bitmap(port, proto):
+	return known_ports[port] & ports.PROTO_MASKS[proto] != 0
+
+# both tables have to agree
+for port in range(ports.NUM_PORTS):
+	for proto in [-1, 0, 1, 6, 17]:
+		if is_known_dict(known_dict, port, proto) != is_known_bitmap(port, proto):
+			print >> sys.stderr, "Tables differ for port %i and protocol %i!" % (port, proto)
+			sys.exit(1)
+
+def measure(name, samples):
+	def lookup_dict():
+		for port, proto in samples:
+			port in known_dict and (proto == -1 or proto in known_dict[port])
+
+	masks = ports.PROTO_MASKS
+
+	def lookup_compiled():
+		for port, proto in samples:
+			known_ports[port] & masks[proto]
+
+	num = max(1, args.lookups / len(samples))
+	print "Dict lookup (%s):     %.3f us" % (name, timeit.timeit(lookup_dict, number=num) / (num * len(samples)) * 1e6)
+	print "Compiled lookup (%s): %.3f us" % (name, timeit.timeit(lookup_compiled, number=num) / (num * len(samples)) * 1e6)
+
+random.seed(0)
+protos = [-1, 6, 17]
+measure("random ports", [(random.randint(0, ports.NUM_PORTS - 1), random.choice(protos)) for i in range(1000)])
+registered = sorted(known_dict.keys())
+measure("registered ports", [(random.choice(registered), random.choice(protos)) for i in range(1000)])
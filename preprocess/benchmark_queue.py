@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compare the JSON and the binary encoding of flows on the Redis queue:
+size of the queue entries, Redis memory (with --redis) and the CPU time
+to decode a flow and read the values the flow handlers need.
+"""
+
+import sys
+import os.path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'config'))
+
+import time
+import json
+import random
+import argparse
+
+import config
+import flowrecords
+
+parser = argparse.ArgumentParser(description="Benchmark the encodings of flows on the Redis queue.")
+parser.add_argument("--flows", nargs="?", default=100000, type=int, help="Number of generated flows")
+parser.add_argument("--batch-records", nargs="?", default=100, type=int, help="Number of flows in one binary batch")
+parser.add_argument("--redis", nargs="?", type=bool, default=False, const=True, help="Measure the memory of the entries in Redis")
+parser.add_argument("--redis-host", nargs="?", default="127.0.0.1", help="Redis host")
+parser.add_argument("--redis-port", nargs="?", default=6379, type=int, help="Redis port")
+parser.add_argument("--redis-database", nargs="?", default=15, type=int, help="Redis database (will be flushed!)")
+args = parser.parse_args()
+
+BENCHMARK_KEY = "benchmark:queue"
+
+def generate_flows(num):
+	random.seed(0)
+	flows = []
+	start = 1330000000
+	for i in xrange(num):
+		last = start + i // 10
+		flows.append({
+			"srcIP": 0x0a000000 + random.randint(0, 65535),
+			"dstIP": 0xc0a80000 + random.randint(0, 65535),
+			"srcPort": random.choice([80, 443, 22, 53, random.randint(1024, 65535)]),
+			"dstPort": random.choice([80, 443, 22, 53, random.randint(1024, 65535)]),
+			"proto": random.choice([6, 17]),
+			"pkts": random.randint(1, 1000),
+			"bytes": random.randint(40, 1000000),
+			"firstSwitched": last - random.choice([0, 0, 5, 30, 200]),
+			"lastSwitched": last
+		})
+	return flows
+
+def decode_json(entries):
+	flows = []
+	for entry in entries:
+		obj = json.loads(entry)
+		obj["firstSwitched"] = int(obj["firstSwitched"])
+		obj["lastSwitched"] = int(obj["lastSwitched"])
+		for s in config.flow_aggr_sums:
+			obj[s] = int(obj[s])
+		flows.append(obj)
+	return flows
+
+def decode_binary(entries):
+	flows = []
+	for entry in entries:
+		flows.extend(flowrecords.decode(entry))
+	return flows
+
+def access(flows):
+	"""Read the values like the flow handlers and the index updates do.
+	"""
+	for flow in flows:
+		flow["firstSwitched"]
+		flow["lastSwitched"]
+		for v in config.flow_aggr_values:
+			flow.get(v, None)
+		flow.get("proto", -1)
+		for s in config.flow_aggr_sums:
+			flow.get(s, 0)
+			flow.get(s, 0)
+
+def redis_memory(entries):
+	import redis
+	r = redis.StrictRedis(host=args.redis_host, port=args.redis_port, db=args.redis_database)
+	r.flushdb()
+	before = r.info()["used_memory"]
+	for i in xrange(0, len(entries), 1000):
+		r.rpush(BENCHMARK_KEY, *entries[i:i + 1000])
+	used = r.info()["used_memory"] - before
+	r.flushdb()
+	return used
+
+def measure(name, entries, decode):
+	start = time.time()
+	flows = decode(entries)
+	decode_time = time.time() - start
+	start = time.time()
+	access(flows)
+	access_time = time.time() - start
+
+	size = sum([len(e) for e in entries])
+	print "%s:" % (name)
+	print "Queue entries: %i (%.1f bytes per flow)" % (len(entries), size / float(args.flows))
+	if args.redis:
+		print "Redis memory: %.1f bytes per flow" % (redis_memory(entries) / float(args.flows))
+	print "Decode: %.3f us per flow" % (decode_time / args.flows * 1e6)
+	print "Access: %.3f us per flow" % (access_time / args.flows * 1e6)
+	print "Total: %.3f us per flow" % ((decode_time + access_time) / args.flows * 1e6)
+	print ""
+
+flows = generate_flows(args.flows)
+measure("JSON", [json.dumps(flow) for flow in flows], decode_json)
+measure("Binary", flowrecords.encode(flows, args.batch_records), decode_binary)
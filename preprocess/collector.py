@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Collect NetFlow v5, NetFlow v9 and IPFIX packets from exporters over UDP.
+
+The decoded flows are sliced into the bucket collections by this process,
+so no Redis queue and no preprocess.py instance is needed. With --redis the
+flows are pushed to the Redis queue of preprocess.py instead.
+Keep this script running forever if you want live data:
+nohup ./collector.py --port 2055 4739
+
+Run only one instance per port, templates are kept in memory.
+"""
+
+import sys
+import os.path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'config'))
+
+import time
+import errno
+import socket
+import asyncore
+import argparse
+import datetime
+import json
+
+import config
+import ports
+import netflow
+import flowhandlers
+from flowhandlers import FlowPipeline
+
+parser = argparse.ArgumentParser(description="Collect NetFlow v5/v9 and IPFIX flows over UDP and preprocess them into MongoDB.")
+parser.add_argument("--host", nargs="?", default="0.0.0.0", help="Address to listen on")
+parser.add_argument("--port", nargs="+", default=[2055, 4739], type=int, help="UDP ports to listen on")
+parser.add_argument("--dst-host", nargs="?", default=config.db_host, help="MongoDB host")
+parser.add_argument("--dst-port", nargs="?", default=config.db_port, type=int, help="MongoDB port")
+parser.add_argument("--dst-database", nargs="?", default=config.db_name, help="MongoDB database name")
+parser.add_argument("--engine", nargs="?", default="python", choices=["python", "numpy"], help="Slice flows one by one in Python or in batches with NumPy")
+parser.add_argument("--batch-size", nargs="?", default=1000, type=int, help="Number of records handed to the slicing stage or Redis at once")
+parser.add_argument("--redis", nargs="?", type=bool, default=False, const=True, help="Push the flows to the Redis queue of preprocess.py instead of slicing them")
+parser.add_argument("--redis-host", nargs="?", default="127.0.0.1", help="Redis host")
+parser.add_argument("--redis-port", nargs="?", default=6379, type=int, help="Redis port")
+parser.add_argument("--redis-database", nargs="?", default=0, type=int, help="Redis database")
+
+args = parser.parse_args()
+
+if args.engine == "numpy" and flowhandlers.numpy == None:
+	print >> sys.stderr, "The numpy engine requires NumPy!"
+	sys.exit(1)
+
+# Print output every ... in seconds
+OUTPUT_INTERVAL = 10
+
+# the xml file containing known port numbers
+PORTS_FILE = os.path.join(os.path.dirname(__file__), '..', 'config', 'service-names-port-numbers.xml')
+
+REDIS_QUEUE_KEY = "entry:queue"
+
+# Size of the socket receive buffers, exporters send in bursts
+RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+# Maximum size of a UDP packet
+MAX_PACKET_SIZE = 65535
+# Maximum number of packets read at once from one socket
+MAX_READS = 100
+# Wake up after ... seconds to hand over batches and write lingering documents
+POLL_TIMEOUT = 1
+
+class FlowReceiver(asyncore.dispatcher):
+	def __init__(self, host, port, decoder, batch):
+		"""
+		:Parameters:
+		 - `host`: The address to listen on.
+		 - `port`: The UDP port to listen on.
+		 - `decoder`: The NetFlow and IPFIX decoder shared by all ports.
+		 - `batch`: The list the decoded flows are appended to.
+		"""
+		asyncore.dispatcher.__init__(self)
+		self.create_socket(socket.AF_INET, socket.SOCK_DGRAM)
+		try:
+			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+		except socket.error:
+			pass
+		self.bind((host, port))
+		self.decoder = decoder
+		self.batch = batch
+
+	def writable(self):
+		return False
+
+	def handle_connect(self):
+		pass
+
+	def handle_error(self):
+		# asyncore closes the socket by default
+		print >> sys.stderr, "%s: Could not receive packets: %s" % (datetime.datetime.now(), sys.exc_info()[1])
+
+	def handle_read(self):
+		for i in xrange(MAX_READS):
+			try:
+				data, addr = self.socket.recvfrom(MAX_PACKET_SIZE)
+			except socket.error, e:
+				if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+					return
+				raise
+			self.batch.extend(self.decoder.decode(data, addr[0]))
+
+def get_receive_errors():
+	"""Get the number of UDP packets the kernel dropped because of full receive buffers.
+	Returns None if the counter is not available (Linux only).
+	"""
+	try:
+		f = open("/proc/net/snmp", "r")
+		lines = [line.split() for line in f if line.startswith("Udp:")]
+		f.close()
+		return int(lines[1][lines[0].index("RcvbufErrors")])
+	except (IOError, IndexError, ValueError):
+		return None
+
+print "%s: Init..." % (datetime.datetime.now())
+
+pipeline = None
+r = None
+if args.redis:
+	import redis
+	try:
+		r = redis.StrictRedis(host=args.redis_host, port=args.redis_port, db=args.redis_database)
+	except Exception, e:
+		print >> sys.stderr, "Could not connect to Redis database: %s" % (e)
+		sys.exit(1)
+else:
+	import pymongo
+	try:
+		dst_conn = pymongo.Connection(args.dst_host, args.dst_port)
+	except pymongo.errors.AutoReconnect, e:
+		print >> sys.stderr, "Could not connect to MongoDB database!"
+		sys.exit(1)
+	dst_db = dst_conn[args.dst_database]
+
+	# read ports for special filtering
+	known_ports = None
+	if config.flow_filter_unknown_ports:
+		known_ports = ports.load_known_ports(PORTS_FILE)
+
+	# the ports identify this instance, only one may listen on them
+	name = "%s:collector:%s" % (socket.gethostname(), ",".join([str(p) for p in args.port]))
+	pipeline = FlowPipeline(dst_db, known_ports, args.engine, name=name)
+	pipeline.createIndexes()
+
+def handle_batch():
+	"""Hand the received flows over to the slicing stage or the Redis queue.
+	"""
+	if len(batch) == 0:
+		return
+
+	if r != None:
+		pipe = r.pipeline(transaction=False)
+		pipe.rpush(REDIS_QUEUE_KEY, *[json.dumps(flow) for flow in batch])
+		pipe.execute()
+	else:
+		for flow in batch:
+			pipeline.handleFlow(flow)
+	del batch[:]
+
+decoder = netflow.Decoder()
+batch = []
+receivers = [FlowReceiver(args.host, port, decoder, batch) for port in args.port]
+
+print "%s: Listening on UDP %s port %s." % (datetime.datetime.now(), args.host, ", ".join([str(p) for p in args.port]))
+print "%s: Use Ctrl-C to quit." % (datetime.datetime.now())
+
+start_time = time.time()
+last_output = start_time
+last_timeout = start_time
+last_packets = 0
+last_records = 0
+start_errors = get_receive_errors()
+last_errors = start_errors
+
+# Daemon loop
+while True:
+	try:
+		asyncore.loop(timeout=POLL_TIMEOUT, count=1)
+		if len(batch) >= args.batch_size:
+			handle_batch()
+
+		now = time.time()
+		if now - last_timeout >= POLL_TIMEOUT:
+			handle_batch()
+			if pipeline != None:
+				pipeline.handleTimeouts()
+			last_timeout = now
+
+		if now - last_output >= OUTPUT_INTERVAL:
+			elapsed = now - last_output
+			errors = get_receive_errors()
+			print "%s: Received %i packets (%.2f packets/s) with %i records (%.2f records/s), %i malformed packets, %i sets without template, %i records without addresses, %s packets dropped by the kernel." % (
+				datetime.datetime.now(),
+				decoder.num_packets - last_packets, (decoder.num_packets - last_packets) / elapsed,
+				decoder.num_records - last_records, (decoder.num_records - last_records) / elapsed,
+				decoder.num_malformed, decoder.num_unknown_sets, decoder.num_no_address,
+				errors - last_errors if errors != None and last_errors != None else "unknown")
+			last_packets = decoder.num_packets
+			last_records = decoder.num_records
+			last_errors = errors
+			last_output = now
+
+	except KeyboardInterrupt:
+		print "%s: Keyboard interrupt. Terminating..." % (datetime.datetime.now())
+		break
+	except Exception, e:
+		# the collector keeps running, the flows of the current batch are dropped
+		print >> sys.stderr, "%s: Could not handle %i flows: %s" % (datetime.datetime.now(), len(batch), e)
+		del batch[:]
+
+for receiver in receivers:
+	receiver.close()
+
+# clear cache
+handle_batch()
+if pipeline != None:
+	pipeline.flush()
+
+# print reports
+elapsed = time.time() - start_time
+print ""
+print "Received %i packets (%.2f packets/s) with %i records (%.2f records/s) in %.2f seconds." % (
+	decoder.num_packets, decoder.num_packets / elapsed, decoder.num_records, decoder.num_records / elapsed, elapsed)
+errors = get_receive_errors()
+if errors != None and start_errors != None:
+	print "Packets dropped by the kernel (all UDP sockets): %i" % (errors - start_errors)
+print ""
+decoder.printReport()
+if pipeline != None:
+	pipeline.printReports()
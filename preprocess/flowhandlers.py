@@ -0,0 +1,1328 @@
+# -*- coding: utf-8 -*-
+
+"""
+Slicing of flows into the bucket collections and updating of the
+node and port indexes.
+
+Shared by preprocess.py, which takes the flows from the Redis queue,
+and collector.py, which receives them directly from the exporters.
+"""
+
+import time
+import heapq
+import bson
+from collections import deque
+
+import config
+import flowkeys
+import hyperloglog
+import subnets
+import topk
+from ports import PROTO_MASKS
+
+try:
+	import numpy
+	import slicing
+except ImportError:
+	numpy = None
+
+# flow time interval column names
+COL_FIRST_SWITCHED = "firstSwitched"
+COL_LAST_SWITCHED = "lastSwitched"
+# column names of IP addresses
+COL_SRC_IP = "srcIP"
+COL_DST_IP = "dstIP"
+# column names of ports and protocol
+COL_SRC_PORT = "srcPort"
+COL_DST_PORT = "dstPort"
+COL_PROTO = "proto"
+
+# the collection prefix to use for flows
+DB_FLOW_PREFIX = "flows_"
+# the collection prefix to use for completely aggregated flows
+DB_FLOW_AGGR_PREFIX = "flows_aggr_"
+# the collection prefix to use for flows aggregated by a subset of the values
+DB_FLOW_CUBE_PREFIX = "flows_cube_"
+# the collection prefix to use for flows aggregated by the networks of a prefix length
+DB_FLOW_NET_PREFIX = "flows_net"
+# the collection to use for the node index
+DB_INDEX_NODES = "index_nodes"
+# the collection to use for the port index
+DB_INDEX_PORTS = "index_ports"
+# the collection prefix to use for the top-k summaries
+DB_TOPK_PREFIX = "topk_"
+# the collection to use for the bucket catalogue
+DB_BUCKET_CATALOGUE = "bucket_catalogue"
+
+# the collection the preprocessors publish their horizon in
+DB_HORIZON = "horizon"
+# the collection the preprocessors keep the open rolled up buckets in
+DB_ROLLUP_STATE = "rollup_state"
+
+# the bucket catalogue has one document per bucket size and day
+CATALOGUE_DAY = 24*60*60
+# the horizon is published at least every ... seconds
+HORIZON_INTERVAL = 10
+# maximum number of late writes kept in the published horizon
+LATE_LOG_SIZE = 100
+# expired partitions are dropped at most every ... seconds
+EXPIRY_INTERVAL = 60
+# the timeouts are also handled every ... seconds while flows arrive
+TIMEOUT_INTERVAL = 1
+# maximum number of rollup state documents in one write
+ROLLUP_STATE_BATCH_SIZE = 1000
+
+# Number of flows sliced at once by the numpy engine
+ENGINE_BATCH_SIZE = 10000
+
+# Each flow is routed to one worker by its aggregation values and each
+# index entry by its node or port. Only the flow collections and the node
+# and port indexes are split into disjoint key spaces, the documents of the
+# aggregated collections, the cubes, the networks and the node index of the
+# networks are updated by several workers. Their updates only add up and
+# set maxima, so the order does not matter, but each worker writes its own
+# update of such a document per bucket.
+SHARD_FLOW = 1
+SHARD_SRC_NODE = 2
+SHARD_DST_NODE = 4
+SHARD_SRC_PORT = 8
+SHARD_DST_PORT = 16
+SHARD_ALL = SHARD_FLOW | SHARD_SRC_NODE | SHARD_DST_NODE | SHARD_SRC_PORT | SHARD_DST_PORT
+
+def get_cubes():
+	"""Returns the configured subsets of the aggregation values,
+	each one sorted like the aggregation values and without duplicates.
+	"""
+	cubes = []
+	for fields in config.flow_cubes:
+		cube = [v for v in config.flow_aggr_values if v in fields]
+		if len(cube) > 0 and cube not in cubes:
+			cubes.append(cube)
+	return cubes
+	
+def get_topk_fields():
+	"""Returns the configured aggregation values of the top-k summaries
+	like get_cubes.
+	"""
+	topk_fields = []
+	for fields in config.topk_fields:
+		fields = [v for v in config.flow_aggr_values if v in fields]
+		if len(fields) > 0 and fields not in topk_fields:
+			topk_fields.append(fields)
+	return topk_fields
+	
+def get_prefix_lengths():
+	"""Returns the configured prefix lengths as sorted (IPv4 length, IPv6 length) tuples.
+	"""
+	return sorted(config.flow_prefix_lengths.iteritems())
+	
+def get_net_values():
+	"""Returns the IP addresses of the aggregation values, which the collections
+	of the networks are aggregated and indexed by.
+	"""
+	return [v for v in config.flow_aggr_values if v == COL_SRC_IP or v == COL_DST_IP]
+	
+def get_partition_size(size):
+	"""Returns the time window of the partitions of a bucket size (0 if it is not partitioned).
+	"""
+	return config.flow_partition_sizes.get(size, 0)
+	
+def merge_registers(doc, registers):
+	"""Set the HyperLogLog registers of an update document to the larger rank.
+	
+	:Parameters:
+	 - `doc`: The update document.
+	 - `registers`: An iterator over ($max key, rank) tuples.
+	"""
+	maxes = doc.get("$max", None)
+	for key, rank in registers:
+		if maxes == None:
+			maxes = dict()
+			doc["$max"] = maxes
+		if maxes.get(key, 0) < rank:
+			maxes[key] = rank
+			
+def get_cube_collection(fields, size):
+	"""Returns the name of the collection aggregated by `fields` for a bucket size.
+	"""
+	return DB_FLOW_CUBE_PREFIX + "_".join(fields) + "_" + str(size)
+	
+def get_prefix_collection(length, size):
+	"""Returns the name of the collection aggregated by the networks of an IPv4
+	prefix length for a bucket size, e.g. flows_net24_60.
+	"""
+	return DB_FLOW_NET_PREFIX + str(length) + "_" + str(size)
+	
+def get_prefix_index(length):
+	"""Returns the name of the node index of the networks of an IPv4 prefix length.
+	"""
+	return DB_INDEX_NODES + "_" + str(length)
+
+class PartitionedCollection:
+	def __init__(self, db, name, width=0, indexes=[]):
+		"""A bucket collection which is split into one collection per time window.
+		The partitions are named after the collection and the start of their
+		window, e.g. flows_60_1330041600.
+		
+		:Parameters:
+		 - `db`: A pymongo database.
+		 - `name`: The name of the bucket collection.
+		 - `width`: The time window of a partition in seconds (0 keeps a single collection).
+		 - `indexes`: The fields which are indexed in addition to the bucket.
+		"""
+		self.db = db
+		self.name = name
+		self.width = width
+		self.indexes = indexes
+		# name -> the partitions used so far
+		self.collections = dict()
+		
+	def get(self, bucket):
+		"""Returns the collection the documents of a bucket are stored in.
+		The bucket index and the other indexes are created when a partition
+		is used the first time.
+		"""
+		name = self.name
+		if self.width > 0:
+			name = "%s_%i" % (self.name, bucket - bucket % self.width)
+		collection = self.collections.get(name, None)
+		if collection == None:
+			collection = self.db[name]
+			collection.create_index("bucket")
+			for field in self.indexes:
+				collection.create_index(field)
+			self.collections[name] = collection
+		return collection
+		
+	def getPartitions(self):
+		"""Returns the existing partitions sorted by time as (start, collection) tuples.
+		"""
+		if self.width == 0:
+			return [(0, self.db[self.name])]
+			
+		prefix = self.name + "_"
+		starts = [int(name[len(prefix):]) for name in self.db.collection_names()
+			if name.startswith(prefix) and name[len(prefix):].isdigit()]
+		return [(start, self.db[prefix + str(start)]) for start in sorted(starts)]
+		
+	def expire(self, limit):
+		"""Drop the partitions which end before `limit`.
+		Returns the start of the oldest partition which is kept.
+		"""
+		boundary = limit - limit % self.width
+		for start, collection in self.getPartitions():
+			if start < boundary:
+				collection.drop()
+				self.collections.pop(collection.name, None)
+		return boundary
+		
+	def drop(self):
+		for start, collection in self.getPartitions():
+			collection.drop()
+		self.collections = dict()
+
+# Class to handle flows
+class FlowHandler:
+	def __init__(self, bucket_interval, collection, aggr_sum, aggr_values=[], filter_ports=None, cache_size=0, bulk_size=0, bulk_linger=0, cache_lateness=0, distinct=[], precision=10, prefix=None):
+		"""
+		:Parameters:
+		 - `bucket_interval`: The bucket interval in seconds.
+		 - `collection`: A PartitionedCollection to insert the documents.
+		 - `aggr_sum`: A list of keys which will be sliced and summed up.
+		 - `aggr_values`: A list of keys which have to match in order to aggregate two flows
+		 - `filter_ports`: A bitmap of known ports (see ports.py) to remove unknown ports
+		 - `cache_size`: The maximum number of documents to keep in the cache
+		 - `bulk_size`: The maximum number of documents in one bulk write (0 disables bulk writes)
+		 - `bulk_linger`: The maximum time in seconds a document may wait in a bulk batch
+		 - `cache_lateness`: The time in seconds a bucket stays in the cache after its end
+		 - `distinct`: A list of lists of keys whose distinct values are counted with HyperLogLog
+		 - `precision`: The number of HyperLogLog registers as a power of 2
+		 - `prefix`: An (IPv4, IPv6) tuple of prefix lengths to aggregate the IP addresses by their networks
+		"""
+		self.bucket_interval = bucket_interval
+		self.collection = collection
+		self.aggr_sum = aggr_sum
+		self.aggr_values = aggr_values
+		self.filter_ports = filter_ports
+		self.distinct = distinct
+		self.precision = precision
+		self.prefix = prefix
+		
+		# init cache
+		# buckets stay in the cache until the watermark (the latest time seen
+		# minus the allowed lateness) passes their end
+		self.cache = None
+		self.cache_size = cache_size
+		self.cache_lateness = cache_lateness
+		self.max_time = 0
+		# buckets ending before this time have been written before a restart
+		# and are skipped while the unacknowledged queue entries are replayed
+		self.replay_horizon = 0
+		# the horizon of the bucket size published last and the earliest bucket
+		# written after it had passed the bucket (the app may have cached it)
+		self.published_horizon = None
+		self.late_bucket = None
+		if cache_size > 0:
+			self.cache = dict()
+			# keys of cached documents per bucket and a heap of those buckets
+			self.cache_buckets = dict()
+			self.cache_heap = []
+			
+		# init bulk batch
+		# (when the first document is written and the collection class is known)
+		self.bulk = None
+		self.bulk_size = bulk_size
+		self.bulk_linger = bulk_linger
+			
+		# the handler of the next coarser bucket size which is
+		# filled with the documents leaving this handler
+		self.rollup = None
+		# the keys of the rolled up documents which have changed since the
+		# last checkpoint (None if the open buckets are not kept in the rollup state)
+		self.rolled_keys = None
+		
+		# the buckets written since the last catalogue update
+		# (None if this handler does not feed the bucket catalogue)
+		self.written_buckets = None
+		
+		# the TopKHandler summarizing the written documents (None if there is none)
+		self.topk = None
+			
+		# stats
+		self.num_flows = 0
+		self.num_slices = 0
+		self.num_rollups = 0
+		self.cache_hits = 0
+		self.cache_misses = 0
+		self.cache_flushes = 0
+		self.cache_early_flushes = 0
+		self.db_requests = 0
+		
+	def get_id(self, bucket, values):
+		"""Generate a unique binary id from the bucket and the aggregation values.
+		"""
+		return flowkeys.pack_bucket(bucket) + flowkeys.pack_values(self.aggr_values, values)
+	
+	def get_values(self, flow):
+		"""Get the aggregation values of a flow.
+		"""
+		values = dict()
+		
+		# set unknown ports to None
+		if self.filter_ports:
+			for v in self.aggr_values:
+				if v == COL_SRC_PORT or v == COL_DST_PORT:
+					set_value = None
+					value = flow.get(v, None)
+					if value != None and self.filter_ports[value] & PROTO_MASKS[int(flow.get(COL_PROTO, -1))]:
+						set_value = value
+					values[v] = set_value
+				else:
+					values[v] = flow.get(v, None)
+		else:
+			for v in self.aggr_values:
+				values[v] = flow.get(v, None)
+				
+		if self.prefix != None:
+			self.set_networks(values)
+		return values
+		
+	def set_networks(self, values):
+		"""Replace the IP addresses of aggregation values by their networks.
+		"""
+		for v in self.aggr_values:
+			if v == COL_SRC_IP or v == COL_DST_IP:
+				values[v] = subnets.get_network(values[v], *self.prefix)
+	
+	def get_registers(self, flow):
+		"""Get the HyperLogLog registers of a flow as ($max key, rank) tuples.
+		"""
+		registers = []
+		for fields in self.distinct:
+			register, rank = hyperloglog.get_register(flowkeys.pack_values(fields, flow), self.precision)
+			registers.append(("distinct.%s.%i" % ("_".join(fields), register), rank))
+		return registers
+		
+	def get_bucket(self, timestamp, interval):
+		"""Compute the bucket timestamp.
+		"""
+		return int(timestamp) / int(interval) * int(interval)
+	
+	def handleFlow(self, flow):
+		"""Slice a flow from the queue into buckets and insert into MongoDB.
+		"""
+		
+		self.num_flows += 1
+		
+		if flow[COL_LAST_SWITCHED] > self.max_time:
+			self.max_time = flow[COL_LAST_SWITCHED]
+		
+		carry = dict();
+		emitted = dict();
+		for s in self.aggr_sum:
+			carry[s] = 0
+			emitted[s] = 0
+		# the aggregation values are the same for all slices
+		values = self.get_values(flow)
+		packed_values = flowkeys.pack_values(self.aggr_values, values)
+		registers = dict(self.get_registers(flow))
+		
+		bucket = self.get_bucket(flow[COL_FIRST_SWITCHED], self.bucket_interval)
+		while bucket <= flow[COL_LAST_SWITCHED]:
+		
+			self.num_slices += 1
+		
+			nextBucket = bucket + self.bucket_interval;
+			bucketStart = bucket
+			if bucketStart < flow[COL_FIRST_SWITCHED]:
+				bucketStart = flow[COL_FIRST_SWITCHED]
+			bucketEnd = nextBucket - 1
+			if bucketEnd > flow[COL_LAST_SWITCHED]:
+				bucketEnd = flow[COL_LAST_SWITCHED]
+			intervalFactor = (bucketEnd - bucketStart + 1) / float(flow[COL_LAST_SWITCHED] - flow[COL_FIRST_SWITCHED] + 1)
+			
+			incs = dict()
+			if nextBucket > flow[COL_LAST_SWITCHED]:
+				for s in self.aggr_sum:
+					assert flow.get(s, 0) - emitted[s] >= 0
+					incs[s] = flow.get(s, 0) - emitted[s]
+			else:
+				for s in self.aggr_sum:
+					interval = intervalFactor * flow.get(s, 0)
+					num = carry[s] + interval
+					val = int(num)
+					carry[s] = num - val;
+					emitted[s] += val
+					incs[s] = val
+					
+			# count number of aggregated flows in the bucket
+			incs["flows"] = intervalFactor
+			
+			self.handleDoc(flowkeys.pack_bucket(bucket) + packed_values, bucket, values, incs, registers)
+				
+			bucket = nextBucket
+			
+	def handleRollup(self, fine_doc):
+		"""Add a document of a finer bucket size to the bucket it falls into.
+		The bucket interval has to be a multiple of the finer bucket interval.
+		The finer document may have more aggregation values than this handler.
+		"""
+		
+		self.num_rollups += 1
+		
+		bucket = self.get_bucket(fine_doc["$set"]["bucket"], self.bucket_interval)
+		# ports are already filtered in the finer document
+		values = dict([(v, fine_doc["$set"].get(v, None)) for v in self.aggr_values])
+		# the finer document may contain the addresses instead of their networks
+		if self.prefix != None:
+			self.set_networks(values)
+		key = self.get_id(bucket, values)
+		
+		# the finer handler lets this one close its buckets when it is done
+		self.handleDoc(key, bucket, values, fine_doc["$inc"], fine_doc.get("$max", {}), False)
+		if self.rolled_keys != None:
+			self.rolled_keys.add(key)
+		
+	def handleFlows(self, flows):
+		"""Slice a batch of flows into buckets with the vectorized engine.
+		Slices with the same bucket and key are summed up before they reach the cache.
+		"""
+		
+		self.num_flows += len(flows)
+		
+		# number the distinct aggregation values of the batch
+		numbers = dict()
+		key_values = []
+		key_packed = []
+		key_index = numpy.empty(len(flows), numpy.int64)
+		registers = [numpy.empty(len(flows), numpy.int64) for fields in self.distinct]
+		ranks = [numpy.empty(len(flows), numpy.int64) for fields in self.distinct]
+		for i, flow in enumerate(flows):
+			for j, fields in enumerate(self.distinct):
+				registers[j][i], ranks[j][i] = hyperloglog.get_register(flowkeys.pack_values(fields, flow), self.precision)
+			values = self.get_values(flow)
+			packed_values = flowkeys.pack_values(self.aggr_values, values)
+			num = numbers.get(packed_values, None)
+			if num == None:
+				num = len(key_values)
+				numbers[packed_values] = num
+				key_values.append(values)
+				key_packed.append(packed_values)
+			key_index[i] = num
+			
+		first = numpy.fromiter((flow[COL_FIRST_SWITCHED] for flow in flows), numpy.int64, len(flows))
+		last = numpy.fromiter((flow[COL_LAST_SWITCHED] for flow in flows), numpy.int64, len(flows))
+		values = [numpy.fromiter((flow.get(s, 0) for flow in flows), numpy.int64, len(flows)) for s in self.aggr_sum]
+		
+		index, bucket, values, factor = slicing.slice_flows(first, last, values, self.bucket_interval)
+		self.num_slices += len(index)
+		
+		# (key number, bucket) -> HyperLogLog registers
+		maxes = dict()
+		for j, fields in enumerate(self.distinct):
+			name = "_".join(fields)
+			k, b, r, rank = slicing.max_registers(key_index[index], bucket, registers[j][index], ranks[j][index], self.bucket_interval)
+			for i in range(len(k)):
+				maxes.setdefault((int(k[i]), int(b[i])), {})["distinct.%s.%i" % (name, r[i])] = int(rank[i])
+				
+		index, bucket, values, factor = slicing.reduce_slices(key_index[index], bucket, values, factor, self.bucket_interval)
+		for i in range(len(index)):
+			b = int(bucket[i])
+			incs = dict()
+			for j, s in enumerate(self.aggr_sum):
+				incs[s] = int(values[j][i])
+			incs["flows"] = float(factor[i])
+			self.handleDoc(flowkeys.pack_bucket(b) + key_packed[index[i]], b, key_values[index[i]], incs, maxes.get((int(index[i]), b), {}), False)
+			
+		# the watermark moves after all slices of the batch are in the cache,
+		# so the buckets of its earlier flows are not written before its later ones
+		if len(flows) > 0 and last.max() > self.max_time:
+			self.max_time = int(last.max())
+		self.handleCache()
+			
+	def handleDoc(self, key, bucket, values, incs, registers={}, flush=True):
+		"""Add summed up values to the document of a bucket.
+		
+		:Parameters:
+		 - `key`: The unique id of the document.
+		 - `bucket`: The bucket timestamp.
+		 - `values`: A dictionary of the aggregation values.
+		 - `incs`: A dictionary of the values to add.
+		 - `registers`: A dictionary of the HyperLogLog registers to set ($max keys and ranks).
+		 - `flush`: Whether to write the buckets which have been closed.
+		"""
+		
+		if bucket + self.bucket_interval <= self.replay_horizon:
+			# the bucket has been written and rolled up before the restart,
+			# the open coarser buckets are restored from the rollup state
+			if flush:
+				self.handleCache()
+			return
+			
+		# check if we hit the cache
+		doc = None
+		if self.cache != None:
+			doc = self.cache.get(key, None)
+			if doc == None:
+				self.cache_misses += 1
+			else:
+				self.cache_hits += 1
+		if doc == None:
+			doc = { "$set": dict(values), "$inc": {} }
+			doc["$set"]["bucket"] = bucket
+			for s in incs:
+				doc["$inc"][s] = 0
+				
+			if self.cache != None:
+				self.insertCache(key, bucket, doc)
+				
+		for s in incs:
+			doc["$inc"][s] += incs[s]
+		merge_registers(doc, registers.iteritems())
+			
+		# if caching is deactivated then update the collection directly
+		if self.cache == None:
+			self.updateCollection(key, doc)
+		if flush:
+			self.handleCache()
+			
+	def updateCollection(self, key, doc):
+		bucket = doc["$set"]["bucket"]
+		if self.written_buckets != None:
+			self.written_buckets.add(bucket)
+		if self.published_horizon != None and bucket + self.bucket_interval <= self.published_horizon:
+			if self.late_bucket == None or bucket < self.late_bucket:
+				self.late_bucket = bucket
+			
+		if self.topk != None:
+			self.topk.handleDoc(doc, self.max_time - self.cache_lateness)
+			
+		if self.rollup != None:
+			self.rollup.handleRollup(doc)
+			
+		collection = self.collection.get(bucket)
+		# unordered bulk operations are available since pymongo 2.7
+		if self.bulk == None and self.bulk_size > 0 and hasattr(collection.__class__, "initialize_unordered_bulk_op"):
+			self.bulk = dict()
+			self.bulk_started = None
+			
+		if self.bulk != None:
+			self.addToBulk(key, doc)
+			return
+			
+		collection.update({ "_id": bson.binary.Binary(key) }, doc, True)
+		self.db_requests += 1
+		
+	def addToBulk(self, key, doc):
+		"""Add a document to the current bulk batch.
+		Documents with the same key are merged before they are sent.
+		"""
+		pending = self.bulk.get(key, None)
+		if pending == None:
+			if len(self.bulk) == 0:
+				self.bulk_started = time.time()
+			self.bulk[key] = doc
+		elif pending is not doc:
+			for s in doc["$inc"]:
+				pending["$inc"][s] = pending["$inc"].get(s, 0) + doc["$inc"][s]
+			merge_registers(pending, doc.get("$max", {}).iteritems())
+				
+		if len(self.bulk) >= self.bulk_size:
+			self.handleBulk(True)
+		else:
+			self.handleBulk()
+		
+	def handleBulk(self, clear=False):
+		"""Send the current bulk batch as one unordered bulk upsert
+		if it is full, older than the linger time or `clear` is set.
+		"""
+		if not self.bulk:
+			return
+			
+		if not clear and time.time() - self.bulk_started < self.bulk_linger:
+			return
+			
+		# one bulk write per partition
+		bulks = dict()
+		for key, doc in self.bulk.iteritems():
+			collection = self.collection.get(doc["$set"]["bucket"])
+			bulk = bulks.get(collection.name, None)
+			if bulk == None:
+				bulk = collection.initialize_unordered_bulk_op()
+				bulks[collection.name] = bulk
+			bulk.find({ "_id": bson.binary.Binary(key) }).upsert().update(doc)
+		for bulk in bulks.itervalues():
+			bulk.execute()
+			self.db_requests += 1
+		
+		self.bulk = dict()
+		self.bulk_started = None
+		
+	def insertCache(self, key, bucket, doc):
+		keys = self.cache_buckets.get(bucket, None)
+		if keys == None:
+			keys = deque()
+			self.cache_buckets[bucket] = keys
+			heapq.heappush(self.cache_heap, bucket)
+		keys.append(key)
+		self.cache[key] = doc
+		
+	def handleCache(self, clear=False):
+		"""Write all buckets which have been passed by the watermark.
+		The oldest documents are written early if the cache is full.
+		The coarser handler closes its buckets afterwards, so all
+		documents of a closed bucket have been rolled up before.
+		"""
+		if self.cache:
+			# flush closed buckets once
+			watermark = self.max_time - self.cache_lateness
+			while len(self.cache_heap) > 0 and (clear or self.cache_heap[0] + self.bucket_interval <= watermark):
+				bucket = heapq.heappop(self.cache_heap)
+				for key in self.cache_buckets.pop(bucket):
+					self.updateCollection(key, self.cache.pop(key))
+					self.cache_flushes += 1
+					
+			# enforce the memory cap
+			while len(self.cache) > self.cache_size:
+				bucket = self.cache_heap[0]
+				keys = self.cache_buckets[bucket]
+				key = keys.popleft()
+				self.updateCollection(key, self.cache.pop(key))
+				self.cache_early_flushes += 1
+				if self.rolled_keys != None:
+					self.rolled_keys.add(key)
+				if len(keys) == 0:
+					heapq.heappop(self.cache_heap)
+					del self.cache_buckets[bucket]
+					
+		if self.rollup != None:
+			# the coarser handler follows the same watermark
+			if self.max_time > self.rollup.max_time:
+				self.rollup.max_time = self.max_time
+			self.rollup.handleCache(clear)
+			
+	def getHorizon(self):
+		"""Returns the time up to which all buckets of this handler have been written.
+		Buckets ending before it only change if flows arrive later than the allowed lateness.
+		"""
+		horizon = self.max_time - self.cache_lateness
+		if self.cache_heap:
+			horizon = min(horizon, self.cache_heap[0])
+		if self.bulk:
+			horizon = min(horizon, min([doc["$set"]["bucket"] for doc in self.bulk.itervalues()]))
+		return horizon
+		
+	def printReport(self):
+		print "%s report:" % (self.collection.name)
+		print "-----------------------------------"
+		if self.num_rollups > 0:
+			print "Documents rolled up: %i" % (self.num_rollups)
+		else:
+			print "Flows processed: %i" % (self.num_flows)
+			print "Slices overall: %i (avg. %.2f per flow)" % (self.num_slices, self.num_slices / float(max(1, self.num_flows)))
+		print "Database requests: %i" % (self.db_requests)
+		
+		if self.bulk != None:
+			print "Bulk writes: max. %i documents or %.1f seconds per batch" % (self.bulk_size, self.bulk_linger)
+		
+		if self.cache != None:
+			print "Cache hit ratio: %.2f%%" % (self.cache_hits / float(max(1, self.cache_hits + self.cache_misses)) * 100)
+			print "Cache flushes: %i closed, %i early (memory cap)" % (self.cache_flushes, self.cache_early_flushes)
+		else:
+			print "Cache deactivated"
+			
+		print ""
+		
+# Class to aggregate index updates
+class IndexHandler:
+	def __init__(self, collection, cache_size=0, cache_interval=0, bulk_size=0):
+		"""
+		:Parameters:
+		 - `collection`: A pymongo collection to insert the documents.
+		 - `cache_size`: The maximum number of index entries to keep in memory (0 disables the cache)
+		 - `cache_interval`: The maximum time in seconds the counters are kept in memory
+		 - `bulk_size`: The maximum number of documents in one bulk write (0 disables bulk writes)
+		"""
+		self.collection = collection
+		self.bulk_size = bulk_size
+		
+		# init cache
+		self.cache = None
+		self.cache_size = cache_size
+		self.cache_interval = cache_interval
+		if cache_size > 0:
+			self.cache = dict()
+			self.cache_started = None
+			
+		# stats
+		self.num_updates = 0
+		self.num_flushes = 0
+		self.cache_hits = 0
+		self.cache_misses = 0
+		self.db_requests = 0
+		
+	def handleUpdate(self, key, doc):
+		"""Add the $inc values of an index update to the counters of its entry.
+		"""
+		self.num_updates += 1
+		
+		if self.cache == None:
+			# insert if not exists, else update sums
+			self.collection.update({ "_id": key }, doc, True)
+			self.db_requests += 1
+			return
+			
+		counters = self.cache.get(key, None)
+		if counters == None:
+			self.cache_misses += 1
+			if len(self.cache) == 0:
+				self.cache_started = time.time()
+			self.cache[key] = doc
+		else:
+			self.cache_hits += 1
+			for s in doc["$inc"]:
+				counters["$inc"][s] = counters["$inc"].get(s, 0) + doc["$inc"][s]
+				
+		if len(self.cache) >= self.cache_size:
+			self.handleCache(True)
+		else:
+			self.handleCache()
+		
+	def handleCache(self, clear=False):
+		"""Write the counters if the cache interval is over or `clear` is set.
+		"""
+		if not self.cache:
+			return
+			
+		if not clear and time.time() - self.cache_started < self.cache_interval:
+			return
+			
+		self.num_flushes += 1
+		
+		# unordered bulk operations are available since pymongo 2.7
+		if self.bulk_size > 0 and hasattr(self.collection.__class__, "initialize_unordered_bulk_op"):
+			bulk = None
+			for key, doc in self.cache.iteritems():
+				if bulk == None:
+					bulk = self.collection.initialize_unordered_bulk_op()
+					num = 0
+				bulk.find({ "_id": key }).upsert().update(doc)
+				num += 1
+				if num >= self.bulk_size:
+					bulk.execute()
+					self.db_requests += 1
+					bulk = None
+			if bulk != None:
+				bulk.execute()
+				self.db_requests += 1
+		else:
+			for key, doc in self.cache.iteritems():
+				self.collection.update({ "_id": key }, doc, True)
+				self.db_requests += 1
+				
+		self.cache = dict()
+		self.cache_started = None
+		
+	def printReport(self):
+		print "%s report:" % (self.collection.name)
+		print "-----------------------------------"
+		print "Index updates: %i" % (self.num_updates)
+		print "Database requests: %i" % (self.db_requests)
+		
+		if self.cache != None:
+			print "Cache hit ratio: %.2f%%" % (self.cache_hits / float(max(1, self.cache_hits + self.cache_misses)) * 100)
+			print "Cache flushes: %i" % (self.num_flushes)
+		else:
+			print "Cache deactivated"
+			
+		print ""
+		
+def update_node_index(obj, index, aggr_sum, src=True, dst=True, prefix=None):
+	"""Update the node index collection in MongoDB with the current flow.
+	
+	:Parameters:
+	 - `obj`: A dictionary containing a flow.
+	 - `index`: An IndexHandler to aggregate the documents.
+	 - `aggr_sum`: A list of keys which will be sliced and summed up.
+	 - `src`: Whether to update the source node.
+	 - `dst`: Whether to update the destination node.
+	 - `prefix`: An (IPv4, IPv6) tuple of prefix lengths to count the networks of the nodes instead
+	"""
+	
+	# update source node
+	if src:
+		doc = { "$inc": {} }
+		
+		for s in aggr_sum:
+			doc["$inc"][s] = obj.get(s, 0)
+			doc["$inc"]["src." + s] = obj.get(s, 0)
+		doc["$inc"]["flows"] = 1
+		doc["$inc"]["src.flows"] = 1
+		
+		node = obj[COL_SRC_IP]
+		if prefix != None:
+			node = subnets.get_network(node, *prefix)
+		index.handleUpdate(node, doc)
+		
+	# update destination node
+	if dst:
+		doc = { "$inc": {} }
+		
+		for s in aggr_sum:
+			doc["$inc"][s] = obj.get(s, 0)
+			doc["$inc"]["dst." + s] = obj.get(s, 0)
+		doc["$inc"]["flows"] = 1
+		doc["$inc"]["dst.flows"] = 1
+		
+		node = obj[COL_DST_IP]
+		if prefix != None:
+			node = subnets.get_network(node, *prefix)
+		index.handleUpdate(node, doc)
+
+def update_port_index(obj, index, aggr_sum, filter_ports, src=True, dst=True):
+	"""Update the port index collection in MongoDB with the current flow.
+	
+	:Parameters:
+	 - `obj`: A dictionary containing a flow.
+	 - `index`: An IndexHandler to aggregate the documents.
+	 - `aggr_sum`: A list of keys which will be sliced and summed up.
+	 - `filter_ports`: A bitmap of known ports (see ports.py) to remove unknown ports
+	 - `src`: Whether to update the source port.
+	 - `dst`: Whether to update the destination port.
+	"""
+	
+	# update source port
+	if src:
+		doc = { "$inc": {} }
+		
+		for s in aggr_sum:
+			doc["$inc"][s] = obj.get(s, 0)
+			doc["$inc"]["src." + s] = obj.get(s, 0)
+		doc["$inc"]["flows"] = 1
+		doc["$inc"]["src.flows"] = 1
+		
+		# set unknown ports to None
+		port = obj.get(COL_SRC_PORT, None)
+		if filter_ports and port != None and not filter_ports[port] & PROTO_MASKS[int(obj.get(COL_PROTO, -1))]:
+			port = None
+		
+		index.handleUpdate(port, doc)
+		
+	# update destination port
+	if dst:
+		doc = { "$inc": {} }
+		
+		for s in aggr_sum:
+			doc["$inc"][s] = obj.get(s, 0)
+			doc["$inc"]["dst." + s] = obj.get(s, 0)
+		doc["$inc"]["flows"] = 1
+		doc["$inc"]["dst.flows"] = 1
+		
+		# set unknown ports to None
+		port = obj.get(COL_DST_PORT, None)
+		if filter_ports and port != None and not filter_ports[port] & PROTO_MASKS[int(obj.get(COL_PROTO, -1))]:
+			port = None
+		
+		index.handleUpdate(port, doc)
+
+def publish_horizon(collection, name, horizons, started=0, late=[]):
+	"""Store the horizon of each bucket size of a preprocessor instance.
+	The app caches the results of buckets which end before the horizon
+	of all instances that have published it recently.
+	
+	:Parameters:
+	 - `collection`: The horizon collection.
+	 - `name`: The unique name of the instance.
+	 - `horizons`: A dictionary of bucket size and horizon.
+	 - `started`: The start time of the instance, so the app notices restarts.
+	 - `late`: The buckets written after the horizon had passed them as
+	   [number, bucket size, bucket] lists with increasing numbers.
+	"""
+	collection.update(
+		{ "_id": name },
+		{ "$set": {
+			"horizons": dict([(str(s), horizon) for s, horizon in horizons.iteritems()]),
+			"started": started,
+			"late": late,
+			"updated": int(time.time())
+		} },
+		True)
+
+class FlowPipeline:
+	def __init__(self, db, known_ports=None, engine="python", catalogue=None, name=None, timeout_interval=TIMEOUT_INTERVAL):
+		"""Create the flow and index handlers writing into a database.
+		
+		:Parameters:
+		 - `db`: A pymongo database.
+		 - `known_ports`: A bitmap of known ports (see ports.py) or None to keep all ports.
+		 - `engine`: Slice flows one by one with "python" or in batches with "numpy".
+		 - `catalogue`: The bucket catalogue collection (defaults to the one in `db`).
+		 - `name`: The unique name the horizon is published under (None does not publish it).
+		 - `timeout_interval`: The interval in seconds the timeouts are handled in between
+		   the flows, so a busy queue does not delay them (0 leaves them to the caller).
+		"""
+		self.db = db
+		self.catalogue = catalogue
+		if catalogue == None:
+			self.catalogue = db[DB_BUCKET_CATALOGUE]
+		self.name = name
+		self.horizon_published = 0
+		self.started = int(time.time())
+		# the late writes published so far and the number of the last one
+		self.late = deque(maxlen=LATE_LOG_SIZE)
+		self.num_late = 0
+		self.expired = 0
+		self.timeout_interval = timeout_interval
+		self.timeouts_handled = time.time()
+		self.known_ports = known_ports
+		self.engine = engine
+		self.pending_flows = []
+		
+		self.handlers = []
+		for s in config.flow_bucket_sizes:
+			self.handlers.append(FlowHandler(
+				s,
+				PartitionedCollection(db, DB_FLOW_PREFIX + str(s), get_partition_size(s)),
+				config.flow_aggr_sums,
+				config.flow_aggr_values,
+				known_ports,
+				config.pre_cache_size,
+				config.pre_bulk_size,
+				config.pre_bulk_linger,
+				config.pre_cache_lateness
+			))
+		for s in config.flow_bucket_sizes:
+			self.handlers.append(FlowHandler(
+				s,
+				PartitionedCollection(db, DB_FLOW_AGGR_PREFIX + str(s), get_partition_size(s)),
+				config.flow_aggr_sums,
+				[],
+				None,
+				config.pre_cache_size_aggr,
+				config.pre_bulk_size,
+				config.pre_bulk_linger,
+				config.pre_cache_lateness,
+				config.flow_aggr_distinct,
+				config.flow_distinct_precision
+			))
+		# the data cube: flows aggregated by subsets of the aggregation values
+		for fields in get_cubes():
+			for s in config.flow_bucket_sizes:
+				self.handlers.append(FlowHandler(
+					s,
+					PartitionedCollection(db, get_cube_collection(fields, s), get_partition_size(s)),
+					config.flow_aggr_sums,
+					fields,
+					known_ports,
+					config.pre_cache_size,
+					config.pre_bulk_size,
+					config.pre_bulk_linger,
+					config.pre_cache_lateness
+				))
+		# the flows between the networks of the configured prefix lengths,
+		# which are queried by their addresses (the node indexes of the
+		# networks are looked up by their _id and need no further index)
+		net_values = get_net_values()
+		for prefix in get_prefix_lengths():
+			for s in config.flow_bucket_sizes:
+				self.handlers.append(FlowHandler(
+					s,
+					PartitionedCollection(db, get_prefix_collection(prefix[0], s), get_partition_size(s), net_values),
+					config.flow_aggr_sums,
+					net_values,
+					None,
+					config.pre_cache_size,
+					config.pre_bulk_size,
+					config.pre_bulk_linger,
+					config.pre_cache_lateness,
+					prefix=prefix
+				))
+				
+		# the buckets of the aggregated collections are added to the catalogue
+		num = len(config.flow_bucket_sizes)
+		self.aggr_handlers = self.handlers[num:2*num]
+		for handler in self.aggr_handlers:
+			handler.written_buckets = set()
+			
+		# the heavy hitters of each bucket are summarized from the flow documents
+		self.topk_handlers = []
+		if len(get_topk_fields()) > 0 and len(config.topk_values) > 0:
+			for handler in self.handlers[:num]:
+				handler.topk = topk.TopKHandler(
+					handler.bucket_interval,
+					PartitionedCollection(db, DB_TOPK_PREFIX + str(handler.bucket_interval), get_partition_size(handler.bucket_interval)),
+					get_topk_fields(),
+					config.topk_values,
+					config.topk_size
+				)
+				self.topk_handlers.append(handler.topk)
+			
+		# only slice the raw flows into the smallest bucket size and
+		# fill the coarser ones with the documents leaving the next finer one
+		if config.pre_rollup:
+			self.flow_handlers = []
+			for offset in range(0, len(self.handlers), num):
+				for i in range(1, num):
+					self.handlers[offset + i - 1].rollup = self.handlers[offset + i]
+				self.flow_handlers.append(self.handlers[offset])
+		else:
+			self.flow_handlers = self.handlers
+			
+		# the open buckets of the rolled up handlers are stored at every checkpoint,
+		# so the queue entries only wait for the buckets of the smallest bucket size
+		self.rollup_state = None
+		if name != None and config.pre_rollup:
+			self.rollup_state = db[DB_ROLLUP_STATE]
+			for handler in self.handlers:
+				if handler not in self.flow_handlers and handler.cache != None:
+					handler.rolled_keys = set()
+					
+		self.node_index = IndexHandler(db[DB_INDEX_NODES], config.pre_index_cache_size, config.pre_index_cache_interval, config.pre_bulk_size)
+		self.port_index = IndexHandler(db[DB_INDEX_PORTS], config.pre_index_cache_size, config.pre_index_cache_interval, config.pre_bulk_size)
+		# (prefix lengths, node index of the networks) tuples
+		self.prefix_indexes = [(prefix, IndexHandler(db[get_prefix_index(prefix[0])], config.pre_index_cache_size,
+			config.pre_index_cache_interval, config.pre_bulk_size)) for prefix in get_prefix_lengths()]
+		
+	def createIndexes(self):
+		# the flow collections get their bucket index when they are used the first time
+		self.catalogue.create_index("size")
+		if self.rollup_state != None:
+			self.rollup_state.create_index([("instance", 1), ("collection", 1), ("bucket", 1)])
+			
+	def handleFlow(self, obj, shards=SHARD_ALL):
+		"""Slice a flow into the buckets and update the indexes.
+		
+		:Parameters:
+		 - `obj`: A dictionary containing a flow.
+		 - `shards`: The parts of the flow this process is responsible for.
+		"""
+		
+		# Bucket slicing
+		if shards & SHARD_FLOW:
+			if self.engine == "numpy":
+				self.pending_flows.append(obj)
+				if len(self.pending_flows) >= ENGINE_BATCH_SIZE:
+					self.slicePending()
+			else:
+				for handler in self.flow_handlers:
+					handler.handleFlow(obj)
+				
+		if shards & (SHARD_SRC_NODE | SHARD_DST_NODE):
+			update_node_index(obj, self.node_index, config.flow_aggr_sums,
+				shards & SHARD_SRC_NODE, shards & SHARD_DST_NODE)
+			for prefix, index in self.prefix_indexes:
+				update_node_index(obj, index, config.flow_aggr_sums,
+					shards & SHARD_SRC_NODE, shards & SHARD_DST_NODE, prefix)
+		if shards & (SHARD_SRC_PORT | SHARD_DST_PORT):
+			update_port_index(obj, self.port_index, config.flow_aggr_sums, self.known_ports,
+				shards & SHARD_SRC_PORT, shards & SHARD_DST_PORT)
+				
+		if self.timeout_interval > 0 and time.time() - self.timeouts_handled >= self.timeout_interval:
+			self.handleTimeouts()
+				
+	def slicePending(self):
+		"""Slice the flows collected for the numpy engine.
+		"""
+		if len(self.pending_flows) == 0:
+			return
+			
+		for handler in self.flow_handlers:
+			handler.handleFlows(self.pending_flows)
+		self.pending_flows = []
+		
+	def flush(self):
+		"""Write all cached and batched documents to MongoDB, including the
+		buckets which are still open (on shutdown).
+		Handlers are sorted by bucket size, so rolled up documents
+		are flushed by the coarser handlers afterwards.
+		"""
+		self.slicePending()
+		for handler in self.handlers:
+			handler.handleCache(True)
+			handler.handleBulk(True)
+			if handler.topk != None:
+				handler.topk.handleSketches(0, True)
+		self.node_index.handleCache(True)
+		self.port_index.handleCache(True)
+		for prefix, index in self.prefix_indexes:
+			index.handleCache(True)
+		self.updateCatalogue()
+		self.updateHorizon(True)
+		self.clearRollups()
+		
+	def checkpoint(self):
+		"""Write the closed buckets, the bulk batches and the index counters.
+		Returns the horizon of each bucket size as dictionary, all buckets
+		ending before it have been written.
+		"""
+		self.slicePending()
+		for handler in self.handlers:
+			handler.handleCache()
+			handler.handleBulk(True)
+			if handler.topk != None:
+				handler.topk.handleSketches(handler.max_time - handler.cache_lateness)
+		self.node_index.handleCache(True)
+		self.port_index.handleCache(True)
+		for prefix, index in self.prefix_indexes:
+			index.handleCache(True)
+		self.updateCatalogue()
+		self.updateHorizon(True)
+		self.saveRollups()
+		return self.getHorizons()
+		
+	def advanceTime(self, max_time):
+		"""Move the watermark of the handlers forward to the latest time seen
+		by the other processes, so buckets without new flows are closed too.
+		"""
+		for handler in self.flow_handlers:
+			if max_time > handler.max_time:
+				handler.max_time = max_time
+				
+	def setReplay(self, horizons):
+		"""Skip the buckets which have been written before a restart while the
+		unacknowledged entries are processed again.
+		
+		:Parameters:
+		 - `horizons`: The horizon of each bucket size returned by the last checkpoint or None to stop skipping.
+		"""
+		self.slicePending()
+		for handler in self.handlers:
+			handler.replay_horizon = 0
+			if horizons != None:
+				handler.replay_horizon = horizons.get(handler.bucket_interval, 0)
+				
+	def getStateId(self, handler, key):
+		return bson.binary.Binary("%s\0%s\0%s" % (self.name, handler.collection.name, key))
+		
+	def saveRollups(self):
+		"""Store the open buckets of the rolled up handlers which have changed since
+		the last checkpoint and remove the buckets which have been written since then.
+		"""
+		if self.rollup_state == None:
+			return
+			
+		bulk = None
+		if hasattr(self.rollup_state.__class__, "initialize_unordered_bulk_op"):
+			bulk = self.rollup_state.initialize_unordered_bulk_op()
+		num = 0
+		for handler in self.handlers:
+			if handler.rolled_keys == None:
+				continue
+				
+			# the closed buckets have been written
+			horizon = handler.getHorizon()
+			self.rollup_state.remove({ "instance": self.name, "collection": handler.collection.name,
+				"bucket": { "$lte": horizon - handler.bucket_interval } })
+				
+			# documents which left the cache early have been written as well
+			removed = []
+			for key in handler.rolled_keys:
+				doc = handler.cache.get(key, None)
+				if doc == None:
+					removed.append(self.getStateId(handler, key))
+					continue
+					
+				state = {
+					"instance": self.name,
+					"collection": handler.collection.name,
+					"key": bson.binary.Binary(key),
+					"bucket": doc["$set"]["bucket"],
+					"values": doc["$set"],
+					"incs": doc["$inc"],
+					# the register names contain dots
+					"registers": doc.get("$max", {}).items()
+				}
+				if bulk == None:
+					self.rollup_state.update({ "_id": self.getStateId(handler, key) }, state, True)
+					continue
+				bulk.find({ "_id": self.getStateId(handler, key) }).upsert().replace_one(state)
+				num += 1
+				if num >= ROLLUP_STATE_BATCH_SIZE:
+					bulk.execute()
+					bulk = self.rollup_state.initialize_unordered_bulk_op()
+					num = 0
+			for i in range(0, len(removed), ROLLUP_STATE_BATCH_SIZE):
+				self.rollup_state.remove({ "_id": { "$in": removed[i:i + ROLLUP_STATE_BATCH_SIZE] } })
+			handler.rolled_keys = set()
+		if num > 0:
+			bulk.execute()
+			
+	def restoreRollups(self):
+		"""Fill the rolled up handlers with the open buckets stored at the last
+		checkpoint before the unacknowledged queue entries are processed again.
+		Returns the number of restored documents.
+		"""
+		if self.rollup_state == None:
+			return 0
+			
+		handlers = dict([(handler.collection.name, handler) for handler in self.handlers if handler.rolled_keys != None])
+		num = 0
+		for state in self.rollup_state.find({ "instance": self.name }):
+			# the bucket size or cube may not be configured anymore
+			handler = handlers.get(state["collection"], None)
+			if handler == None:
+				continue
+			doc = { "$set": state["values"], "$inc": state["incs"] }
+			merge_registers(doc, state["registers"])
+			handler.insertCache(str(state["key"]), state["bucket"], doc)
+			num += 1
+		return num
+		
+	def clearRollups(self):
+		"""Remove the rollup state after all buckets have been written.
+		"""
+		if self.rollup_state == None:
+			return
+			
+		self.rollup_state.remove({ "instance": self.name })
+		for handler in self.handlers:
+			if handler.rolled_keys != None:
+				handler.rolled_keys = set()
+				
+	def handleTimeouts(self):
+		"""Write bulk batches and index counters which have been waiting too long,
+		update the catalogue and the horizon and drop expired partitions.
+		"""
+		self.timeouts_handled = time.time()
+		self.slicePending()
+		for handler in self.handlers:
+			handler.handleBulk()
+			if handler.topk != None:
+				handler.topk.handleSketches(handler.max_time - handler.cache_lateness)
+		self.node_index.handleCache()
+		self.port_index.handleCache()
+		for prefix, index in self.prefix_indexes:
+			index.handleCache()
+		self.updateCatalogue()
+		self.updateHorizon()
+		self.expirePartitions()
+		
+	def updateCatalogue(self):
+		"""Add the buckets written to the aggregated collections to the bucket catalogue.
+		The catalogue has one document per bucket size and day with the list
+		of buckets, so the app can find the time extent without scanning the
+		flow collections.
+		"""
+		for handler in self.aggr_handlers:
+			if len(handler.written_buckets) == 0:
+				continue
+				
+			days = dict()
+			for bucket in handler.written_buckets:
+				days.setdefault(bucket - bucket % CATALOGUE_DAY, []).append(bucket)
+			for day, buckets in days.iteritems():
+				self.catalogue.update(
+					{ "_id": "%i:%i" % (handler.bucket_interval, day) },
+					{
+						"$set": { "size": handler.bucket_interval, "day": day },
+						"$addToSet": { "buckets": { "$each": sorted(buckets) } }
+					},
+					True)
+			handler.written_buckets = set()
+			
+	def expirePartitions(self, force=False):
+		"""Drop the partitions which ended longer than the retention time of their
+		bucket size before the newest flow and remove their buckets from the catalogue.
+		Runs once per expiry interval or if `force` is set.
+		"""
+		if not force and time.time() - self.expired < EXPIRY_INTERVAL:
+			return
+		self.expired = time.time()
+		
+		newest = max([handler.max_time for handler in self.handlers])
+		for s in config.flow_bucket_sizes:
+			retention = config.flow_retention.get(s, 0)
+			if retention <= 0 or newest == 0:
+				continue
+				
+			for handler in self.handlers + self.topk_handlers:
+				if handler.bucket_interval == s:
+					boundary = handler.collection.expire(newest - retention)
+			self.catalogue.update(
+				{ "size": s, "day": { "$lt": boundary } },
+				{ "$pull": { "buckets": { "$lt": boundary } } },
+				multi=True)
+			self.catalogue.remove({ "size": s, "buckets": { "$size": 0 } })
+			
+	def getHorizons(self):
+		"""Returns the time up to which the buckets of all flow handlers have been
+		written as dictionary of bucket size and horizon.
+		"""
+		horizons = dict()
+		for handler in self.handlers:
+			horizon = handler.getHorizon()
+			horizons[handler.bucket_interval] = min(horizon, horizons.get(handler.bucket_interval, horizon))
+		return horizons
+		
+	def updateHorizon(self, force=False):
+		"""Publish the horizons once per horizon interval or if `force` is set.
+		Long or late flows change buckets the horizon has passed already,
+		the earliest of them per bucket size is added to the late writes.
+		"""
+		if self.name == None:
+			return
+		if not force and time.time() - self.horizon_published < HORIZON_INTERVAL:
+			return
+			
+		late = dict()
+		for handler in self.handlers:
+			if handler.late_bucket != None:
+				late[handler.bucket_interval] = min(handler.late_bucket, late.get(handler.bucket_interval, handler.late_bucket))
+				handler.late_bucket = None
+		for s in sorted(late.keys()):
+			self.num_late += 1
+			self.late.append([self.num_late, s, late[s]])
+			
+		horizons = self.getHorizons()
+		publish_horizon(self.db[DB_HORIZON], self.name, horizons, self.started, list(self.late))
+		for handler in self.handlers:
+			handler.published_horizon = horizons[handler.bucket_interval]
+		self.horizon_published = time.time()
+		
+	def printReports(self):
+		for handler in self.handlers + self.topk_handlers:
+			handler.printReport()
+		self.node_index.printReport()
+		for prefix, index in self.prefix_indexes:
+			index.printReport()
+		self.port_index.printReport()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compact binary keys for the flow documents.
+
+A key is the bucket as a 32 bit big-endian integer followed by one field
+per aggregation value. Every field starts with a type marker, so keys are
+never ambiguous and missing values differ from all other values:
+ - IPv4 addresses (dotted strings or integers): 4 bytes
+ - IPv6 addresses (strings or integers): 16 bytes
+ - ports: 16 bit integer
+ - protocol: 8 bit integer
+ - all other values: length-prefixed UTF-8 string
+"""
+
+import socket
+import struct
+
+# column names of IP addresses
+IP_COLUMNS = ["srcIP", "dstIP"]
+# column names of ports
+PORT_COLUMNS = ["srcPort", "dstPort"]
+# column names of protocols
+PROTO_COLUMNS = ["proto"]
+
+MARKER_NONE = "\x00"
+MARKER_INT8 = "\x01"
+MARKER_INT16 = "\x02"
+MARKER_IPV4 = "\x04"
+MARKER_IPV6 = "\x06"
+MARKER_STRING = "\xff"
+
+BUCKET = struct.Struct(">I")
+INT8 = struct.Struct(">B")
+INT16 = struct.Struct(">H")
+INT32 = struct.Struct(">I")
+INT128 = struct.Struct(">QQ")
+
+def pack_bucket(bucket):
+	return BUCKET.pack(bucket)
+
+def pack_string(value):
+	if isinstance(value, unicode):
+		value = value.encode("utf-8")
+	else:
+		value = str(value)
+	return MARKER_STRING + INT16.pack(len(value)) + value
+
+def pack_ip(value):
+	if isinstance(value, (int, long)):
+		if 0 <= value < 1 << 32:
+			return MARKER_IPV4 + INT32.pack(value)
+		if 0 <= value < 1 << 128:
+			return MARKER_IPV6 + INT128.pack(value >> 64, value & 0xffffffffffffffff)
+		return pack_string(value)
+
+	try:
+		return MARKER_IPV4 + socket.inet_pton(socket.AF_INET, value)
+	except (socket.error, TypeError, ValueError):
+		pass
+	try:
+		return MARKER_IPV6 + socket.inet_pton(socket.AF_INET6, value)
+	except (socket.error, TypeError, ValueError):
+		return pack_string(value)
+
+def pack_int(value, marker, packer):
+	try:
+		return marker + packer.pack(int(value))
+	except (struct.error, TypeError, ValueError):
+		return pack_string(value)
+
+def pack_value(col, value):
+	"""Pack one aggregation value.
+	"""
+	if value == None:
+		return MARKER_NONE
+	if col in IP_COLUMNS:
+		return pack_ip(value)
+	if col in PORT_COLUMNS:
+		return pack_int(value, MARKER_INT16, INT16)
+	if col in PROTO_COLUMNS:
+		return pack_int(value, MARKER_INT8, INT8)
+	return pack_string(value)
+
+def pack_values(columns, values):
+	"""Pack the aggregation values of a flow or document.
+	The bucket has to be prepended with pack_bucket.
+
+	:Parameters:
+	 - `columns`: A list of the aggregation value column names.
+	 - `values`: A dictionary containing the aggregation values.
+	"""
+	return "".join([pack_value(col, values.get(col, None)) for col in columns])
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compact binary encoding of flows on the Redis queue.
+
+Besides JSON objects the queue may carry binary batches. A batch starts
+with the FORMAT_BATCH marker, which can never start a JSON object or the
+END flag, followed by the number of records and the packed records:
+
+ marker (1 byte) | count (uint16) | count * record (37 bytes)
+
+A record holds the columns of RECORD_COLUMNS with a fixed layout. IPv4
+addresses are stored as integers. Flows that do not fit into the layout
+(e.g. IPv6 addresses or missing values) are sent as JSON objects instead.
+
+Decoded flows are FlowRecord tuples, which support the read access of
+dictionaries used by the flow handlers.
+"""
+
+import json
+import struct
+
+FORMAT_BATCH = "\x01"
+
+RECORD_COLUMNS = ("srcIP", "dstIP", "srcPort", "dstPort", "proto", "pkts", "bytes", "firstSwitched", "lastSwitched")
+RECORD = struct.Struct("!IIHHBQQII")
+COUNT = struct.Struct("!H")
+
+# Maximum number of records in a batch
+MAX_BATCH_RECORDS = 0xffff
+
+COLUMN_INDEX = dict([(col, i) for i, col in enumerate(RECORD_COLUMNS)])
+
+class FlowRecord(tuple):
+	"""A decoded flow with the values of RECORD_COLUMNS.
+	"""
+	__slots__ = ()
+
+	def __getitem__(self, key):
+		return tuple.__getitem__(self, COLUMN_INDEX[key])
+
+	def get(self, key, default=None):
+		i = COLUMN_INDEX.get(key, None)
+		if i == None:
+			return default
+		return tuple.__getitem__(self, i)
+
+	def __contains__(self, key):
+		return key in COLUMN_INDEX
+
+	def keys(self):
+		return list(RECORD_COLUMNS)
+
+def is_batch(entry):
+	return entry[:1] == FORMAT_BATCH
+
+def pack_record(flow):
+	"""Pack a flow dictionary into a record.
+	Returns None if the flow does not fit into the record layout.
+	"""
+	try:
+		return RECORD.pack(*[flow[col] for col in RECORD_COLUMNS])
+	except (KeyError, TypeError, struct.error):
+		return None
+
+def encode(flows, batch_records=MAX_BATCH_RECORDS):
+	"""Encode flow dictionaries into queue entries.
+	Returns a list of binary batches and JSON objects of the flows which do not fit.
+	The entries keep the order of the flows.
+
+	:Parameters:
+	 - `flows`: A list of flow dictionaries.
+	 - `batch_records`: The maximum number of records in a batch.
+	"""
+	entries = []
+	records = []
+	for flow in flows:
+		record = pack_record(flow)
+		if record == None:
+			# flush the pending records to keep the order of the flows
+			if len(records) > 0:
+				entries.append(FORMAT_BATCH + COUNT.pack(len(records)) + "".join(records))
+				records = []
+			entries.append(json.dumps(flow))
+			continue
+		records.append(record)
+		if len(records) >= batch_records:
+			entries.append(FORMAT_BATCH + COUNT.pack(len(records)) + "".join(records))
+			records = []
+	if len(records) > 0:
+		entries.append(FORMAT_BATCH + COUNT.pack(len(records)) + "".join(records))
+	return entries
+
+def decode(entry):
+	"""Decode a binary batch into a list of FlowRecords.
+	Raises ValueError if the batch is truncated.
+	"""
+	if len(entry) < 1 + COUNT.size:
+		raise ValueError("Truncated batch")
+	count = COUNT.unpack_from(entry, 1)[0]
+	if len(entry) != 1 + COUNT.size + count * RECORD.size:
+		raise ValueError("Invalid batch length")
+	unpack = RECORD.unpack_from
+	size = RECORD.size
+	return [FlowRecord(unpack(entry, offset)) for offset in xrange(1 + COUNT.size, len(entry), size)]
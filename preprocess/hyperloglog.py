@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+"""
+HyperLogLog registers for counting distinct values per bucket.
+
+The hash of a value selects one of 2^precision registers, which keeps the
+largest rank (position of the first set bit) of all hashes it has seen.
+Registers of several buckets are merged with the maximum, so the flow
+documents store them as a subdocument { register: rank } which is
+updated with $max and only contains the registers which are set.
+"""
+
+import struct
+import hashlib
+
+HASH = struct.Struct(">Q")
+
+def get_register(packed_values, precision):
+	"""Returns the register and the rank of a value.
+
+	:Parameters:
+	 - `packed_values`: The value packed with flowkeys.pack_values.
+	 - `precision`: The number of hash bits which select the register.
+	"""
+	h = HASH.unpack(hashlib.md5(packed_values).digest()[:8])[0]
+	bits = 64 - precision
+	rest = h & ((1 << bits) - 1)
+	return h >> bits, bits - rest.bit_length() + 1
@@ -5,34 +5,29 @@
 Import IPFIX flows from MySQL or PostgreSQL Vermont format
 into the Redis buffer for preprocessing
 
+The hourly tables are read through server-side cursors, so no table is
+loaded into memory at once. Several worker processes can read them in
+parallel if the preprocessor allows flows to be late by as many hours.
+
 Author: Mario Volke
 """
 
 import sys
-import math
+import os.path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'config'))
+
 import time
+import signal
+import multiprocessing
+import Queue
 import argparse
 import datetime
 import redis
 import json
-import psycopg2
-import MySQLdb
-import _mysql_exceptions
-
-IGNORE_COLUMNS = ["firstSwitchedMillis", "lastSwitchedMillis"]
-
-# width defines bar width
-# percent defines current percentage
-def progress(width, percent):
-	marks = math.floor(width * (percent / 100.0))
-	spaces = math.floor(width - marks)
- 
- 	loader = '[' + ('=' * int(marks)) + (' ' * int(spaces)) + ']'
- 
-	sys.stdout.write("%s %d%%\r" % (loader, percent))
-	if percent >= 100:
-		sys.stdout.write("\n")
-	sys.stdout.flush()
+
+import config
+import flowrecords
+import sqlsource
 
 parser = argparse.ArgumentParser(description="Import IPFIX flows from MySQL or PostgreSQL Vermont format into the Redis buffer for preprocessing")
 parser.add_argument("--src-host", nargs="?", default="127.0.0.1", help="MySQL or PostgreSQL host")
@@ -43,93 +38,162 @@ parser.add_argument("--src-database", nargs="?", default="flows", help="MySQL or
 parser.add_argument("--dst-host", nargs="?", default="127.0.0.1", help="Redis host")
 parser.add_argument("--dst-port", nargs="?", default=6379, type=int, help="Redis port")
 parser.add_argument("--dst-database", nargs="?", default=0, type=int, help="Redis database")
-parser.add_argument("--max-queue", nargs="?", type=int, default=100000, help="The maximum queue length before the import will sleep.")
+parser.add_argument("--max-queue", nargs="?", type=int, default=100000, help="The maximum queue length (entries) before the import will wait for the preprocessing.")
+parser.add_argument("--fetch-size", nargs="?", type=int, default=5000, help="Number of rows fetched from the database and pushed to the queue at once.")
+parser.add_argument("--workers", nargs="?", type=int, default=1, help="Number of tables imported in parallel (1 keeps the flows ordered by time). The flows of up to this many hourly tables are interleaved, so pre_cache_lateness of the preprocessor has to cover as many hours, otherwise the watermark closes buckets which still receive flows.")
+parser.add_argument("--format", nargs="?", default="json", choices=["json", "binary"], help="Push the flows as JSON objects or as compact binary batches")
+parser.add_argument("--batch-records", nargs="?", type=int, default=100, help="Number of flows in one binary batch.")
 parser.add_argument("--clear-queue", nargs="?", type=bool, default=False, const=True, help="Whether to clear the queue before importing the flows.")
 
 args = parser.parse_args()
 
+if args.format == "binary":
+	missing = [c for c in config.flow_aggr_values + config.flow_aggr_sums if c not in flowrecords.RECORD_COLUMNS]
+	if len(missing) > 0:
+		print >> sys.stderr, "Binary records do not contain the aggregated columns %s!" % (", ".join(missing))
+		sys.exit(1)
+
 REDIS_QUEUE_KEY = "entry:queue"
 
-# check if is there a MySQL or a PostgreSQL database
+# Bounds of the time to wait for the preprocessing in seconds
+MIN_WAIT = 0.01
+MAX_WAIT = 1
+
+def wait_for_queue(r, queue_length):
+	"""Wait until the preprocessing has drained the queue below the maximum length.
+	The waiting time is estimated from the rate the queue is drained, so the
+	import resumes as soon as there is room again.
+	"""
+	delay = MIN_WAIT
+	last_length = queue_length
+	last_time = time.time()
+	while queue_length > args.max_queue:
+		time.sleep(delay)
+		queue_length = r.llen(REDIS_QUEUE_KEY)
+		now = time.time()
+		if queue_length < last_length:
+			rate = (last_length - queue_length) / (now - last_time)
+			delay = (queue_length - args.max_queue) / rate
+		else:
+			delay *= 2
+		delay = min(max(delay, MIN_WAIT), MAX_WAIT)
+		last_length = queue_length
+		last_time = now
+	return queue_length
+
+def import_table(conn, type, r, table):
+	"""Push all flows of a table to the queue.
+	Returns the number of flows and the time spent waiting for the preprocessing.
+	"""
+	count = 0
+	waited = 0
+	for flows in sqlsource.read_table(conn, type, table, args.fetch_size):
+		# push the whole batch with a single command
+		if args.format == "binary":
+			entries = flowrecords.encode(flows, args.batch_records)
+		else:
+			entries = [json.dumps(flow) for flow in flows]
+		queue_length = r.rpush(REDIS_QUEUE_KEY, *entries)
+		count += len(flows)
+
+		if queue_length > args.max_queue:
+			wait_start = time.time()
+			wait_for_queue(r, queue_length)
+			waited += time.time() - wait_start
+
+	return count, waited
+
+def run_worker(tables, results):
+	"""Import tables until there are none left.
+
+	:Parameters:
+	 - `tables`: The queue of table names to import, None ends the worker.
+	 - `results`: The queue to report the number of imported flows of each table.
+	"""
+	# the main process takes care of Ctrl-C
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+	conn, type = sqlsource.connect(args.src_host, args.src_port, args.src_user, args.src_password, args.src_database)
+	r = redis.StrictRedis(host=args.dst_host, port=args.dst_port, db=args.dst_database)
+
+	while True:
+		table = tables.get()
+		if table == None:
+			break
+
+		start = time.time()
+		count, waited = import_table(conn, type, r, table)
+		results.put((table, count, time.time() - start, waited))
+
+	conn.close()
+
 try:
-	TYPE = "postgresql"
-	dns = dict(
-		database = args.src_database, 
-		host = args.src_host,
-		user = args.src_user,
-		password = args.src_password
-	)
-	if args.src_port is not None:
-		dns.port = args.src_port
-	conn = psycopg2.connect(**dns)
-except psycopg2.OperationalError, e:
-	try:
-		TYPE = "mysql"
-		dns = dict(
-			db = args.src_database, 
-			host = args.src_host,
-			user = args.src_user,
-			passwd = args.src_password
-		)
-		if args.src_port is not None:
-			dns.port = args.src_port
-		conn = MySQLdb.connect(**dns)
-	except _mysql_exceptions.OperationalError, e:
-		print >> sys.stderr, "Could not connect to source database!"
-		sys.exit(1)
+	conn, TYPE = sqlsource.connect(args.src_host, args.src_port, args.src_user, args.src_password, args.src_database)
+except sqlsource.ConnectionErrors, e:
+	print >> sys.stderr, "Could not connect to source database!"
+	sys.exit(1)
 
 try:
 	r = redis.StrictRedis(host=args.dst_host, port=args.dst_port, db=args.dst_database)
-except e:
+except Exception, e:
 	print >> sys.stderr, "Could not connect to Redis database!"
 	sys.exit(1)
-	
+
 if args.clear_queue:
 	r.delete(REDIS_QUEUE_KEY)
-	
-c = conn.cursor()
 
 startTime = datetime.datetime.now()
 print "%s: connected to source and destination database" % (startTime)
 
 # get all flow tables
-c.execute("""SELECT table_name from information_schema.tables 
-	WHERE table_schema=%s AND table_type='BASE TABLE' AND table_name LIKE 'h\\_%%' ORDER BY table_name ASC""", 
-	(args.src_database))
-tables = c.fetchall()
+tables = sqlsource.get_tables(conn, args.src_database)
+conn.close()
+
+table_queue = multiprocessing.Queue()
+for table in tables:
+	table_queue.put(table)
+results = multiprocessing.Queue()
+
+num_workers = max(1, min(args.workers, len(tables)))
+for i in range(num_workers):
+	table_queue.put(None)
 
-# THIS IS MYSQL SPECIFIC
-#c.execute("SHOW TABLES LIKE 'h\\_%'")
-#tables = c.fetchall()
+workers = []
+for i in range(num_workers):
+	worker = multiprocessing.Process(target=run_worker, args=(table_queue, results))
+	worker.start()
+	workers.append(worker)
+print "%s: importing %i tables with %i worker processes" % (datetime.datetime.now(), len(tables), len(workers))
 
 count = 0
-for i, table in enumerate(tables):
-	progress(100, i/len(tables)*100)
-	
-	c.execute("SELECT * FROM " + table[0] + " ORDER BY firstSwitched ASC")
-	
-	for row in c:
-		obj = dict()
-		for j, col in enumerate(c.description):
-			if col[0] not in IGNORE_COLUMNS:
-				obj[col[0]] = row[j]
-		
-		queue_length = r.rpush(REDIS_QUEUE_KEY, json.dumps(obj))
-		while queue_length > args.max_queue:
-			print "Max queue length reached, importing paused..."
-			time.sleep(10)
-			queue_length = r.llen(REDIS_QUEUE_KEY)
-			
-		count += 1
-
-progress(100, 100)
+done = 0
+try:
+	while done < len(tables):
+		try:
+			table, rows, elapsed, waited = results.get(True, 1)
+		except Queue.Empty:
+			if len([w for w in workers if w.is_alive()]) == 0:
+				print >> sys.stderr, "All worker processes died!"
+				sys.exit(1)
+			continue
+
+		done += 1
+		count += rows
+		print "%s: [%i/%i] imported %i flows from %s in %.2f seconds (%.2f rows/s, %.2f seconds waiting for the queue)" % (
+			datetime.datetime.now(), done, len(tables), rows, table, elapsed, rows / max(elapsed, 0.001), waited)
+except KeyboardInterrupt:
+	print "%s: Keyboard interrupt. Terminating..." % (datetime.datetime.now())
+	for worker in workers:
+		worker.terminate()
+	sys.exit(1)
+
+for worker in workers:
+	worker.join()
 
 # Append termination flag to queue
 # The preprocessing daemon will terminate with this flag.
 r.rpush(REDIS_QUEUE_KEY, "END")
 
 endTime = datetime.datetime.now()
-print "%s: imported %i flows in %s" % (endTime, count, endTime - startTime)
-
-c.close()
-conn.close()
\ No newline at end of file
+elapsed = endTime - startTime
+print "%s: imported %i flows in %s (%.2f rows/s)" % (endTime, count, elapsed, count / max(elapsed.total_seconds(), 0.001))
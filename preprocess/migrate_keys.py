@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Convert the document ids of existing flow collections from the former
+string ids into the compact binary ids.
+
+All bucket collections are converted, i.e. the flows, the aggregated flows,
+the data cube and the networks of every bucket size, and their partitions.
+Documents which only differed in unknown ports are merged, because the new
+ids are built from the stored (filtered) values. Merged documents sum up
+their counters and keep the larger rank of their HyperLogLog registers.
+Stop all preprocess.py instances before running the migration!
+"""
+
+import sys
+import os.path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'config'))
+
+import argparse
+import datetime
+import pymongo
+import bson
+
+import config
+import flowkeys
+from flowhandlers import PartitionedCollection, DB_FLOW_PREFIX, DB_FLOW_AGGR_PREFIX
+from flowhandlers import get_cubes, get_cube_collection, get_prefix_lengths, get_prefix_collection, get_net_values
+
+parser = argparse.ArgumentParser(description="Convert the ids of the flow collections into compact binary ids.")
+parser.add_argument("--dst-host", nargs="?", default=config.db_host, help="MongoDB host")
+parser.add_argument("--dst-port", nargs="?", default=config.db_port, type=int, help="MongoDB port")
+parser.add_argument("--dst-database", nargs="?", default=config.db_name, help="MongoDB database name")
+parser.add_argument("--batch-size", nargs="?", default=1000, type=int, help="Number of documents per bulk write")
+
+args = parser.parse_args()
+
+# the suffix of the temporary collections
+DB_MIGRATE_SUFFIX = "_migrate"
+
+def get_id_index_size(db, name):
+	stats = db.command("collstats", name)
+	return stats.get("indexSizes", {}).get("_id_", 0)
+
+def migrate(db, name, aggr_values, indexes=[]):
+	"""Copy all documents of a collection with new ids and replace the collection.
+	
+	:Parameters:
+	 - `db`: A pymongo database.
+	 - `name`: The name of the collection.
+	 - `aggr_values`: The keys the documents of the collection are aggregated by.
+	 - `indexes`: The fields which are indexed in addition to the bucket.
+	"""
+	collection = db[name]
+	tmp = db[name + DB_MIGRATE_SUFFIX]
+	tmp.drop()
+
+	num_docs = collection.count()
+	index_size = get_id_index_size(db, name)
+
+	bulk = None
+	for doc in collection.find().batch_size(args.batch_size):
+		values = dict([(v, doc.get(v, None)) for v in aggr_values])
+		key = flowkeys.pack_bucket(doc["bucket"]) + flowkeys.pack_values(aggr_values, values)
+
+		# merge every field like partition_collections.py
+		update = { "$set": values, "$inc": {} }
+		for k, v in doc.iteritems():
+			if k in config.flow_aggr_sums or k == "flows":
+				update["$inc"][k] = v
+			elif k == "distinct":
+				# HyperLogLog registers keep the larger rank
+				for field, registers in v.iteritems():
+					for r, rank in registers.iteritems():
+						update.setdefault("$max", {})["distinct.%s.%s" % (field, r)] = rank
+			elif k != "_id" and not k in aggr_values:
+				update["$set"][k] = v
+
+		# unordered bulk operations are available since pymongo 2.7
+		if hasattr(tmp.__class__, "initialize_unordered_bulk_op"):
+			if bulk == None:
+				bulk = tmp.initialize_unordered_bulk_op()
+				num = 0
+			bulk.find({ "_id": bson.binary.Binary(key) }).upsert().update(update)
+			num += 1
+			if num >= args.batch_size:
+				bulk.execute()
+				bulk = None
+		else:
+			tmp.update({ "_id": bson.binary.Binary(key) }, update, True)
+	if bulk != None:
+		bulk.execute()
+
+	tmp.create_index("bucket")
+	for field in indexes:
+		tmp.create_index(field)
+	tmp.rename(name, dropTarget=True)
+
+	print "%s: %i documents -> %i documents, _id index %i -> %i bytes" % (
+		name, num_docs, collection.count(), index_size, get_id_index_size(db, name))
+
+try:
+	dst_conn = pymongo.Connection(args.dst_host, args.dst_port)
+except pymongo.errors.AutoReconnect, e:
+	print >> sys.stderr, "Could not connect to MongoDB database!"
+	sys.exit(1)
+
+dst_db = dst_conn[args.dst_database]
+collection_names = dst_db.collection_names()
+
+startTime = datetime.datetime.now()
+print "%s: Migration started." % (startTime)
+
+net_values = get_net_values()
+for s in config.flow_bucket_sizes:
+	collections = [(DB_FLOW_PREFIX + str(s), config.flow_aggr_values, []), (DB_FLOW_AGGR_PREFIX + str(s), [], [])]
+	collections += [(get_cube_collection(fields, s), fields, []) for fields in get_cubes()]
+	collections += [(get_prefix_collection(length, s), net_values, net_values) for length, length6 in get_prefix_lengths()]
+	for name, aggr_values, indexes in collections:
+		# the single collection and the partitions of any size
+		names = []
+		if name in collection_names:
+			names.append(name)
+		names += [partition.name for start, partition in PartitionedCollection(dst_db, name, 1).getPartitions()]
+		for partition_name in names:
+			migrate(dst_db, partition_name, aggr_values, indexes)
+
+endTime = datetime.datetime.now()
+print "%s: Migration finished in %s." % (endTime, endTime - startTime)
@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+
+"""
+Decoder for NetFlow v5, NetFlow v9 and IPFIX (RFC 7011) export packets.
+
+Packets are decoded into flow dictionaries with the same columns as the
+Vermont flow tables: IPv4 addresses as integers, IPv6 addresses as strings,
+ports, protocol, packet and byte counters and the flow start and end as
+unix timestamps in seconds.
+
+Templates of NetFlow v9 and IPFIX are kept per exporter address, observation
+domain (source id) and template id. Every template is compiled into a struct
+format, so a data record with fixed length fields is decoded with a single
+unpack call.
+"""
+
+import socket
+import struct
+import binascii
+
+VERSION_V5 = 5
+VERSION_V9 = 9
+VERSION_IPFIX = 10
+
+V5_HEADER = struct.Struct("!HHIIIIBBH")
+V5_RECORD = struct.Struct("!IIIHHIIIIHHBBBBHHBBH")
+V9_HEADER = struct.Struct("!HHIIII")
+IPFIX_HEADER = struct.Struct("!HHIII")
+SET_HEADER = struct.Struct("!HH")
+FIELD = struct.Struct("!HH")
+UINT8 = struct.Struct("!B")
+UINT16 = struct.Struct("!H")
+UINT32 = struct.Struct("!I")
+
+# set ids of templates and options templates, data sets start at 256
+V9_TEMPLATE_SET = 0
+V9_OPTIONS_SET = 1
+IPFIX_TEMPLATE_SET = 2
+IPFIX_OPTIONS_SET = 3
+MIN_DATA_SET = 256
+
+# field length of variable length IPFIX fields
+VARIABLE_LENGTH = 0xffff
+# enterprise bit of IPFIX information element ids
+ENTERPRISE_BIT = 0x8000
+
+# information elements, the NetFlow v9 field types have the same numbers
+IE_OCTETS = 1
+IE_PACKETS = 2
+IE_PROTO = 4
+IE_SRC_PORT = 7
+IE_SRC_IPV4 = 8
+IE_DST_PORT = 11
+IE_DST_IPV4 = 12
+IE_LAST_UPTIME = 21
+IE_FIRST_UPTIME = 22
+IE_SRC_IPV6 = 27
+IE_DST_IPV6 = 28
+IE_START_SECONDS = 150
+IE_END_SECONDS = 151
+IE_START_MILLISECONDS = 152
+IE_END_MILLISECONDS = 153
+IE_SYSTEM_INIT_MILLISECONDS = 160
+
+COL_FIRST_SWITCHED = "firstSwitched"
+COL_LAST_SWITCHED = "lastSwitched"
+COL_SRC_IP = "srcIP"
+COL_DST_IP = "dstIP"
+COL_SRC_PORT = "srcPort"
+COL_DST_PORT = "dstPort"
+COL_PROTO = "proto"
+COL_PKTS = "pkts"
+COL_BYTES = "bytes"
+
+# the columns of the decoded information elements,
+# timestamps are collected under their element id first
+FIELD_COLUMNS = {
+	IE_OCTETS: COL_BYTES,
+	IE_PACKETS: COL_PKTS,
+	IE_PROTO: COL_PROTO,
+	IE_SRC_PORT: COL_SRC_PORT,
+	IE_SRC_IPV4: COL_SRC_IP,
+	IE_DST_PORT: COL_DST_PORT,
+	IE_DST_IPV4: COL_DST_IP,
+	IE_SRC_IPV6: COL_SRC_IP,
+	IE_DST_IPV6: COL_DST_IP,
+	IE_LAST_UPTIME: IE_LAST_UPTIME,
+	IE_FIRST_UPTIME: IE_FIRST_UPTIME,
+	IE_START_SECONDS: IE_START_SECONDS,
+	IE_END_SECONDS: IE_END_SECONDS,
+	IE_START_MILLISECONDS: IE_START_MILLISECONDS,
+	IE_END_MILLISECONDS: IE_END_MILLISECONDS,
+	IE_SYSTEM_INIT_MILLISECONDS: IE_SYSTEM_INIT_MILLISECONDS
+}
+
+# struct formats of unsigned integers by length
+UINT_FORMATS = { 1: "B", 2: "H", 4: "I", 8: "Q" }
+
+class DecodeError(Exception):
+	pass
+
+def to_int(data):
+	return int(binascii.hexlify(data) or "0", 16)
+
+def to_ipv6(data):
+	return socket.inet_ntop(socket.AF_INET6, data)
+
+def uptime_to_unix(uptime, sys_uptime, unix_msecs):
+	"""Convert a system uptime in milliseconds into a unix timestamp in seconds.
+	The uptime counter of the exporter wraps around after 49.7 days.
+	"""
+	if uptime > sys_uptime:
+		uptime -= 1 << 32
+	return (unix_msecs - sys_uptime + uptime) // 1000
+
+class Template:
+	def __init__(self, fields, options=False):
+		"""
+		:Parameters:
+		 - `fields`: A list of (element id, length) pairs.
+		 - `options`: Whether the records describe the exporter instead of flows.
+		"""
+		self.fields = fields
+		self.options = options
+		self.variable = False
+		self.columns = []
+		self.converters = []
+
+		fmt = "!"
+		for ie, length in fields:
+			if length == VARIABLE_LENGTH:
+				self.variable = True
+			elif ie not in FIELD_COLUMNS:
+				fmt += "%ix" % (length)
+			elif length in UINT_FORMATS and ie not in (IE_SRC_IPV6, IE_DST_IPV6):
+				fmt += UINT_FORMATS[length]
+				self.columns.append(FIELD_COLUMNS[ie])
+				self.converters.append(None)
+			else:
+				fmt += "%is" % (length)
+				self.columns.append(FIELD_COLUMNS[ie])
+				if ie in (IE_SRC_IPV6, IE_DST_IPV6) and length == 16:
+					self.converters.append(to_ipv6)
+				else:
+					self.converters.append(to_int)
+
+		if not self.variable:
+			self.record = struct.Struct(fmt)
+			self.convert = [(i, c) for i, c in enumerate(self.converters) if c != None]
+			if self.record.size == 0:
+				raise DecodeError("Template without fields")
+
+	def decodeRecords(self, data, offset, end):
+		"""Decode all records of a data set.
+		Returns a list of dictionaries with the decoded fields.
+		"""
+		if self.variable:
+			return self.decodeVariableRecords(data, offset, end)
+
+		records = []
+		size = self.record.size
+		columns = self.columns
+		# the remaining bytes are padding
+		while offset + size <= end:
+			values = self.record.unpack_from(data, offset)
+			offset += size
+			if len(self.convert) > 0:
+				values = list(values)
+				for i, c in self.convert:
+					values[i] = c(values[i])
+			records.append(dict(zip(columns, values)))
+		return records
+
+	def decodeVariableRecords(self, data, offset, end):
+		records = []
+		# padding is shorter than the smallest possible record
+		min_size = sum([l for ie, l in self.fields if l != VARIABLE_LENGTH]) + \
+			len([l for ie, l in self.fields if l == VARIABLE_LENGTH])
+		while offset + min_size <= end:
+			record = {}
+			for ie, length in self.fields:
+				if length == VARIABLE_LENGTH:
+					if offset + 1 > end:
+						raise DecodeError("Truncated variable length field")
+					length = UINT8.unpack_from(data, offset)[0]
+					offset += 1
+					if length == 255:
+						if offset + 2 > end:
+							raise DecodeError("Truncated variable length field")
+						length = UINT16.unpack_from(data, offset)[0]
+						offset += 2
+				if offset + length > end:
+					raise DecodeError("Truncated record")
+				if ie in FIELD_COLUMNS:
+					value = data[offset:offset + length]
+					if ie in (IE_SRC_IPV6, IE_DST_IPV6) and length == 16:
+						value = to_ipv6(value)
+					else:
+						value = to_int(value)
+					record[FIELD_COLUMNS[ie]] = value
+				offset += length
+			records.append(record)
+		return records
+
+class Decoder:
+	def __init__(self):
+		# templates by (exporter, version, observation domain, template id)
+		self.templates = {}
+
+		self.num_packets = 0
+		self.num_records = 0
+		self.num_templates = 0
+		self.num_malformed = 0
+		self.num_unknown_sets = 0
+		self.num_no_address = 0
+
+	def decode(self, data, exporter):
+		"""Decode an export packet into a list of flows.
+		Malformed packets, data sets of unknown templates and records
+		without addresses are counted and skipped.
+
+		:Parameters:
+		 - `data`: The payload of the UDP packet.
+		 - `exporter`: The address of the exporter.
+		"""
+		self.num_packets += 1
+		try:
+			if len(data) < 2:
+				raise DecodeError("Packet too short")
+			version = UINT16.unpack_from(data, 0)[0]
+			if version == VERSION_V5:
+				flows = self.decodeV5(data)
+			elif version == VERSION_V9:
+				flows = self.decodeV9(data, exporter)
+			elif version == VERSION_IPFIX:
+				flows = self.decodeIPFIX(data, exporter)
+			else:
+				raise DecodeError("Unknown version %i" % (version))
+		except (DecodeError, struct.error, ValueError):
+			self.num_malformed += 1
+			return []
+
+		self.num_records += len(flows)
+		return flows
+
+	def decodeV5(self, data):
+		if len(data) < V5_HEADER.size:
+			raise DecodeError("Truncated header")
+		version, count, sys_uptime, unix_secs, unix_nsecs, seq, engine_type, engine_id, sampling = V5_HEADER.unpack_from(data, 0)
+		if len(data) < V5_HEADER.size + count * V5_RECORD.size:
+			raise DecodeError("Truncated records")
+
+		unix_msecs = unix_secs * 1000 + unix_nsecs // 1000000
+		flows = []
+		offset = V5_HEADER.size
+		for i in xrange(count):
+			(src_ip, dst_ip, nexthop, input, output, pkts, octets, first, last,
+				src_port, dst_port, pad1, tcp_flags, proto, tos, src_as, dst_as,
+				src_mask, dst_mask, pad2) = V5_RECORD.unpack_from(data, offset)
+			offset += V5_RECORD.size
+			flows.append({
+				COL_SRC_IP: src_ip,
+				COL_DST_IP: dst_ip,
+				COL_SRC_PORT: src_port,
+				COL_DST_PORT: dst_port,
+				COL_PROTO: proto,
+				COL_PKTS: pkts,
+				COL_BYTES: octets,
+				COL_FIRST_SWITCHED: uptime_to_unix(first, sys_uptime, unix_msecs),
+				COL_LAST_SWITCHED: uptime_to_unix(last, sys_uptime, unix_msecs)
+			})
+		return flows
+
+	def decodeV9(self, data, exporter):
+		if len(data) < V9_HEADER.size:
+			raise DecodeError("Truncated header")
+		version, count, sys_uptime, unix_secs, seq, source_id = V9_HEADER.unpack_from(data, 0)
+		return self.decodeSets(data, V9_HEADER.size, len(data), (exporter, version, source_id),
+			sys_uptime, unix_secs * 1000)
+
+	def decodeIPFIX(self, data, exporter):
+		if len(data) < IPFIX_HEADER.size:
+			raise DecodeError("Truncated header")
+		version, length, export_time, seq, domain_id = IPFIX_HEADER.unpack_from(data, 0)
+		if length > len(data) or length < IPFIX_HEADER.size:
+			raise DecodeError("Invalid message length")
+		return self.decodeSets(data, IPFIX_HEADER.size, length, (exporter, version, domain_id),
+			None, export_time * 1000)
+
+	def decodeSets(self, data, offset, end, domain, sys_uptime, export_msecs):
+		"""Decode the flow sets of a NetFlow v9 or the sets of an IPFIX message.
+
+		:Parameters:
+		 - `domain`: The (exporter, version, observation domain) the templates belong to.
+		 - `sys_uptime`: The uptime of a NetFlow v9 exporter in milliseconds or None for IPFIX.
+		 - `export_msecs`: The export time in milliseconds.
+		"""
+		flows = []
+		while offset + SET_HEADER.size <= end:
+			set_id, length = SET_HEADER.unpack_from(data, offset)
+			if length < SET_HEADER.size or offset + length > end:
+				raise DecodeError("Invalid set length")
+			set_end = offset + length
+			offset += SET_HEADER.size
+
+			if set_id == V9_TEMPLATE_SET or set_id == IPFIX_TEMPLATE_SET:
+				self.decodeTemplates(data, offset, set_end, domain, set_id == IPFIX_TEMPLATE_SET)
+			elif set_id == V9_OPTIONS_SET:
+				self.decodeV9OptionsTemplates(data, offset, set_end, domain)
+			elif set_id == IPFIX_OPTIONS_SET:
+				self.decodeIPFIXOptionsTemplates(data, offset, set_end, domain)
+			elif set_id >= MIN_DATA_SET:
+				template = self.templates.get(domain + (set_id,), None)
+				if template == None:
+					self.num_unknown_sets += 1
+				elif not template.options:
+					for record in template.decodeRecords(data, offset, set_end):
+						# the flows are aggregated and indexed by their addresses
+						if COL_SRC_IP not in record or COL_DST_IP not in record:
+							self.num_no_address += 1
+							continue
+						flows.append(self.finishRecord(record, sys_uptime, export_msecs))
+			offset = set_end
+		return flows
+
+	def readFields(self, data, offset, end, count, enterprise):
+		fields = []
+		for i in xrange(count):
+			if offset + FIELD.size > end:
+				raise DecodeError("Truncated template")
+			ie, length = FIELD.unpack_from(data, offset)
+			offset += FIELD.size
+			if enterprise and ie & ENTERPRISE_BIT:
+				# enterprise specific elements are skipped, so their id must not
+				# be mistaken for one of the standard elements
+				offset += UINT32.size
+				ie = None
+			fields.append((ie, length))
+		if offset > end:
+			raise DecodeError("Truncated template")
+		return fields, offset
+
+	def decodeTemplates(self, data, offset, end, domain, enterprise):
+		while offset + 4 <= end:
+			template_id, count = FIELD.unpack_from(data, offset)
+			offset += 4
+			if count == 0:
+				# IPFIX template withdrawal
+				self.templates.pop(domain + (template_id,), None)
+				continue
+			fields, offset = self.readFields(data, offset, end, count, enterprise)
+			self.templates[domain + (template_id,)] = Template(fields)
+			self.num_templates += 1
+
+	def decodeV9OptionsTemplates(self, data, offset, end, domain):
+		while offset + 6 <= end:
+			template_id, scope_length, option_length = struct.unpack_from("!HHH", data, offset)
+			offset += 6
+			count = (scope_length + option_length) // FIELD.size
+			if count == 0:
+				break
+			fields, offset = self.readFields(data, offset, end, count, False)
+			self.templates[domain + (template_id,)] = Template(fields, True)
+			self.num_templates += 1
+
+	def decodeIPFIXOptionsTemplates(self, data, offset, end, domain):
+		while offset + 6 <= end:
+			template_id, count, scope_count = struct.unpack_from("!HHH", data, offset)
+			offset += 6
+			if count == 0:
+				break
+			fields, offset = self.readFields(data, offset, end, count, True)
+			self.templates[domain + (template_id,)] = Template(fields, True)
+			self.num_templates += 1
+
+	def finishRecord(self, record, sys_uptime, export_msecs):
+		"""Convert the timestamps of a decoded record into unix seconds.
+		"""
+		first = last = None
+		if IE_START_SECONDS in record:
+			first = record.pop(IE_START_SECONDS)
+		if IE_END_SECONDS in record:
+			last = record.pop(IE_END_SECONDS)
+		if IE_START_MILLISECONDS in record:
+			first = record.pop(IE_START_MILLISECONDS) // 1000
+		if IE_END_MILLISECONDS in record:
+			last = record.pop(IE_END_MILLISECONDS) // 1000
+
+		# uptime based timestamps are relative to the uptime in the NetFlow v9
+		# header or to the system init time of an IPFIX exporter
+		init = record.pop(IE_SYSTEM_INIT_MILLISECONDS, None)
+		first_uptime = record.pop(IE_FIRST_UPTIME, None)
+		last_uptime = record.pop(IE_LAST_UPTIME, None)
+		if sys_uptime != None:
+			if first == None and first_uptime != None:
+				first = uptime_to_unix(first_uptime, sys_uptime, export_msecs)
+			if last == None and last_uptime != None:
+				last = uptime_to_unix(last_uptime, sys_uptime, export_msecs)
+		elif init != None:
+			if first == None and first_uptime != None:
+				first = (init + first_uptime) // 1000
+			if last == None and last_uptime != None:
+				last = (init + last_uptime) // 1000
+
+		# flows without timestamps are put at the export time
+		if last == None:
+			last = export_msecs // 1000
+		if first == None or first > last:
+			first = last
+		record[COL_FIRST_SWITCHED] = first
+		record[COL_LAST_SWITCHED] = last
+
+		record.setdefault(COL_PKTS, 0)
+		record.setdefault(COL_BYTES, 0)
+		return record
+
+	def printReport(self):
+		print "NetFlow/IPFIX decoder:"
+		print "Packets: %i" % (self.num_packets)
+		print "Records: %i" % (self.num_records)
+		print "Templates: %i" % (self.num_templates)
+		print "Malformed packets: %i" % (self.num_malformed)
+		print "Sets without template: %i" % (self.num_unknown_sets)
+		print "Records without addresses: %i" % (self.num_no_address)
+		print ""
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Move the documents of the bucket collections into the partitions of the
+configured partition sizes (config.flow_partition_sizes).
+
+Needed for databases created before the collections were partitioned or
+after a partition size has been changed. Documents which already exist in
+the target partition are merged.
+Stop all preprocess.py instances before running the migration!
+"""
+
+import sys
+import os.path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'config'))
+
+import argparse
+import datetime
+import pymongo
+
+import config
+from flowhandlers import PartitionedCollection, DB_FLOW_PREFIX, DB_FLOW_AGGR_PREFIX, DB_TOPK_PREFIX
+from flowhandlers import get_cubes, get_cube_collection, get_prefix_lengths, get_prefix_collection, get_partition_size, get_net_values
+
+parser = argparse.ArgumentParser(description="Move the documents of the bucket collections into their partitions.")
+parser.add_argument("--dst-host", nargs="?", default=config.db_host, help="MongoDB host")
+parser.add_argument("--dst-port", nargs="?", default=config.db_port, type=int, help="MongoDB port")
+parser.add_argument("--dst-database", nargs="?", default=config.db_name, help="MongoDB database name")
+parser.add_argument("--batch-size", nargs="?", default=1000, type=int, help="Number of documents per bulk write")
+
+args = parser.parse_args()
+
+def move(source, target, start, end):
+	"""Upsert the documents of a collection outside of [start, end) into their partitions.
+	Returns the number of moved documents.
+	"""
+	num = 0
+	bulks = dict()
+	for doc in source.find().batch_size(args.batch_size):
+		if start <= doc["bucket"] < end:
+			continue
+
+		update = { "$set": {}, "$inc": {} }
+		for k, v in doc.iteritems():
+			if k in config.flow_aggr_sums or k == "flows":
+				update["$inc"][k] = v
+			elif k == "distinct":
+				# HyperLogLog registers keep the larger rank
+				for name, registers in v.iteritems():
+					for r, rank in registers.iteritems():
+						update.setdefault("$max", {})["distinct.%s.%s" % (name, r)] = rank
+			elif k != "_id":
+				update["$set"][k] = v
+
+		collection = target.get(doc["bucket"])
+		# unordered bulk operations are available since pymongo 2.7
+		if hasattr(collection.__class__, "initialize_unordered_bulk_op"):
+			bulk, size = bulks.get(collection.name, (None, 0))
+			if bulk == None:
+				bulk = collection.initialize_unordered_bulk_op()
+			bulk.find({ "_id": doc["_id"] }).upsert().update(update)
+			size += 1
+			if size >= args.batch_size:
+				bulk.execute()
+				bulk, size = None, 0
+			bulks[collection.name] = (bulk, size)
+		else:
+			collection.update({ "_id": doc["_id"] }, update, True)
+		num += 1
+
+	for bulk, size in bulks.itervalues():
+		if bulk != None:
+			bulk.execute()
+	return num
+
+try:
+	dst_conn = pymongo.Connection(args.dst_host, args.dst_port)
+except pymongo.errors.AutoReconnect, e:
+	print >> sys.stderr, "Could not connect to MongoDB database!"
+	sys.exit(1)
+
+dst_db = dst_conn[args.dst_database]
+collection_names = dst_db.collection_names()
+
+startTime = datetime.datetime.now()
+print "%s: Migration started." % (startTime)
+
+for s in config.flow_bucket_sizes:
+	width = get_partition_size(s)
+	names = [DB_FLOW_PREFIX + str(s), DB_FLOW_AGGR_PREFIX + str(s)]
+	names += [get_cube_collection(fields, s) for fields in get_cubes()]
+	net_names = [get_prefix_collection(length, s) for length, length6 in get_prefix_lengths()]
+	names += net_names
+	# the top-k summaries have unique ids, so they are moved unchanged
+	names.append(DB_TOPK_PREFIX + str(s))
+	for name in names:
+		indexes = []
+		if name in net_names:
+			indexes = get_net_values()
+		target = PartitionedCollection(dst_db, name, width, indexes)
+
+		# the single collection and the partitions of any size
+		sources = []
+		if name in collection_names:
+			sources.append((None, dst_db[name]))
+		sources += PartitionedCollection(dst_db, name, 1).getPartitions()
+
+		for start, source in sources:
+			if start == None and width == 0 or start != None and width > 0 and start % width == 0:
+				# a collection which is kept only loses the documents of other partitions
+				end = width > 0 and start + width or sys.maxint
+				num = move(source, target, start or 0, end)
+				if num > 0:
+					source.remove({ "$or": [{ "bucket": { "$lt": start or 0 } }, { "bucket": { "$gte": end } }] })
+			else:
+				num = move(source, target, 0, 0)
+				source.drop()
+			if num > 0:
+				print "%s: %i documents moved" % (source.name, num)
+
+endTime = datetime.datetime.now()
+print "%s: Migration finished in %s." % (endTime, endTime - startTime)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compiled table of known port numbers.
+
+The IANA service name and port number registry is compiled into a bitmap
+with one byte per port and one bit per protocol (tcp, udp and others).
+The bitmap is cached in a binary file next to the XML file and only
+rebuilt if the XML file changes. A port is known for a protocol if
+`bitmap[port] & PROTO_MASKS[proto]` is not zero.
+"""
+
+import os
+import struct
+from xml.etree import cElementTree as ElementTree
+
+NUM_PORTS = 65536
+
+# bits of the protocols in the bitmap, all protocols other
+# than tcp and udp are registered as protocol 0
+PROTO_BITS = { 0: 1, 6: 2, 17: 4 }
+ANY = 1 | 2 | 4
+
+# bits to test for each IP protocol of a flow, protocol -1 (no protocol)
+# matches every known port and protocols without a bit match none, the
+# table is complete so the lookup needs no default
+PROTO_MASKS = dict((proto, PROTO_BITS.get(proto, 0)) for proto in xrange(256))
+PROTO_MASKS[-1] = ANY
+
+# magic, mtime and size of the XML file
+CACHE_HEADER = struct.Struct("<4sdq")
+CACHE_MAGIC = "FIP1"
+
+XML_NAMESPACE = "{http://www.iana.org/assignments}"
+
+def get_text(elem):
+	"""Get the text of an element without the text of its children.
+	"""
+	rc = [elem.text or ""]
+	for child in elem:
+		rc.append(child.tail or "")
+	return "".join(rc)
+
+def parse_ports_file(filename):
+	"""Parse the IANA XML file into a bitmap of known ports.
+	"""
+	bitmap = bytearray(NUM_PORTS)
+
+	for event, record in ElementTree.iterparse(filename):
+		if record.tag != XML_NAMESPACE + "record":
+			continue
+
+		description = record.find(XML_NAMESPACE + "description")
+		number = record.find(XML_NAMESPACE + "number")
+		if description != None and get_text(description) != "Unassigned" and number != None:
+			numbers = get_text(number).split('-')
+			number = int(numbers[0])
+			number_to = int(numbers[len(numbers)-1])
+
+			protocol = record.find(XML_NAMESPACE + "protocol")
+			if protocol != None:
+				protocol = get_text(protocol)
+				if protocol == "tcp":
+					protocol = 6
+				elif protocol == "udp":
+					protocol = 17
+				else:
+					protocol = 0
+			else:
+				protocol = 0
+
+			while number <= number_to:
+				bitmap[number] |= PROTO_BITS[protocol]
+				number += 1
+
+		# keep memory low
+		record.clear()
+
+	return bitmap
+
+def load_known_ports(filename):
+	"""Load the known ports from the cache file or compile the XML file if it has changed.
+	Returns a bytearray with the protocol bits of every port.
+	"""
+	cache_filename = os.path.splitext(filename)[0] + ".bin"
+	stat = os.stat(filename)
+
+	try:
+		f = open(cache_filename, "rb")
+		header = f.read(CACHE_HEADER.size)
+		bitmap = bytearray(f.read())
+		f.close()
+
+		if len(header) == CACHE_HEADER.size and len(bitmap) == NUM_PORTS:
+			magic, mtime, size = CACHE_HEADER.unpack(header)
+			if magic == CACHE_MAGIC and mtime == stat.st_mtime and size == stat.st_size:
+				return bitmap
+	except IOError:
+		pass
+
+	bitmap = parse_ports_file(filename)
+
+	# write the cache atomically, a read-only config directory is no error
+	try:
+		f = open(cache_filename + ".tmp", "wb")
+		f.write(CACHE_HEADER.pack(CACHE_MAGIC, stat.st_mtime, stat.st_size))
+		f.write(bitmap)
+		f.close()
+		os.rename(cache_filename + ".tmp", cache_filename)
+	except (IOError, OSError):
+		pass
+
+	return bitmap
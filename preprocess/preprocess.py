@@ -7,6 +7,8 @@ Keep this script running forever if you want live data:
 nohup ./preprocess.py
 
 It is save to run multiple instances of this script!
+Instances on the same host need a different --worker-id, an instance
+refuses to start while another one owns the processing list of its id.
 
 Author: Mario Volke
 """
@@ -15,19 +17,31 @@ import sys
 import os.path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'config'))
 
-import math
 import time
+import errno
+import socket
+import signal
 import threading
+import multiprocessing
+import Queue
 import argparse
 import datetime
 import redis
 import json
+import csv
 import pymongo
-import bson
-import xml.dom.minidom
 from collections import deque
 
 import config
+import ports
+import flowrecords
+import flowhandlers
+import subnets
+import backfill
+from flowhandlers import FlowPipeline, publish_horizon
+from flowhandlers import DB_FLOW_PREFIX, DB_TOPK_PREFIX, DB_INDEX_NODES, DB_INDEX_PORTS, DB_BUCKET_CATALOGUE, DB_HORIZON
+from flowhandlers import COL_FIRST_SWITCHED, COL_LAST_SWITCHED, COL_SRC_IP, COL_DST_IP, COL_SRC_PORT, COL_DST_PORT
+from flowhandlers import SHARD_FLOW, SHARD_SRC_NODE, SHARD_DST_NODE, SHARD_SRC_PORT, SHARD_DST_PORT, SHARD_ALL
 
 parser = argparse.ArgumentParser(description="Import IPFIX flows from MySQL or PostgreSQL Vermont format into MongoDB.")
 parser.add_argument("--src-host", nargs="?", default="127.0.0.1", help="Redis host")
@@ -36,433 +50,783 @@ parser.add_argument("--src-database", nargs="?", default=0, type=int, help="Redi
 parser.add_argument("--dst-host", nargs="?", default=config.db_host, help="MongoDB host")
 parser.add_argument("--dst-port", nargs="?", default=config.db_port, type=int, help="MongoDB port")
 parser.add_argument("--dst-database", nargs="?", default=config.db_name, help="MongoDB database name")
+parser.add_argument("--batch-size", nargs="?", default=config.pre_queue_batch_size, type=int, help="Number of queue entries to dequeue at once (0 dequeues single entries without acknowledgement)")
+parser.add_argument("--worker-id", nargs="?", default=socket.gethostname(), help="Unique name of this instance for its processing list (defaults to the hostname, instances on the same host need different ids)")
+parser.add_argument("--engine", nargs="?", default="python", choices=["python", "numpy"], help="Slice flows one by one in Python or in batches with NumPy")
+parser.add_argument("--workers", nargs="?", default=0, type=int, help="Number of worker processes (0 processes all flows in this process)")
 parser.add_argument("--clear-database", nargs="?", type=bool, default=False, const=True, help="Whether to clear the whole databse before importing any flows.")
+parser.add_argument("--from-file", nargs="?", help="Rebuild the database from a JSONL or CSV (.csv) file of flows instead of the Redis queue")
+parser.add_argument("--from-sql", nargs="?", type=bool, default=False, const=True, help="Rebuild the database from a MySQL or PostgreSQL Vermont database instead of the Redis queue")
+parser.add_argument("--sql-host", nargs="?", default="127.0.0.1", help="MySQL or PostgreSQL host")
+parser.add_argument("--sql-port", nargs="?", type=int, help="MySQL or PostgreSQL port")
+parser.add_argument("--sql-user", nargs="?", default="root", help="MySQL or PostgreSQL user")
+parser.add_argument("--sql-password", nargs="?", default="", help="MySQL or PostgreSQL password")
+parser.add_argument("--sql-database", nargs="?", default="flows", help="MySQL or PostgreSQL database name")
+parser.add_argument("--fetch-size", nargs="?", type=int, default=5000, help="Number of rows fetched from the SQL database at once")
 
 args = parser.parse_args()
 
+if args.engine == "numpy" and flowhandlers.numpy == None:
+	print >> sys.stderr, "The numpy engine requires NumPy!"
+	sys.exit(1)
+	
+backfill_mode = args.from_file != None or args.from_sql
+if backfill_mode and args.workers > 0:
+	print >> sys.stderr, "The backfill mode does not support worker processes!"
+	sys.exit(1)
+
 # Print output every ... in seconds
 OUTPUT_INTERVAL = 10
 
-# flow time interval column names
-COL_FIRST_SWITCHED = "firstSwitched"
-COL_LAST_SWITCHED = "lastSwitched"
-# column names of IP addresses
-COL_SRC_IP = "srcIP"
-COL_DST_IP = "dstIP"
-# column names of ports and protocol
-COL_SRC_PORT = "srcPort"
-COL_DST_PORT = "dstPort"
-COL_PROTO = "proto"
-
-# the collection prefix to use for flows
-DB_FLOW_PREFIX = "flows_"
-# the collection prefix to use for completely aggregated flows
-DB_FLOW_AGGR_PREFIX = "flows_aggr_"
-# the collection to use for the node index
-DB_INDEX_NODES = "index_nodes"
-# the collection to use for the port index
-DB_INDEX_PORTS = "index_ports"
-
 # the xml file containing known port numbers
 PORTS_FILE = os.path.join(os.path.dirname(__file__), '..', 'config', 'service-names-port-numbers.xml')
 
 REDIS_QUEUE_KEY = "entry:queue"
+# the prefix of the per instance list of dequeued but unacknowledged entries
+REDIS_PROCESSING_PREFIX = "entry:processing:"
+# the suffix of the key storing the last checkpoint of the processing list
+REDIS_CHECKPOINT_SUFFIX = ":checkpoint"
+# the suffix of the key naming the instance which owns the processing list
+REDIS_OWNER_SUFFIX = ":owner"
+# the owner key expires ... seconds after the last checkpoint
+REDIS_OWNER_TIMEOUT = config.pre_queue_ack_interval + 5*60
+
+# Moves up to ARGV[1] entries from the queue to the processing list
+DEQUEUE_SCRIPT = """
+local entries = redis.call('LRANGE', KEYS[1], 0, ARGV[1] - 1)
+if #entries > 0 then
+	redis.call('LTRIM', KEYS[1], #entries, -1)
+	for i = 1, #entries, 1000 do
+		redis.call('RPUSH', KEYS[2], unpack(entries, i, math.min(i + 999, #entries)))
+	end
+end
+return entries
+"""
+
+# Sets the owner key KEYS[1] to ARGV[1] unless another instance owns it
+# (ARGV[2] is a stopped owner which may be replaced), returns the owner
+CLAIM_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if not owner or owner == ARGV[1] or owner == ARGV[2] then
+	redis.call('SETEX', KEYS[1], ARGV[3], ARGV[1])
+	return ARGV[1]
+end
+return owner
+"""
+
+# Wait ... seconds before polling an empty queue again in batch mode
+QUEUE_POLL_INTERVAL = 0.1
+
+# Maximum number of messages waiting for each worker process
+WORKER_QUEUE_SIZE = 100
+# Number of flows sent to a worker process in one message
+DISPATCH_BATCH_SIZE = 500
+
+# Wake up from waiting on the queue after ... seconds to send lingering bulk batches and index counters
+BLPOP_TIMEOUT = 1
 	
-# Class to handle flows
-class FlowHandler:
-	def __init__(self, bucket_interval, collection, aggr_sum, aggr_values=[], filter_ports=None, cache_size=0):
-		"""
-		:Parameters:
-		 - `bucket_interval`: The bucket interval in seconds.
-		 - `collection`: A pymongo collection to insert the documents.
-		 - `aggr_sum`: A list of keys which will be sliced and summed up.
-		 - `aggr_values`: A list of keys which have to match in order to aggregate two flows
-		 - `filter_ports`: A dictionary of ports and protocols to remove unknown ports
-		"""
-		self.bucket_interval = bucket_interval
-		self.collection = collection
-		self.aggr_sum = aggr_sum
-		self.aggr_values = aggr_values
-		self.filter_ports = filter_ports
-		
-		# init cache
-		self.cache = None
-		self.cache_size = cache_size
-		if cache_size > 0:
-			self.cache = dict()
-			self.cache_queue = deque()
-			
-		# stats
-		self.num_flows = 0
-		self.num_slices = 0
-		self.cache_hits = 0
-		self.cache_misses = 0
-		self.db_requests = 0
-		
-	def get_id(self, bucket, flow):
-		"""Generate a unique id.
-		"""
-		id = str(bucket)
-		for i,col in enumerate(self.aggr_values):
-			id += str(flow.get(col, "x"))
-		return id
+output_flows = 0
+total_flows = 0
+def print_output():
+	global OUTPUT_INTERVAL, output_flows, total_flows, timer
+	total_flows += output_flows
+	print "%s: Processed %i flows within last %i seconds (%.2f flows/s, avg. %.2f flows/s)." % (
+		datetime.datetime.now(), output_flows, OUTPUT_INTERVAL, output_flows / float(OUTPUT_INTERVAL),
+		total_flows / (time.time() - start_time))
+	output_flows = 0
+	timer = threading.Timer(OUTPUT_INTERVAL, print_output)
+	timer.start()
 	
-	def get_bucket(self, timestamp, interval):
-		"""Compute the bucket timestamp.
-		"""
-		return int(timestamp) / int(interval) * int(interval)
+print "%s: Init..." % (datetime.datetime.now())
+
+# init redis connection
+try:
+	r = redis.StrictRedis(host=args.src_host, port=args.src_port, db=args.src_database)
+except Exception, e:
+	print >> sys.stderr, "Could not connect to Redis database: %s" % (e)
+	sys.exit(1)
+
+# init pymongo connection
+try:
+	dst_conn = pymongo.Connection(args.dst_host, args.dst_port)
+except pymongo.errors.AutoReconnect, e:
+	print >> sys.stderr, "Could not connect to MongoDB database!"
+	sys.exit(1)
 	
-	def handleFlow(self, flow):
-		"""Slice a flow from the queue into buckets and insert into MongoDB.
-		"""
+if args.clear_database:
+	dst_conn.drop_database(args.dst_database)
+	
+dst_db = dst_conn[args.dst_database]
+	
+# read ports for special filtering
+known_ports = None
+if config.flow_filter_unknown_ports:
+	load_start = time.time()
+	known_ports = ports.load_known_ports(PORTS_FILE)
+	print "%s: Loaded known ports in %.3f seconds." % (datetime.datetime.now(), time.time() - load_start)
+
+if config.pre_rollup:
+	sizes = config.flow_bucket_sizes
+	for i in range(1, len(sizes)):
+		if sizes[i] % sizes[i-1] != 0:
+			print >> sys.stderr, "Roll-up requires each bucket size to be a multiple of the previous one!"
+			sys.exit(1)
+			
+for fields in config.flow_cubes:
+	unknown = [v for v in fields if v not in config.flow_aggr_values]
+	if len(unknown) > 0:
+		print >> sys.stderr, "The cube %s contains values which are not aggregated: %s" % (",".join(fields), ",".join(unknown))
+		sys.exit(1)
 		
-		self.num_flows += 1
+if config.flow_distinct_precision < 4 or config.flow_distinct_precision > 16:
+	print >> sys.stderr, "The HyperLogLog precision has to be between 4 and 16!"
+	sys.exit(1)
+	
+for fields in config.topk_fields:
+	unknown = [v for v in fields if v not in config.flow_aggr_values]
+	if len(unknown) > 0:
+		print >> sys.stderr, "The top-k summary of %s contains values which are not aggregated: %s" % (",".join(fields), ",".join(unknown))
+		sys.exit(1)
+for v in config.topk_values:
+	if v not in ["flows"] + config.flow_aggr_sums:
+		print >> sys.stderr, "The top-k summaries can only be ranked by flows or the summed up values, not by %s!" % (v)
+		sys.exit(1)
 		
-		carry = dict();
-		emitted = dict();
-		for s in self.aggr_sum:
-			carry[s] = 0
-			emitted[s] = 0
-		bucket = self.get_bucket(flow[COL_FIRST_SWITCHED], self.bucket_interval)
-		while bucket <= flow[COL_LAST_SWITCHED]:
+for length, length6 in config.flow_prefix_lengths.iteritems():
+	if length < 1 or length > 32 or length6 < 1 or length6 > 128:
+		print >> sys.stderr, "The prefix lengths have to be between 1 and 32 for IPv4 and between 1 and 128 for IPv6!"
+		sys.exit(1)
+if len(config.flow_prefix_lengths) > 0 and not (COL_SRC_IP in config.flow_aggr_values or COL_DST_IP in config.flow_aggr_values):
+	print >> sys.stderr, "The prefix aggregation requires the IP addresses in the aggregation values!"
+	sys.exit(1)
+	
+for s in config.flow_bucket_sizes:
+	if config.flow_partition_sizes.get(s, 0) % s != 0:
+		print >> sys.stderr, "The partition size of bucket size %i has to be a multiple of it!" % (s)
+		sys.exit(1)
+	if config.flow_retention.get(s, 0) > 0 and config.flow_partition_sizes.get(s, 0) == 0:
+		print >> sys.stderr, "The retention of bucket size %i requires partitions!" % (s)
+		sys.exit(1)
+			
+if backfill_mode:
+	# the finished documents are inserted, so they must not exist yet
+	existing = [name for name in dst_db.collection_names()
+		if name.startswith(DB_FLOW_PREFIX) or name.startswith(DB_TOPK_PREFIX) or name.startswith(DB_INDEX_NODES)
+		or name in [DB_INDEX_PORTS, DB_BUCKET_CATALOGUE, DB_HORIZON]]
+	if len(existing) > 0:
+		print >> sys.stderr, "The backfill mode requires an empty database (use --clear-database)!"
+		sys.exit(1)
 		
-			self.num_slices += 1
+	# all updates are aggregated before they are inserted
+	backfill_db = backfill.BackfillDatabase(dst_db, config.pre_backfill_max_docs,
+		config.pre_backfill_spill_dir, max(1, config.pre_bulk_size))
+	# the bucket catalogue is updated directly and everything is written by the final flush
+	pipeline = FlowPipeline(backfill_db, known_ports, args.engine, dst_db[DB_BUCKET_CATALOGUE], timeout_interval=0)
+elif args.workers > 0:
+	# the flows are sliced by the worker processes, which publish their own horizon
+	pipeline = None
+else:
+	pipeline = FlowPipeline(dst_db, known_ports, args.engine, name=args.worker_id)
+# indexes of the backfill collections are created after loading
+if pipeline != None:
+	pipeline.createIndexes()
+	
+def restore_rollups(pipeline, prefix=""):
+	"""Restore the open buckets of the coarser bucket sizes a crashed instance
+	has stored at its last checkpoint.
+	"""
+	num = pipeline.restoreRollups()
+	if num > 0:
+		print "%s: %sRestored %i documents of open rolled up buckets." % (datetime.datetime.now(), prefix, num)
 		
-			nextBucket = bucket + self.bucket_interval;
-			bucketStart = bucket
-			if bucketStart < flow[COL_FIRST_SWITCHED]:
-				bucketStart = flow[COL_FIRST_SWITCHED]
-			bucketEnd = nextBucket - 1
-			if bucketEnd > flow[COL_LAST_SWITCHED]:
-				bucketEnd = flow[COL_LAST_SWITCHED]
-			intervalFactor = (bucketEnd - bucketStart + 1) / float(flow[COL_LAST_SWITCHED] - flow[COL_FIRST_SWITCHED] + 1)
+# columns which are aggregated but not contained in binary records
+binary_missing = [c for c in config.flow_aggr_values + config.flow_aggr_sums if c not in flowrecords.RECORD_COLUMNS]
+
+def decode_entry(obj):
+	"""Decode a queue entry into a list of flows.
+	An entry is either a JSON object or a binary batch of records.
+	Returns an empty list if the entry is not valid.
+	"""
+	if flowrecords.is_batch(obj):
+		if len(binary_missing) > 0:
+			print >> sys.stderr, "Binary records in queue do not contain the columns %s!" % (", ".join(binary_missing))
+			return []
+		try:
+			return flowrecords.decode(obj)
+		except ValueError:
+			print >> sys.stderr, "Could not decode binary records in queue!"
+			return []
 			
-			key = self.get_id(bucket, flow)	
+	try:
+		obj = json.loads(obj)
+		obj[COL_FIRST_SWITCHED] = int(obj[COL_FIRST_SWITCHED])
+		obj[COL_LAST_SWITCHED] = int(obj[COL_LAST_SWITCHED])
+		for s in config.flow_aggr_sums:
+			obj[s] = int(obj[s])
+	except ValueError:
+		print >> sys.stderr, "Could not decode JSON object in queue!"
+		return []
+	# IP addresses are routed and aggregated by their normalized value
+	return [subnets.normalize_flow(obj, [COL_SRC_IP, COL_DST_IP])]
+	
+def run_worker(num, queue, done):
+	"""Process the flows routed to this worker until it gets the END message.
+	
+	:Parameters:
+	 - `num`: The number of the worker.
+	 - `queue`: The queue of messages from the dispatcher.
+	 - `done`: The queue to confirm flush, checkpoint and report messages.
+	"""
+	global pipeline
+	
+	# the dispatcher takes care of Ctrl-C
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	parent = os.getppid()
+	
+	# each worker needs its own connection
+	db = pymongo.Connection(args.dst_host, args.dst_port)[args.dst_database]
+	pipeline = FlowPipeline(db, known_ports, args.engine, name="%s:%i" % (args.worker_id, num))
+	pipeline.createIndexes()
+	restore_rollups(pipeline, "Worker %i: " % (num))
+	
+	while True:
+		try:
+			cmd, data = queue.get(True, 1)
+		except Queue.Empty:
+			# the entries of a crashed dispatcher are processed again on restart
+			if os.getppid() != parent:
+				print >> sys.stderr, "Worker %i: The dispatcher died, terminating." % (num)
+				break
+			pipeline.handleTimeouts()
+			continue
 			
-			# check if we hit the cache
-			doc = None
-			if self.cache != None:
-				doc = self.cache.get(key, None)
-				if doc == None:
-					self.cache_misses += 1
-				else:
-					self.cache_hits += 1
-			if doc == None:
-				doc = { "$set": { "bucket": bucket }, "$inc": {} }
+		if cmd == "flows":
+			for obj, shards in data:
+				pipeline.handleFlow(obj, shards)
+		elif cmd == "flush":
+			flush_handlers()
+			done.put(num)
+		elif cmd == "checkpoint":
+			pipeline.advanceTime(data)
+			done.put((num, pipeline.checkpoint()))
+		elif cmd == "replay":
+			pipeline.setReplay(data)
+		elif cmd == "report":
+			print "Worker %i:" % (num)
+			print ""
+			pipeline.printReports()
+			sys.stdout.flush()
+			done.put(num)
+		elif cmd == "end":
+			break
 			
-				# set unknown ports to None
-				if self.filter_ports:
-					for v in self.aggr_values:
-						if v == COL_SRC_PORT or v == COL_DST_PORT:
-							set_value = None
-							value = flow.get(v, None)
-							if value != None and value in self.filter_ports:
-								proto = int(flow.get(COL_PROTO, -1))
-								if proto == -1 or proto in self.filter_ports[value]:
-									set_value = value
-							doc["$set"][v] = set_value
-						else:
-							doc["$set"][v] = flow.get(v, None)
-				else:
-					for v in self.aggr_values:
-						doc["$set"][v] = flow.get(v, None)
-						
-				for s in self.aggr_sum:
-					doc["$inc"][s] = 0
-				doc["$inc"]["flows"] = 0
-				
-				if self.cache != None:
-					# insert into cache
-					self.cache[key] = doc
-					self.cache_queue.append(key)
+class Dispatcher:
+	def __init__(self, num_workers):
+		"""
+		:Parameters:
+		 - `num_workers`: The number of worker processes to start.
+		"""
+		self.done = multiprocessing.Queue()
+		self.queues = []
+		self.workers = []
+		self.pending = []
+		# the latest time of the dispatched flows
+		self.max_time = 0
+		for i in range(num_workers):
+			queue = multiprocessing.Queue(WORKER_QUEUE_SIZE)
+			worker = multiprocessing.Process(target=run_worker, args=(i, queue, self.done))
+			worker.start()
+			self.queues.append(queue)
+			self.workers.append(worker)
+			self.pending.append([])
 			
-			if nextBucket > flow[COL_LAST_SWITCHED]:
-				for s in self.aggr_sum:
-					assert flow.get(s, 0) - emitted[s] >= 0
-					doc["$inc"][s] += flow.get(s, 0) - emitted[s]
-			else:
-				for s in self.aggr_sum:
-					interval = intervalFactor * flow.get(s, 0)
-					num = carry[s] + interval
-					val = int(num)
-					carry[s] = num - val;
-					emitted[s] += val
-					doc["$inc"][s] += val
-					
-			# count number of aggregated flows in the bucket
-			doc["$inc"]["flows"] += intervalFactor
+	def get_worker(self, value):
+		return hash(value) % len(self.workers)
+		
+	def dispatch(self, obj, mask=SHARD_ALL):
+		"""Route the parts of a flow to their workers.
+		
+		:Parameters:
+		 - `obj`: A dictionary containing a flow.
+		 - `mask`: The parts of the flow to route.
+		"""
+		if obj[COL_LAST_SWITCHED] > self.max_time:
+			self.max_time = obj[COL_LAST_SWITCHED]
 			
-			# if caching is actived then insert into cache
-			if self.cache != None:
-				self.handleCache()
-			else:
-				self.updateCollection(key, doc)
+		shards = [0] * len(self.workers)
+		shards[self.get_worker(tuple([obj.get(v, None) for v in config.flow_aggr_values]))] |= SHARD_FLOW
+		shards[self.get_worker(obj.get(COL_SRC_IP, None))] |= SHARD_SRC_NODE
+		shards[self.get_worker(obj.get(COL_DST_IP, None))] |= SHARD_DST_NODE
+		shards[self.get_worker(obj.get(COL_SRC_PORT, None))] |= SHARD_SRC_PORT
+		shards[self.get_worker(obj.get(COL_DST_PORT, None))] |= SHARD_DST_PORT
+		
+		for i, s in enumerate(shards):
+			s &= mask
+			if s > 0:
+				self.pending[i].append((obj, s))
+				if len(self.pending[i]) >= DISPATCH_BATCH_SIZE:
+					self.put(i, ("flows", self.pending[i]))
+					self.pending[i] = []
+					
+	def sendPending(self):
+		for i in range(len(self.queues)):
+			if len(self.pending[i]) > 0:
+				self.put(i, ("flows", self.pending[i]))
+				self.pending[i] = []
 				
-			bucket = nextBucket
+	def put(self, i, msg):
+		"""Send a message to a worker, waits while its queue is full.
+		"""
+		while True:
+			try:
+				return self.queues[i].put(msg, True, 1)
+			except Queue.Full:
+				self.checkWorkers()
+				
+	def flush(self):
+		"""Wait until all workers have written their caches.
+		"""
+		self.sendPending()
+		for i in range(len(self.queues)):
+			self.put(i, ("flush", None))
+		for queue in self.queues:
+			self.wait()
 			
-	def updateCollection(self, key, doc):
-		# bindata will reduce id size by 50%
-		self.collection.update({ "_id": bson.binary.Binary(key) }, doc, True)
-		self.db_requests += 1
+	def checkpoint(self):
+		"""Let the workers write their closed buckets.
+		Returns the horizon of each bucket size all workers have reached.
+		"""
+		self.sendPending()
+		for i in range(len(self.queues)):
+			self.put(i, ("checkpoint", self.max_time))
+		horizons = dict()
+		for queue in self.queues:
+			num, worker_horizons = self.wait()
+			for s, horizon in worker_horizons.iteritems():
+				horizons[s] = min(horizon, horizons.get(s, horizon))
+		return horizons
 		
-	def handleCache(self, clear=False):
-		if not self.cache:
-			return
+	def setReplay(self, horizons):
+		"""Let the workers skip the buckets written before a restart (None stops skipping).
+		"""
+		self.sendPending()
+		for i in range(len(self.queues)):
+			self.put(i, ("replay", horizons))
 			
-		while (clear and len(self.cache_queue) > 0) or len(self.cache_queue) > self.cache_size:
-			key = self.cache_queue.popleft()
-			doc = self.cache[key]
-			self.updateCollection(key, doc)
-			del self.cache[key]
+	def report(self):
+		"""Let the workers print their reports one after another.
+		"""
+		for i in range(len(self.queues)):
+			self.put(i, ("report", None))
+			self.wait()
 			
-	def printReport(self):
-		print "%s report:" % (self.collection.name)
-		print "-----------------------------------"
-		print "Flows processed: %i" % (self.num_flows)
-		print "Slices overall: %i (avg. %.2f per flow)" % (self.num_slices, self.num_slices / float(self.num_flows))
-		print "Database requests: %i" % (self.db_requests)
-		
-		if self.cache != None:
-			print "Cache hit ratio: %.2f%%" % (self.cache_hits / float(self.cache_hits + self.cache_misses) * 100)
+	def wait(self):
+		"""Wait for the confirmation of one worker.
+		"""
+		while True:
+			try:
+				return self.done.get(True, 1)
+			except Queue.Empty:
+				self.checkWorkers()
+				
+	def checkWorkers(self):
+		"""Exit if a worker process died. The other workers are stopped without
+		writing their caches, the unacknowledged entries are processed again on restart.
+		"""
+		for worker in self.workers:
+			if not worker.is_alive():
+				print >> sys.stderr, "Worker process %i died!" % (worker.pid)
+				for other in self.workers:
+					if other.is_alive():
+						other.terminate()
+				# the output timer would keep the process alive
+				os._exit(1)
+				
+	def terminate(self):
+		for i in range(len(self.queues)):
+			self.put(i, ("end", None))
+		for worker in self.workers:
+			worker.join()
+			
+def handle_entry(obj, shards=SHARD_ALL):
+	"""Decode a queue entry and slice the flows into the buckets.
+	Returns the latest lastSwitched of its flows or None if it has none.
+	
+	:Parameters:
+	 - `obj`: The queue entry.
+	 - `shards`: The parts of the flows to process.
+	"""
+	global output_flows
+	
+	last = None
+	flows = decode_entry(obj)
+	for flow in flows:
+		if dispatcher != None:
+			dispatcher.dispatch(flow, shards)
 		else:
-			print "Cache deactivated"
+			pipeline.handleFlow(flow, shards)
+		if last == None or flow[COL_LAST_SWITCHED] > last:
+			last = flow[COL_LAST_SWITCHED]
 			
-		print ""
+	output_flows += len(flows)
+	return last
+	
+def flush_handlers():
+	"""Write all cached and batched documents to MongoDB.
+	"""
+	if dispatcher != None:
+		dispatcher.flush()
+		return
 		
-def update_node_index(obj, collection, aggr_sum):
-	"""Update the node index collection in MongoDB with the current flow.
+	pipeline.flush()
+	
+def is_written(last, horizons):
+	"""Returns whether all buckets of a queue entry end before the horizons.
+	With roll-ups only the smallest bucket size is sliced from the flows, the
+	open buckets of the coarser ones are restored from the rollup state.
 	
 	:Parameters:
-	 - `obj`: A dictionary containing a flow.
-	 - `collection`: A pymongo collection to insert the documents.
-	 - `aggr_sum`: A list of keys which will be sliced and summed up.
+	 - `last`: The latest lastSwitched of the entry (None if it has no flows).
+	 - `horizons`: The horizon of each bucket size.
 	"""
+	if last == None:
+		return True
+	for s, horizon in horizons.iteritems():
+		if config.pre_rollup and s != config.flow_bucket_sizes[0]:
+			continue
+		if last - last % s + s > horizon:
+			return False
+	return True
 	
-	# update source node
-	doc = { "$inc": {} }
+def checkpoint_entries():
+	"""Write the closed buckets and acknowledge the processed entries whose buckets
+	have all been written. The horizons are stored with the number of processed
+	entries which are left, so their written buckets are skipped if they are
+	processed again after a crash.
+	"""
+	keep_owner()
+	if dispatcher != None:
+		horizons = dispatcher.checkpoint()
+	else:
+		horizons = pipeline.checkpoint()
+		
+	num = 0
+	while len(pending) > 0 and is_written(pending[0], horizons):
+		pending.popleft()
+		num += 1
+		
+	# MULTI/EXEC keeps the processing list and its checkpoint consistent
+	pipe = r.pipeline()
+	pipe.ltrim(processing_key, num, -1)
+	pipe.set(checkpoint_key, json.dumps({ "entries": len(pending), "horizons": horizons.items() }))
+	pipe.execute()
 	
-	for s in aggr_sum:
-		doc["$inc"][s] = obj.get(s, 0)
-		doc["$inc"]["src." + s] = obj.get(s, 0)
-	doc["$inc"]["flows"] = 1
-	doc["$inc"]["src.flows"] = 1
+def ack_entries():
+	"""Write all buckets and acknowledge the processed entries on shutdown.
+	The entries after them are put back to the head of the queue (the rest of
+	the current batch or the entries moved by a dequeue call which has been interrupted).
+	"""
+	keep_owner()
+	flush_handlers()
 	
-	# insert if not exists, else update sums
-	collection.update({ "_id": obj[COL_SRC_IP] }, doc, True)
+	unprocessed = r.lrange(processing_key, len(pending), -1)
 	
-	# update destination node
-	doc = { "$inc": {} }
+	# MULTI/EXEC makes sure no entry gets lost in between
+	pipe = r.pipeline()
+	for obj in reversed(unprocessed):
+		pipe.lpush(REDIS_QUEUE_KEY, obj)
+	pipe.delete(processing_key, checkpoint_key, owner_key)
+	pipe.execute()
+	pending.clear()
 	
-	for s in aggr_sum:
-		doc["$inc"][s] = obj.get(s, 0)
-		doc["$inc"]["dst." + s] = obj.get(s, 0)
-	doc["$inc"]["flows"] = 1
-	doc["$inc"]["dst.flows"] = 1
+def is_stopped(owner):
+	"""Returns whether the owner of a processing list is a process on this host which has exited.
+	"""
+	host, sep, pid = owner.rpartition(":")
+	if host != socket.gethostname() or not pid.isdigit():
+		return False
+	try:
+		os.kill(int(pid), 0)
+	except OSError, e:
+		return e.errno == errno.ESRCH
+	return False
 	
-	# insert if not exists, else update sums
-	collection.update({ "_id": obj[COL_DST_IP] }, doc, True)
+def claim_owner():
+	"""Claim the processing list for this instance. A crashed owner on this
+	host is replaced at once, the owner key of another host has to expire.
+	Returns the owner of the list.
+	"""
+	owner = claim(keys=[owner_key], args=[owner_id, "", REDIS_OWNER_TIMEOUT])
+	if owner != owner_id and is_stopped(owner):
+		owner = claim(keys=[owner_key], args=[owner_id, owner, REDIS_OWNER_TIMEOUT])
+	return owner
 	
-def update_port_index(obj, collection, aggr_sum, filter_ports):
-	"""Update the port index collection in MongoDB with the current flow.
+def keep_owner():
+	"""Refresh the owner key of the processing list. Exits without writing
+	anything if another instance has taken the list over after the key expired.
+	"""
+	owner = claim(keys=[owner_key], args=[owner_id, "", REDIS_OWNER_TIMEOUT])
+	if owner != owner_id:
+		print >> sys.stderr, "%s: The processing list %s has been taken over by %s!" % (datetime.datetime.now(), processing_key, owner)
+		if dispatcher != None:
+			for worker in dispatcher.workers:
+				worker.terminate()
+		# the output timer would keep the process alive
+		os._exit(1)
 	
-	:Parameters:
-	 - `obj`: A dictionary containing a flow.
-	 - `collection`: A pymongo collection to insert the documents.
-	 - `aggr_sum`: A list of keys which will be sliced and summed up.
-	 - `filter_ports`: A dictionary of ports and protocols to remove unknown ports
+def replay_entries():
+	"""Process the entries which a crashed instance with the same worker id left
+	in its processing list. The buckets written before its last checkpoint are skipped.
+	Returns False if one of them is the END flag.
 	"""
+	entries = r.lrange(processing_key, 0, -1)
+	if len(entries) == 0:
+		r.delete(checkpoint_key)
+		return True
+		
+	num_replayed = 0
+	horizons = None
+	checkpoint = r.get(checkpoint_key)
+	if checkpoint != None:
+		checkpoint = json.loads(checkpoint)
+		num_replayed = checkpoint["entries"]
+		horizons = dict(checkpoint["horizons"])
+	print "%s: Processing %i unacknowledged entries (%i of them partly written)." % (datetime.datetime.now(), len(entries), num_replayed)
 	
-	# update source port
-	doc = { "$inc": {} }
-	
-	for s in aggr_sum:
-		doc["$inc"][s] = obj.get(s, 0)
-		doc["$inc"]["src." + s] = obj.get(s, 0)
-	doc["$inc"]["flows"] = 1
-	doc["$inc"]["src.flows"] = 1
-	
-	# set unknown ports to None
-	port = obj.get(COL_SRC_PORT, None)
-	if filter_ports and port != None:
-		if port in filter_ports:
-			proto = int(obj.get(COL_PROTO, -1))
-			if proto >= 0 and not proto in filter_ports[port]:
-				port = None
-		else:
-			port = None
-	
-	# insert if not exists, else update sums
-	collection.update({ "_id": port }, doc, True)
-	
-	# update destination port
-	doc = { "$inc": {} }
-	
-	for s in aggr_sum:
-		doc["$inc"][s] = obj.get(s, 0)
-		doc["$inc"]["dst." + s] = obj.get(s, 0)
-	doc["$inc"]["flows"] = 1
-	doc["$inc"]["dst.flows"] = 1
-	
-	# set unknown ports to None
-	port = obj.get(COL_DST_PORT, None)
-	if filter_ports and port != None:
-		if port in filter_ports:
-			proto = int(obj.get(COL_PROTO, -1))
-			if proto >= 0 and not proto in filter_ports[port]:
-				port = None
-		else:
-			port = None
+	set_replay(horizons)
+	claimed = time.time()
+	for i, obj in enumerate(entries):
+		if i == num_replayed:
+			set_replay(None)
+		if time.time() - claimed >= config.pre_queue_ack_interval:
+			keep_owner()
+			claimed = time.time()
+		pending.append(None)
+		if obj == "END":
+			return False
+		# the index counters of the entries before the checkpoint have been written
+		pending[-1] = handle_entry(obj, SHARD_FLOW if i < num_replayed else SHARD_ALL)
+	set_replay(None)
+	return True
 	
-	# insert if not exists, else update sums
-	collection.update({ "_id": port }, doc, True)
-
-output_flows = 0
-def print_output():
-	global OUTPUT_INTERVAL, output_flows, timer
-	print "%s: Processed %i flows within last %i seconds (%.2f flows/s)." % (
-		datetime.datetime.now(), output_flows, OUTPUT_INTERVAL, output_flows / float(OUTPUT_INTERVAL))
-	output_flows = 0
+def set_replay(horizons):
+	if dispatcher != None:
+		dispatcher.setReplay(horizons)
+	else:
+		pipeline.setReplay(horizons)
+	
+def convert_csv_row(row):
+	"""Convert the numeric values of a CSV row into integers and normalize the IP addresses.
+	"""
+	flow = dict()
+	for col, value in row.iteritems():
+		if value == "":
+			value = None
+		elif value.isdigit():
+			value = int(value)
+		flow[col] = value
+	for col in [COL_FIRST_SWITCHED, COL_LAST_SWITCHED] + config.flow_aggr_sums:
+		flow[col] = int(flow[col])
+	return subnets.normalize_flow(flow, [COL_SRC_IP, COL_DST_IP])
+	
+def read_file(filename):
+	"""Read batches of flows from a JSONL or CSV file.
+	"""
+	f = open(filename, "rb")
+	if filename.endswith(".csv"):
+		batch = []
+		for row in csv.DictReader(f):
+			try:
+				batch.append(convert_csv_row(row))
+			except (KeyError, TypeError, ValueError):
+				print >> sys.stderr, "Could not convert CSV row!"
+			if len(batch) >= args.fetch_size:
+				yield batch
+				batch = []
+		yield batch
+	else:
+		for line in f:
+			line = line.strip()
+			if line == "" or line == "END":
+				continue
+			yield decode_entry(line)
+	f.close()
+	
+def read_sql():
+	"""Read batches of flows from all tables of a Vermont database.
+	"""
+	import sqlsource
+	try:
+		conn, type = sqlsource.connect(args.sql_host, args.sql_port, args.sql_user, args.sql_password, args.sql_database)
+	except sqlsource.ConnectionErrors:
+		print >> sys.stderr, "Could not connect to source database!"
+		sys.exit(1)
+		
+	for table in sqlsource.get_tables(conn, args.sql_database):
+		for flows in sqlsource.read_table(conn, type, table, args.fetch_size):
+			yield flows
+		print "%s: Read table %s." % (datetime.datetime.now(), table)
+	conn.close()
+	
+def run_backfill():
+	"""Aggregate all flows of the source and insert the finished documents.
+	"""
+	global output_flows, total_flows, start_time, timer
+	
+	print "%s: Backfill started." % (datetime.datetime.now())
+	start_time = time.time()
 	timer = threading.Timer(OUTPUT_INTERVAL, print_output)
 	timer.start()
 	
-print "%s: Init..." % (datetime.datetime.now())
-
-# init redis connection
-try:
-	r = redis.StrictRedis(host=args.src_host, port=args.src_port, db=args.src_database)
-except Exception, e:
-	print >> sys.stderr, "Could not connect to Redis database: %s" % (e)
-	sys.exit(1)
-
-# init pymongo connection
-try:
-	dst_conn = pymongo.Connection(args.dst_host, args.dst_port)
-except pymongo.errors.AutoReconnect, e:
-	print >> sys.stderr, "Could not connect to MongoDB database!"
-	sys.exit(1)
+	try:
+		if args.from_sql:
+			source = read_sql()
+		else:
+			source = read_file(args.from_file)
+		for flows in source:
+			for flow in flows:
+				pipeline.handleFlow(flow)
+			output_flows += len(flows)
+	except KeyboardInterrupt:
+		print "%s: Keyboard interrupt. Aborting backfill, no documents were inserted." % (datetime.datetime.now())
+		sys.exit(1)
+	finally:
+		timer.cancel()
 	
-if args.clear_database:
-	dst_conn.drop_database(args.dst_database)
+	total_flows += output_flows
+	read_time = time.time() - start_time
+	print "%s: Read %i flows in %.2f seconds (%.2f flows/s). Inserting documents..." % (
+		datetime.datetime.now(), total_flows, read_time, total_flows / max(read_time, 0.001))
+		
+	# the caches of the handlers are flushed into the backfill collections
+	pipeline.flush()
+	backfill_db.finish()
 	
-dst_db = dst_conn[args.dst_database]
-node_index_collection = dst_db[DB_INDEX_NODES]
-port_index_collection = dst_db[DB_INDEX_PORTS]
+	# all documents are inserted, so the buckets up to the last flow are final
+	max_time = max([handler.max_time for handler in pipeline.handlers])
+	publish_horizon(dst_db[DB_HORIZON], "%s:backfill" % (args.worker_id),
+		dict([(s, max_time) for s in config.flow_bucket_sizes]), int(start_time))
 	
-# read ports for special filtering
-known_ports = None
-if config.flow_filter_unknown_ports:
-	f = open(PORTS_FILE, "r")
-	dom = xml.dom.minidom.parse(f)
-	f.close()
+	elapsed = time.time() - start_time
+	print ""
+	print "Processed %i flows in %.2f seconds (%.2f flows/s)." % (total_flows, elapsed, total_flows / max(elapsed, 0.001))
+	print ""
+	backfill_db.printReport()
+	pipeline.printReports()
 	
-	def getDomText(node):
-		rc = []
-		for n in node.childNodes:
-			if n.nodeType == node.TEXT_NODE:
-				rc.append(n.data)
-		return ''.join(rc)
-
-	known_ports = dict()
-	records = dom.getElementsByTagName("record")
-	for record in records:
-		description = getDomText(record.getElementsByTagName("description")[0])
-		number = record.getElementsByTagName("number")
-		if description != "Unassigned" and len(number) > 0:
-			numbers = getDomText(number[0]).split('-')
-			number = int(numbers[0])
-			number_to = int(numbers[len(numbers)-1])
-			
-			protocol = record.getElementsByTagName("protocol")
-			if len(protocol) > 0:
-				protocol = getDomText(protocol[0])
-				if protocol == "tcp":
-					protocol = 6
-				elif protocol == "udp":
-					protocol = 17
-				else:
-					protocol = 0
-			else:
-				protocol = 0
-			
-			while number <= number_to:
-				if number in known_ports:
-					known_ports[number].append(protocol)
-				else:
-					known_ports[number] = [protocol]
-				number += 1
-
-# create flow handlers
-handlers = []
-for s in config.flow_bucket_sizes:
-	handlers.append(FlowHandler(
-		s,
-		dst_db[DB_FLOW_PREFIX + str(s)],
-		config.flow_aggr_sums,
-		config.flow_aggr_values,
-		known_ports,
-		config.pre_cache_size
-	))
-for s in config.flow_bucket_sizes:
-	handlers.append(FlowHandler(
-		s,
-		dst_db[DB_FLOW_AGGR_PREFIX + str(s)],
-		config.flow_aggr_sums,
-		[],
-		None,
-		config.pre_cache_size_aggr
-	))
-
-# create indexes
-for handler in handlers:
-	handler.collection.create_index("bucket")
+if backfill_mode:
+	run_backfill()
+	sys.exit(0)
+	
+if args.batch_size > 0:
+	processing_key = REDIS_PROCESSING_PREFIX + args.worker_id
+	checkpoint_key = processing_key + REDIS_CHECKPOINT_SUFFIX
+	owner_key = processing_key + REDIS_OWNER_SUFFIX
+	owner_id = "%s:%i" % (socket.gethostname(), os.getpid())
+	dequeue = r.register_script(DEQUEUE_SCRIPT)
+	claim = r.register_script(CLAIM_SCRIPT)
+	# the latest lastSwitched of each processed but unacknowledged entry
+	pending = deque()
+	
+	# an instance with the same worker id would process the entries of this one
+	owner = claim_owner()
+	if owner != owner_id:
+		print >> sys.stderr, "The processing list %s is owned by %s, use another --worker-id!" % (processing_key, owner)
+		sys.exit(1)
+		
+	print "%s: Dequeue batches of up to %i entries." % (datetime.datetime.now(), args.batch_size)
+else:
+	print "%s: Dequeue single entries." % (datetime.datetime.now())
+	
+# start the workers after all functions are defined
+dispatcher = None
+if args.workers > 0:
+	dispatcher = Dispatcher(args.workers)
+	print "%s: Started %i worker processes." % (datetime.datetime.now(), args.workers)
+else:
+	restore_rollups(pipeline)
 
 print "%s: Preprocessing started." % (datetime.datetime.now())
 print "%s: Use Ctrl-C to quit." % (datetime.datetime.now())
 
+start_time = time.time()
 timer = threading.Timer(OUTPUT_INTERVAL, print_output)
 timer.start()
 
 # Daemon loop
-while True:
-	try:
-		# this redis call blocks until there is a new entry in the queue
-		obj = r.blpop(REDIS_QUEUE_KEY, 0)
-		obj = obj[1]
-		
-		# Terminate if this object is the END flag
-		if obj == "END":
-			print "%s: Reached END. Terminating..." % (datetime.datetime.now())
+if args.batch_size > 0:
+	last_ack = time.time()
+	running = replay_entries()
+	if not running:
+		print "%s: Reached END. Terminating..." % (datetime.datetime.now())
+		ack_entries()
+	while running:
+		try:
+			# move a batch of entries to the processing list in one call
+			batch = dequeue(keys=[REDIS_QUEUE_KEY, processing_key], args=[args.batch_size])
+			if len(batch) == 0:
+				if dispatcher != None:
+					dispatcher.sendPending()
+				else:
+					pipeline.handleTimeouts()
+				time.sleep(QUEUE_POLL_INTERVAL)
+				
+			for obj in batch:
+				# the interrupted entry may be processed partly, it is not requeued
+				pending.append(None)
+				# Terminate if this object is the END flag
+				if obj == "END":
+					print "%s: Reached END. Terminating..." % (datetime.datetime.now())
+					running = False
+					break
+				pending[-1] = handle_entry(obj)
+					
+			if not running:
+				ack_entries()
+			elif time.time() - last_ack >= config.pre_queue_ack_interval:
+				checkpoint_entries()
+				last_ack = time.time()
+				
+		except KeyboardInterrupt:
+			print "%s: Keyboard interrupt. Terminating..." % (datetime.datetime.now())
+			# the processing list may contain more entries than the current batch
+			# if the interrupt arrived while entries were dequeued
+			ack_entries()
 			break
-			
+else:
+	while True:
 		try:
-			obj = json.loads(obj)
-			obj[COL_FIRST_SWITCHED] = int(obj[COL_FIRST_SWITCHED])
-			obj[COL_LAST_SWITCHED] = int(obj[COL_LAST_SWITCHED])
-			for s in config.flow_aggr_sums:
-				obj[s] = int(obj[s])
-		except ValueError, e:
-			print >> sys.stderr, "Could not decode JSON object in queue!"
-			continue
-	
-		# Bucket slicing
-		for handler in handlers:
-			handler.handleFlow(obj)
+			# this redis call blocks until there is a new entry in the queue
+			# or the bulk linger time is over
+			obj = r.blpop(REDIS_QUEUE_KEY, BLPOP_TIMEOUT)
+			if obj == None:
+				if dispatcher != None:
+					dispatcher.sendPending()
+				else:
+					pipeline.handleTimeouts()
+				continue
 			
-		update_node_index(obj, node_index_collection, config.flow_aggr_sums)
-		update_port_index(obj, port_index_collection, config.flow_aggr_sums, known_ports)
+			# Terminate if this object is the END flag
+			if obj[1] == "END":
+				print "%s: Reached END. Terminating..." % (datetime.datetime.now())
+				break
+			handle_entry(obj[1])
 			
-		output_flows += 1
-		
-	except KeyboardInterrupt:
-		print "%s: Keyboard interrupt. Terminating..." % (datetime.datetime.now())
-		break
+		except KeyboardInterrupt:
+			print "%s: Keyboard interrupt. Terminating..." % (datetime.datetime.now())
+			break
 		
 timer.cancel()
 
 # clear cache
-for handler in handlers:
-	handler.handleCache(True)
+flush_handlers()
 # print reports
+total_flows += output_flows
+elapsed = time.time() - start_time
 print ""
-for handler in handlers:
-	handler.printReport()
\ No newline at end of file
+print "Processed %i flows in %.2f seconds (%.2f flows/s)." % (total_flows, elapsed, total_flows / elapsed)
+if dispatcher != None:
+	dispatcher.report()
+	dispatcher.terminate()
+else:
+	pipeline.printReports()
\ No newline at end of file
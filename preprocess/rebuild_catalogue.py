@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Rebuild the bucket catalogue from the aggregated flow collections.
+Only needed once for databases created before the catalogue existed,
+preprocess.py keeps it up to date afterwards.
+"""
+
+import sys
+import os.path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'config'))
+
+import argparse
+import pymongo
+
+import config
+from flowhandlers import PartitionedCollection, DB_FLOW_AGGR_PREFIX, DB_BUCKET_CATALOGUE, CATALOGUE_DAY, get_partition_size
+
+parser = argparse.ArgumentParser(description="Rebuild the bucket catalogue from the aggregated flow collections.")
+parser.add_argument("--dst-host", nargs="?", default=config.db_host, help="MongoDB host")
+parser.add_argument("--dst-port", nargs="?", default=config.db_port, type=int, help="MongoDB port")
+parser.add_argument("--dst-database", nargs="?", default=config.db_name, help="MongoDB database name")
+
+args = parser.parse_args()
+
+try:
+	dst_conn = pymongo.Connection(args.dst_host, args.dst_port)
+except pymongo.errors.AutoReconnect, e:
+	print >> sys.stderr, "Could not connect to MongoDB database!"
+	sys.exit(1)
+
+dst_db = dst_conn[args.dst_database]
+catalogue = dst_db[DB_BUCKET_CATALOGUE]
+
+for s in config.flow_bucket_sizes:
+	days = dict()
+	for start, partition in PartitionedCollection(dst_db, DB_FLOW_AGGR_PREFIX + str(s), get_partition_size(s)).getPartitions():
+		for bucket in partition.distinct("bucket"):
+			days.setdefault(bucket - bucket % CATALOGUE_DAY, []).append(bucket)
+
+	catalogue.remove({ "size": s })
+	for day, buckets in days.iteritems():
+		catalogue.insert({
+			"_id": "%i:%i" % (s, day),
+			"size": s,
+			"day": day,
+			"buckets": sorted(buckets)
+		})
+	print "%s%i: %i buckets on %i days" % (DB_FLOW_AGGR_PREFIX, s, sum([len(b) for b in days.itervalues()]), len(days))
+
+catalogue.create_index("size")
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Rebuild the cube collections from the flow collections and the node indexes
+of networks from the node index.
+Needed for databases created before a cube has been added to config.flow_cubes
+or a prefix length to config.flow_prefix_lengths, preprocess.py keeps them up
+to date afterwards.
+Stop all preprocess.py instances before rebuilding!
+"""
+
+import sys
+import os.path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'config'))
+
+import argparse
+import datetime
+import pymongo
+
+import config
+import subnets
+from flowhandlers import FlowHandler, IndexHandler, PartitionedCollection
+from flowhandlers import DB_FLOW_PREFIX, DB_FLOW_CUBE_PREFIX, DB_FLOW_NET_PREFIX, DB_INDEX_NODES
+from flowhandlers import get_cubes, get_cube_collection, get_prefix_lengths, get_prefix_collection, get_prefix_index, get_partition_size, get_net_values
+
+parser = argparse.ArgumentParser(description="Rebuild the cube collections from the flow collections.")
+parser.add_argument("--dst-host", nargs="?", default=config.db_host, help="MongoDB host")
+parser.add_argument("--dst-port", nargs="?", default=config.db_port, type=int, help="MongoDB port")
+parser.add_argument("--dst-database", nargs="?", default=config.db_name, help="MongoDB database name")
+
+args = parser.parse_args()
+
+try:
+	dst_conn = pymongo.Connection(args.dst_host, args.dst_port)
+except pymongo.errors.AutoReconnect, e:
+	print >> sys.stderr, "Could not connect to MongoDB database!"
+	sys.exit(1)
+
+dst_db = dst_conn[args.dst_database]
+
+startTime = datetime.datetime.now()
+print "%s: Rebuild started." % (startTime)
+
+# remove the cubes and prefix lengths which are not configured anymore (with all their partitions)
+names = [get_cube_collection(fields, s) for fields in get_cubes() for s in config.flow_bucket_sizes]
+names += [get_prefix_collection(length, s) for length, length6 in get_prefix_lengths() for s in config.flow_bucket_sizes]
+indexes = [get_prefix_index(length) for length, length6 in get_prefix_lengths()]
+for name in dst_db.collection_names():
+	base, sep, start = name.rpartition("_")
+	if (name.startswith(DB_FLOW_CUBE_PREFIX) or name.startswith(DB_FLOW_NET_PREFIX)) and name not in names and not (start.isdigit() and base in names) \
+		or name.startswith(DB_INDEX_NODES + "_") and name not in indexes:
+		dst_db.drop_collection(name)
+		print "%s: removed" % (name)
+
+for s in config.flow_bucket_sizes:
+	handlers = []
+	for fields in get_cubes():
+		collection = PartitionedCollection(dst_db, get_cube_collection(fields, s), get_partition_size(s))
+		collection.drop()
+		handlers.append(FlowHandler(s, collection, config.flow_aggr_sums, fields, None,
+			config.pre_cache_size, config.pre_bulk_size, config.pre_bulk_linger))
+	net_values = get_net_values()
+	for prefix in get_prefix_lengths():
+		collection = PartitionedCollection(dst_db, get_prefix_collection(prefix[0], s), get_partition_size(s), net_values)
+		collection.drop()
+		handlers.append(FlowHandler(s, collection, config.flow_aggr_sums, net_values, None,
+			config.pre_cache_size, config.pre_bulk_size, config.pre_bulk_linger, prefix=prefix))
+
+	# the flows are read sorted by bucket, so every bucket is complete
+	# when the next one starts and leaves the cache
+	fields = config.flow_aggr_values + ["bucket", "flows"] + config.flow_aggr_sums
+	flows = PartitionedCollection(dst_db, DB_FLOW_PREFIX + str(s), get_partition_size(s))
+	for start, partition in flows.getPartitions():
+		for doc in partition.find(fields=fields).sort("bucket", pymongo.ASCENDING).batch_size(1000):
+			incs = dict([(v, doc.get(v, 0)) for v in ["flows"] + config.flow_aggr_sums])
+			for handler in handlers:
+				handler.max_time = doc["bucket"]
+				handler.handleRollup({ "$set": doc, "$inc": incs })
+				handler.handleCache()
+
+	for handler in handlers:
+		handler.handleCache(True)
+		handler.handleBulk(True)
+		num_docs = sum([partition.count() for start, partition in handler.collection.getPartitions()])
+		print "%s: %i documents rolled up into %i documents" % (handler.collection.name, handler.num_rollups, num_docs)
+		
+# the counters of the nodes are summed up per network
+for prefix in get_prefix_lengths():
+	index = IndexHandler(dst_db[get_prefix_index(prefix[0])], config.pre_index_cache_size, 0, config.pre_bulk_size)
+	index.collection.drop()
+	for doc in dst_db[DB_INDEX_NODES].find().batch_size(1000):
+		incs = dict()
+		for k, v in doc.iteritems():
+			if isinstance(v, dict):
+				for s, c in v.iteritems():
+					incs[k + "." + s] = c
+			elif k != "_id":
+				incs[k] = v
+		index.handleUpdate(subnets.get_network(doc["_id"], *prefix), { "$inc": incs })
+	index.handleCache(True)
+	print "%s: %i nodes summed up into %i networks" % (index.collection.name, index.num_updates, index.collection.count())
+
+endTime = datetime.datetime.now()
+print "%s: Rebuild finished in %s." % (endTime, endTime - startTime)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Send generated NetFlow v5, NetFlow v9 or IPFIX packets to a collector.
+Used to test collector.py over loopback:
+
+./collector.py --port 2055
+./send_netflow.py --port 2055 --version 9 --packets 10000
+
+The sums of the sent packets and bytes are printed at the end, so they can
+be compared with the flows_aggr_* collections.
+"""
+
+import time
+import socket
+import struct
+import random
+import argparse
+
+import netflow
+
+parser = argparse.ArgumentParser(description="Send generated NetFlow v5/v9 or IPFIX packets over UDP.")
+parser.add_argument("--host", nargs="?", default="127.0.0.1", help="Collector host")
+parser.add_argument("--port", nargs="?", default=2055, type=int, help="Collector UDP port")
+parser.add_argument("--version", nargs="?", default=5, type=int, choices=[5, 9, 10], help="NetFlow version (10 is IPFIX)")
+parser.add_argument("--packets", nargs="?", default=1000, type=int, help="Number of packets to send")
+parser.add_argument("--records", nargs="?", default=30, type=int, help="Number of flow records per packet")
+parser.add_argument("--rate", nargs="?", default=0, type=int, help="Packets per second (0 sends as fast as possible)")
+parser.add_argument("--template-interval", nargs="?", default=20, type=int, help="Resend the template with every ...th packet")
+parser.add_argument("--seed", nargs="?", default=0, type=int, help="Seed of the generated flows")
+
+args = parser.parse_args()
+
+# v5 allows at most 30 records per packet
+if args.version == netflow.VERSION_V5:
+	args.records = min(args.records, 30)
+
+TEMPLATE_ID = 256
+SOURCE_ID = 1
+# the exporter booted ... milliseconds before the first packet
+BOOT_UPTIME = 3600 * 1000
+
+# NetFlow v9 uses uptime based timestamps, IPFIX absolute milliseconds
+V9_FIELDS = [
+	(netflow.IE_SRC_IPV4, 4), (netflow.IE_DST_IPV4, 4), (netflow.IE_SRC_PORT, 2), (netflow.IE_DST_PORT, 2),
+	(netflow.IE_PROTO, 1), (netflow.IE_PACKETS, 4), (netflow.IE_OCTETS, 8),
+	(netflow.IE_FIRST_UPTIME, 4), (netflow.IE_LAST_UPTIME, 4)
+]
+IPFIX_FIELDS = [
+	(netflow.IE_SRC_IPV4, 4), (netflow.IE_DST_IPV4, 4), (netflow.IE_SRC_PORT, 2), (netflow.IE_DST_PORT, 2),
+	(netflow.IE_PROTO, 1), (netflow.IE_PACKETS, 8), (netflow.IE_OCTETS, 8),
+	(netflow.IE_START_MILLISECONDS, 8), (netflow.IE_END_MILLISECONDS, 8)
+]
+V9_RECORD = struct.Struct("!IIHHBIQII")
+IPFIX_RECORD = struct.Struct("!IIHHBQQQQ")
+
+def generate_flow(now):
+	"""Generate a flow which ended up to a minute before now.
+	"""
+	last = now - random.randint(0, 60 * 1000)
+	first = last - random.choice([0, 0, 500, 5000, 30000, 200000])
+	return (
+		0x0a000000 + random.randint(0, 1023),
+		0xc0a80100 + random.randint(0, 31),
+		random.choice([80, 443, 22, 53, 12345, 40000]),
+		random.choice([80, 443, 22, 53, 8080, 65000]),
+		random.choice([6, 17]),
+		random.randint(1, 100),
+		random.randint(40, 100000),
+		first,
+		last
+	)
+
+def pack_set(set_id, body):
+	# sets are padded to 4 bytes
+	body += "\x00" * (-len(body) % 4)
+	return netflow.SET_HEADER.pack(set_id, netflow.SET_HEADER.size + len(body)) + body
+
+def pack_template(set_id, fields):
+	body = netflow.FIELD.pack(TEMPLATE_ID, len(fields))
+	for ie, length in fields:
+		body += netflow.FIELD.pack(ie, length)
+	return pack_set(set_id, body)
+
+def build_v5(seq, flows, now, uptime):
+	packet = netflow.V5_HEADER.pack(netflow.VERSION_V5, len(flows), uptime, now // 1000, now % 1000 * 1000000, seq, 0, 0, 0)
+	for src_ip, dst_ip, src_port, dst_port, proto, pkts, octets, first, last in flows:
+		packet += netflow.V5_RECORD.pack(src_ip, dst_ip, 0, 0, 0, pkts, octets,
+			uptime - (now - first), uptime - (now - last), src_port, dst_port, 0, 0, proto, 0, 0, 0, 0, 0, 0)
+	return packet
+
+def build_v9(seq, flows, now, uptime, template):
+	sets = ""
+	if template:
+		sets += pack_template(netflow.V9_TEMPLATE_SET, V9_FIELDS)
+	records = ""
+	for src_ip, dst_ip, src_port, dst_port, proto, pkts, octets, first, last in flows:
+		records += V9_RECORD.pack(src_ip, dst_ip, src_port, dst_port, proto, pkts, octets,
+			uptime - (now - first), uptime - (now - last))
+	sets += pack_set(TEMPLATE_ID, records)
+	count = len(flows) + (1 if template else 0)
+	return netflow.V9_HEADER.pack(netflow.VERSION_V9, count, uptime, now // 1000, seq, SOURCE_ID) + sets
+
+def build_ipfix(seq, flows, now, template):
+	sets = ""
+	if template:
+		sets += pack_template(netflow.IPFIX_TEMPLATE_SET, IPFIX_FIELDS)
+	records = ""
+	for flow in flows:
+		records += IPFIX_RECORD.pack(*flow)
+	sets += pack_set(TEMPLATE_ID, records)
+	return netflow.IPFIX_HEADER.pack(netflow.VERSION_IPFIX, netflow.IPFIX_HEADER.size + len(sets), now // 1000, seq, SOURCE_ID) + sets
+
+random.seed(args.seed)
+sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+start_time = time.time()
+start_msecs = int(start_time * 1000)
+total_pkts = 0
+total_bytes = 0
+total_records = 0
+for i in xrange(args.packets):
+	now = int(time.time() * 1000)
+	uptime = BOOT_UPTIME + now - start_msecs
+	flows = [generate_flow(now) for j in xrange(args.records)]
+	template = i % args.template_interval == 0
+
+	if args.version == netflow.VERSION_V5:
+		packet = build_v5(total_records, flows, now, uptime)
+	elif args.version == netflow.VERSION_V9:
+		packet = build_v9(i, flows, now, uptime, template)
+	else:
+		packet = build_ipfix(total_records, flows, now, template)
+
+	sock.sendto(packet, (args.host, args.port))
+	total_records += len(flows)
+	for flow in flows:
+		total_pkts += flow[5]
+		total_bytes += flow[6]
+
+	if args.rate > 0:
+		delay = start_time + (i + 1) / float(args.rate) - time.time()
+		if delay > 0:
+			time.sleep(delay)
+
+elapsed = time.time() - start_time
+print "Sent %i packets with %i records in %.2f seconds (%.2f packets/s)." % (args.packets, total_records, elapsed, args.packets / elapsed)
+print "Sum of pkts: %i" % (total_pkts)
+print "Sum of bytes: %i" % (total_bytes)
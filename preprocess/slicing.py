@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""
+Vectorized slicing of flow batches into buckets with NumPy.
+
+The slices are computed with the same floating point operations in the
+same order as FlowHandler.handleFlow, so the integer carry semantics
+and therefore the sliced values are exactly the same.
+"""
+
+import numpy
+
+def slice_flows(first, last, values, interval):
+	"""Slice a batch of flows into buckets.
+
+	Returns the index of the flow, the bucket, the sliced values and
+	the interval factor of every slice.
+
+	:Parameters:
+	 - `first`: An int64 array of the firstSwitched timestamps.
+	 - `last`: An int64 array of the lastSwitched timestamps.
+	 - `values`: A list of int64 arrays which will be sliced and summed up.
+	 - `interval`: The bucket interval in seconds.
+	"""
+	num = len(first)
+	duration = (last - first + 1).astype(numpy.float64)
+	bucket = first // interval * interval
+	carry = [numpy.zeros(num, numpy.float64) for v in values]
+	emitted = [numpy.zeros(num, numpy.int64) for v in values]
+
+	out_index = []
+	out_bucket = []
+	out_values = [[] for v in values]
+	out_factor = []
+
+	# one iteration per slice position, all flows at once
+	active = numpy.nonzero(bucket <= last)[0]
+	while len(active) > 0:
+		b = bucket[active]
+		l = last[active]
+		next_bucket = b + interval
+		start = numpy.maximum(b, first[active])
+		end = numpy.minimum(next_bucket - 1, l)
+		factor = (end - start + 1) / duration[active]
+		final = next_bucket > l
+
+		for j, v in enumerate(values):
+			v = v[active]
+			total = carry[j][active] + factor * v
+			val = numpy.trunc(total)
+			carry[j][active] = total - val
+			# the last slice gets the rest
+			val = numpy.where(final, v - emitted[j][active], val.astype(numpy.int64))
+			emitted[j][active] += val
+			out_values[j].append(val)
+
+		out_index.append(active)
+		out_bucket.append(b)
+		out_factor.append(factor)
+
+		bucket[active] = next_bucket
+		active = active[~final]
+
+	if len(out_index) == 0:
+		empty = numpy.zeros(0, numpy.int64)
+		return empty, empty, [empty for v in values], numpy.zeros(0, numpy.float64)
+
+	return (
+		numpy.concatenate(out_index),
+		numpy.concatenate(out_bucket),
+		[numpy.concatenate(v) for v in out_values],
+		numpy.concatenate(out_factor)
+	)
+
+def reduce_slices(key_index, bucket, values, factor, interval):
+	"""Sum up all slices with the same bucket and key.
+
+	Returns the key index, the bucket, the summed values and the
+	summed interval factors of every distinct bucket and key.
+
+	:Parameters:
+	 - `key_index`: An int64 array of the key number of every slice.
+	 - `bucket`: An int64 array of the bucket of every slice.
+	 - `values`: A list of int64 arrays of the sliced values.
+	 - `factor`: A float64 array of the interval factors.
+	 - `interval`: The bucket interval in seconds.
+	"""
+	if len(bucket) == 0:
+		return key_index, bucket, values, factor
+
+	min_bucket = bucket.min()
+	num_buckets = (bucket.max() - min_bucket) // interval + 1
+	group = key_index * num_buckets + (bucket - min_bucket) // interval
+	groups, inverse = numpy.unique(group, return_inverse=True)
+
+	sums = []
+	for v in values:
+		s = numpy.zeros(len(groups), numpy.int64)
+		numpy.add.at(s, inverse, v)
+		sums.append(s)
+
+	return (
+		groups // num_buckets,
+		groups % num_buckets * interval + min_bucket,
+		sums,
+		numpy.bincount(inverse, weights=factor, minlength=len(groups))
+	)
+
+def max_registers(key_index, bucket, register, rank, interval):
+	"""Find the largest HyperLogLog rank of every register per bucket and key.
+
+	Returns the key index, the bucket, the register and the rank of every
+	distinct bucket, key and register.
+
+	:Parameters:
+	 - `key_index`: An int64 array of the key number of every slice.
+	 - `bucket`: An int64 array of the bucket of every slice.
+	 - `register`: An int64 array of the register of every slice.
+	 - `rank`: An int64 array of the rank of every slice.
+	 - `interval`: The bucket interval in seconds.
+	"""
+	if len(bucket) == 0:
+		return key_index, bucket, register, rank
+
+	min_bucket = bucket.min()
+	num_buckets = (bucket.max() - min_bucket) // interval + 1
+	num_registers = register.max() + 1
+	group = (key_index * num_buckets + (bucket - min_bucket) // interval) * num_registers + register
+	groups, inverse = numpy.unique(group, return_inverse=True)
+
+	ranks = numpy.zeros(len(groups), numpy.int64)
+	numpy.maximum.at(ranks, inverse, rank)
+
+	slots = groups // num_registers
+	return (
+		slots // num_buckets,
+		slots % num_buckets * interval + min_bucket,
+		groups % num_registers,
+		ranks
+	)
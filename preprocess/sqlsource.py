@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""
+Read flows from MySQL or PostgreSQL databases in Vermont format.
+
+The flows are stored in hourly tables named h_*. Tables are read through
+server-side cursors in batches, so no table is loaded into memory at once.
+"""
+
+import psycopg2
+import MySQLdb
+import MySQLdb.cursors
+import _mysql_exceptions
+
+IGNORE_COLUMNS = ["firstSwitchedMillis", "lastSwitchedMillis"]
+
+# errors raised if no connection can be established
+ConnectionErrors = (psycopg2.OperationalError, _mysql_exceptions.OperationalError)
+
+def connect(host, port, user, password, database):
+	"""Connect to the source database.
+	Returns the connection and the type of the database.
+	"""
+	# check if is there a MySQL or a PostgreSQL database
+	try:
+		dns = dict(
+			database = database,
+			host = host,
+			user = user,
+			password = password
+		)
+		if port is not None:
+			dns["port"] = port
+		return psycopg2.connect(**dns), "postgresql"
+	except psycopg2.OperationalError:
+		dns = dict(
+			db = database,
+			host = host,
+			user = user,
+			passwd = password
+		)
+		if port is not None:
+			dns["port"] = port
+		return MySQLdb.connect(**dns), "mysql"
+
+def get_tables(conn, database):
+	"""Get the names of all flow tables ordered by time.
+	"""
+	c = conn.cursor()
+	c.execute("""SELECT table_name from information_schema.tables
+		WHERE table_schema=%s AND table_type='BASE TABLE' AND table_name LIKE 'h\\_%%' ORDER BY table_name ASC""",
+		(database,))
+	tables = [table[0] for table in c.fetchall()]
+
+	# THIS IS MYSQL SPECIFIC
+	#c.execute("SHOW TABLES LIKE 'h\\_%'")
+	#tables = c.fetchall()
+
+	c.close()
+	return tables
+
+def open_cursor(conn, type):
+	"""Open a cursor which keeps the result set on the server.
+	"""
+	if type == "postgresql":
+		return conn.cursor(name="import_flows")
+	return conn.cursor(MySQLdb.cursors.SSCursor)
+
+def read_table(conn, type, table, fetch_size):
+	"""Iterate over the flows of a table in batches of flow dictionaries.
+
+	:Parameters:
+	 - `conn`: The connection returned by connect.
+	 - `type`: The type of the database returned by connect.
+	 - `table`: The name of the table.
+	 - `fetch_size`: The number of rows fetched at once.
+	"""
+	c = open_cursor(conn, type)
+	c.execute("SELECT * FROM " + table + " ORDER BY firstSwitched ASC")
+
+	rows = c.fetchmany(fetch_size)
+	columns = [(j, col[0]) for j, col in enumerate(c.description) if col[0] not in IGNORE_COLUMNS]
+	while len(rows) > 0:
+		yield [dict([(name, row[j]) for j, name in columns]) for row in rows]
+		rows = c.fetchmany(fetch_size)
+
+	c.close()
+	# end the transaction of the named cursor
+	conn.commit()
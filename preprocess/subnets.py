@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+"""
+Normalization of IP addresses and their networks of a prefix length.
+
+The flows store IPv4 addresses as integers and IPv6 addresses as strings
+like the Vermont flow tables and the NetFlow decoder. Flows from JSON or
+CSV may contain dotted IPv4 strings or IPv6 strings in any notation, so
+they are normalized before they are routed and aggregated, otherwise one
+address would lead to several index entries.
+"""
+
+import socket
+import struct
+
+INT32 = struct.Struct(">I")
+INT128 = struct.Struct(">QQ")
+
+def normalize_ip(value):
+	"""Returns an IPv4 address as integer and an IPv6 address in its canonical notation.
+	Other values are returned unchanged.
+	"""
+	if value == None or isinstance(value, (int, long)):
+		return value
+	try:
+		return INT32.unpack(socket.inet_pton(socket.AF_INET, value))[0]
+	except (socket.error, TypeError, ValueError):
+		pass
+	try:
+		return socket.inet_ntop(socket.AF_INET6, socket.inet_pton(socket.AF_INET6, value))
+	except (socket.error, TypeError, ValueError):
+		return value
+
+def normalize_flow(flow, columns):
+	"""Normalize the IP addresses of a flow in place.
+
+	:Parameters:
+	 - `flow`: A dictionary containing a flow.
+	 - `columns`: The column names of the IP addresses.
+	"""
+	for col in columns:
+		value = flow.get(col, None)
+		if value != None and not isinstance(value, (int, long)):
+			flow[col] = normalize_ip(value)
+	return flow
+
+def get_network(value, length, length6):
+	"""Returns the network address of an IP address, e.g. 10.1.2.0 for
+	10.1.2.3 and a prefix length of 24. Other values are returned unchanged.
+
+	:Parameters:
+	 - `value`: An IP address as integer or string.
+	 - `length`: The prefix length of IPv4 addresses.
+	 - `length6`: The prefix length of IPv6 addresses.
+	"""
+	value = normalize_ip(value)
+	if isinstance(value, (int, long)):
+		if 0 <= value < 1 << 32:
+			return value & ~((1 << 32 - length) - 1)
+		if 0 <= value < 1 << 128:
+			return value & ~((1 << 128 - length6) - 1)
+		return value
+
+	try:
+		high, low = INT128.unpack(socket.inet_pton(socket.AF_INET6, value))
+	except (socket.error, TypeError, ValueError):
+		return value
+	network = (high << 64 | low) & ~((1 << 128 - length6) - 1)
+	return socket.inet_ntop(socket.AF_INET6, INT128.pack(network >> 64, network & 0xffffffffffffffff))
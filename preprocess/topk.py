@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+"""
+Heavy-hitter summaries of the flow documents of each bucket.
+
+A SpaceSaving summary (Metwally et al.) counts the weight of at most
+`capacity` items. An item which is not counted replaces the item with the
+smallest counter and inherits its count as error, so every counter
+overestimates the true weight by at most its error and no item which is
+not counted can weigh more than the smallest counter.
+
+The TopKHandler keeps one summary per bucket, aggregation values and
+summed up value and writes it when the bucket is closed. The app merges
+the summaries of any time range into an approximate top-k list.
+"""
+
+import heapq
+import bson
+
+# the summaries of closed buckets are written when more than ... buckets
+# are kept, so slices of long flows arriving after their bucket has been
+# closed do not lead to a document each
+MAX_BUCKETS = 100
+
+class SpaceSaving:
+	def __init__(self, capacity):
+		"""
+		:Parameters:
+		 - `capacity`: The maximum number of counted items.
+		"""
+		self.capacity = capacity
+		# item -> [count, error]
+		self.counters = dict()
+		# (count, item) entries, outdated ones are skipped when popped
+		self.heap = []
+		self.total = 0
+
+	def add(self, item, weight):
+		self.total += weight
+		counter = self.counters.get(item, None)
+		if counter != None:
+			counter[0] += weight
+		elif len(self.counters) < self.capacity:
+			counter = [weight, 0]
+			self.counters[item] = counter
+		else:
+			# replace the item with the smallest counter
+			while True:
+				count, smallest = heapq.heappop(self.heap)
+				if self.counters[smallest][0] == count:
+					break
+			del self.counters[smallest]
+			counter = [count + weight, count]
+			self.counters[item] = counter
+		heapq.heappush(self.heap, (counter[0], item))
+
+		if len(self.heap) > 4 * self.capacity:
+			self.heap = [(c[0], i) for i, c in self.counters.iteritems()]
+			heapq.heapify(self.heap)
+
+	def getFloor(self):
+		"""Returns the largest weight an item which is not counted may have.
+		"""
+		if len(self.counters) < self.capacity:
+			return 0
+		return min([c[0] for c in self.counters.itervalues()])
+
+	def getItems(self):
+		"""Returns the counted items as [item, count, error] lists, heaviest first.
+		"""
+		items = [[i, c[0], c[1]] for i, c in self.counters.iteritems()]
+		items.sort(key=lambda item: item[1], reverse=True)
+		return items
+
+class TopKHandler:
+	def __init__(self, bucket_interval, collection, fields, values, capacity):
+		"""
+		:Parameters:
+		 - `bucket_interval`: The bucket interval in seconds.
+		 - `collection`: A PartitionedCollection to insert the summaries.
+		 - `fields`: A list of lists of aggregation values to find the heavy hitters of.
+		 - `values`: The summed up values the items are weighted by.
+		 - `capacity`: The number of items counted per summary.
+		"""
+		self.bucket_interval = bucket_interval
+		self.collection = collection
+		self.fields = fields
+		self.values = values
+		self.capacity = capacity
+
+		# bucket -> (fields index, value) -> summary
+		self.sketches = dict()
+
+		# stats
+		self.num_docs = 0
+		self.num_sketches = 0
+		self.db_requests = 0
+
+	def handleDoc(self, doc, watermark):
+		"""Add a flow document leaving the flow handler to the summaries of its bucket.
+		"""
+		self.num_docs += 1
+		bucket = doc["$set"]["bucket"]
+
+		sketches = self.sketches.get(bucket, None)
+		if sketches == None:
+			if len(self.sketches) >= MAX_BUCKETS:
+				self.handleSketches(watermark)
+			sketches = dict()
+			self.sketches[bucket] = sketches
+
+		for i, fields in enumerate(self.fields):
+			if len(fields) == 1:
+				item = doc["$set"].get(fields[0], None)
+			else:
+				item = tuple([doc["$set"].get(f, None) for f in fields])
+			for v in self.values:
+				weight = doc["$inc"].get(v, 0)
+				if weight <= 0:
+					continue
+				sketch = sketches.get((i, v), None)
+				if sketch == None:
+					sketch = SpaceSaving(self.capacity)
+					sketches[(i, v)] = sketch
+				sketch.add(item, weight)
+
+	def handleSketches(self, watermark, clear=False):
+		"""Write the summaries of all buckets which ended before the watermark
+		or all of them if `clear` is set.
+		"""
+		for bucket in self.sketches.keys():
+			if not clear and bucket + self.bucket_interval > watermark:
+				continue
+
+			collection = self.collection.get(bucket)
+			for (i, v), sketch in self.sketches.pop(bucket).iteritems():
+				# late flows lead to another summary of the same bucket,
+				# so every summary is a document of its own
+				collection.update(
+					{ "_id": bson.objectid.ObjectId() },
+					{
+						"$set": {
+							"bucket": bucket,
+							"fields": "_".join(self.fields[i]),
+							"value": v,
+							"floor": sketch.getFloor(),
+							"items": sketch.getItems()
+						},
+						"$inc": { "total": sketch.total }
+					},
+					True)
+				self.num_sketches += 1
+				self.db_requests += 1
+
+	def printReport(self):
+		print "%s report:" % (self.collection.name)
+		print "-----------------------------------"
+		print "Documents summarized: %i" % (self.num_docs)
+		print "Summaries written: %i (max. %i items each)" % (self.num_sketches, self.capacity)
+		print "Database requests: %i" % (self.db_requests)
+		print ""